@@ -1,39 +1,64 @@
-from passlib.context import CryptContext
 from datetime import timedelta, datetime, timezone
+from time import time
 
 import jwt
 
+from app.cache import TTLCache
+
+from .password_hasher import PasswordHasher
+
 class Auth:
     """
     Provide methods to create & verify password and JWT tokens
+
+    Verified tokens are cached until 'token_cache_ttl' passes or the token
+    expires, whichever comes first
     """
     
     def __init__(self, 
                  secret_key: str, 
                  access_token_expires_delta: timedelta,
-                 algorithm = 'HS256'):
+                 algorithm = 'HS256',
+                 *,
+                 token_cache_size: int = 10000,
+                 token_cache_ttl: timedelta = timedelta(minutes = 5),
+                 password_hasher: PasswordHasher | None = None):
         
         self.algorithm = algorithm
         self.access_token_expires_delta = access_token_expires_delta
 
         self.__secret_key = secret_key
-        self.__pwd_context = CryptContext(schemes = ['bcrypt'], deprecated = 'auto')
+        self.__password_hasher = password_hasher or PasswordHasher()
+        self.__verified_tokens = TTLCache(token_cache_size, token_cache_ttl)
 
 
-    def verify_password(self, plain: str | bytes, hashed: str | bytes) -> bool:
+    async def verify_password(self, plain: str | bytes, hashed: str | bytes) -> tuple[bool, str | None]:
         """
-        Return True, if the hash of 'plain' is the same as 'hashed'
+        Return True, if the hash of 'plain' is the same as 'hashed', and the new hash
+        of the password, if 'hashed' has to be replaced (the bcrypt cost was changed)
+
+        Raise HasherBusyError, if too many passwords are being hashed
         """
         
-        return self.__pwd_context.verify(plain, hashed)
+        return await self.__password_hasher.verify_and_update(plain, hashed)
     
 
-    def hash_password(self, plain: str | bytes) -> str:
+    async def hash_password(self, plain: str | bytes) -> str:
         """
         Return the hash of the provided password
+
+        Raise HasherBusyError, if too many passwords are being hashed
         """
 
-        return self.__pwd_context.hash(plain)
+        return await self.__password_hasher.hash(plain)
+
+
+    async def warm_up(self):
+        await self.__password_hasher.warm_up()
+
+
+    def close(self):
+        self.__password_hasher.close()
 
     
     def create_access_token(self, 
@@ -56,7 +81,13 @@ class Auth:
         Raise ExpiredSignatureError, if the token is expired
         """
         
-        payload = jwt.decode(access_token, self.__secret_key, algorithms = [self.algorithm])                    
+        username = self.__verified_tokens.get(access_token)
+        if username:
+            return username
+
+        payload = jwt.decode(access_token, self.__secret_key, algorithms = [self.algorithm])
+        self.__verified_tokens.set(access_token, payload['sub'], payload['exp'] - time())
+
         return payload['sub']
 
     
@@ -3,4 +3,8 @@ class AuthError(Exception):
 
 
 class WrongCredentialsError(AuthError):
+    pass
+
+
+class HasherBusyError(AuthError):
     pass
\ No newline at end of file
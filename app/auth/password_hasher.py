@@ -0,0 +1,119 @@
+import asyncio
+
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from functools import cache
+from typing import TYPE_CHECKING
+
+from .exceptions import HasherBusyError
+
+if TYPE_CHECKING:
+    from passlib.context import CryptContext
+
+
+@cache
+def _crypt_context(rounds: int) -> 'CryptContext':
+    """
+    Return the context of the process for the bcrypt cost.
+
+    Hashes with any other cost need an update, so they are rehashed on login
+    """
+
+    # Imported by the executor on the first use, not by the worker on start
+    from passlib.context import CryptContext
+
+    return CryptContext(schemes = ['bcrypt'],
+                        deprecated = 'auto',
+                        bcrypt__default_rounds = rounds,
+                        bcrypt__min_rounds = rounds,
+                        bcrypt__max_rounds = rounds)
+
+
+# Module level functions can be sent to the worker processes
+def _hash(rounds: int, plain: str | bytes) -> str:
+    return _crypt_context(rounds).hash(plain)
+
+
+def _verify_and_update(rounds: int, plain: str | bytes, hashed: str | bytes) -> tuple[bool, str | None]:
+    return _crypt_context(rounds).verify_and_update(plain, hashed)
+
+
+def _load_backend(rounds: int):
+    _crypt_context(rounds).handler().get_backend()
+
+
+class PasswordHasher:
+    """
+    Hash and verify passwords with bcrypt on a dedicated executor, so the
+    event loop is never blocked by the hashing.
+
+    At most 'workers' passwords are hashed at once and 'max_queue' more wait
+    for a worker. Any other request is rejected with HasherBusyError instead
+    of piling up
+    """
+
+    def __init__(self,
+                 *,
+                 rounds: int = 12,
+                 executor: str = 'thread',
+                 workers: int = 4,
+                 max_queue: int = 64):
+
+        if executor not in ('thread', 'process'):
+            raise ValueError(f'Unknown password hasher executor "{executor}"')
+
+        self.rounds = rounds
+        self.workers = workers
+        self.max_queue = max_queue
+
+        self.__executor: Executor = (ThreadPoolExecutor(workers, thread_name_prefix = 'bcrypt')
+                                     if executor == 'thread'
+                                     else ProcessPoolExecutor(workers))
+        self.__pending = 0
+
+
+    async def hash(self, plain: str | bytes) -> str:
+        """
+        Return the hash of the provided password
+
+        Raise HasherBusyError, if the queue is full
+        """
+
+        return await self.__run(_hash, self.rounds, plain)
+
+
+    async def verify_and_update(self, plain: str | bytes, hashed: str | bytes) -> tuple[bool, str | None]:
+        """
+        Return True, if the hash of 'plain' is the same as 'hashed', and the new
+        hash of 'plain', if 'hashed' was made with another bcrypt cost
+
+        Raise HasherBusyError, if the queue is full
+        """
+
+        return await self.__run(_verify_and_update, self.rounds, plain, hashed)
+
+
+    async def warm_up(self):
+        """
+        Start every worker and load the bcrypt backend in it, so the first
+        logins do not pay for it
+        """
+
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self.__executor, _load_backend, self.rounds)
+                               for _ in range(self.workers)))
+
+
+    def close(self):
+        self.__executor.shutdown(wait = False, cancel_futures = True)
+
+
+    async def __run(self, function, *args):
+        if self.__pending >= self.workers + self.max_queue:
+            raise HasherBusyError('Too many passwords are being hashed')
+
+        self.__pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.__executor, function, *args)
+
+        finally:
+            self.__pending -= 1
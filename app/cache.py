@@ -0,0 +1,68 @@
+from collections import OrderedDict
+from datetime import timedelta
+from time import monotonic
+from typing import Any, Hashable
+
+
+class TTLCache:
+    """
+    Bounded cache whose entries expire after the TTL.
+
+    When the cache is full, the least recently set entry is evicted
+    """
+
+    def __init__(self, max_size: int, ttl: timedelta):
+        self.max_size = max_size
+        self.ttl = ttl.total_seconds()
+
+        # key -> (expiration time, value)
+        self.__entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Return the value of the key or 'default', if the key is missing or expired
+        """
+
+        entry = self.__entries.get(key)
+        if not entry:
+            return default
+
+        expires_at, value = entry
+        if expires_at <= monotonic():
+            del self.__entries[key]
+            return default
+
+        return value
+
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None):
+        """
+        Store the value for 'ttl' seconds, which can not exceed the TTL of the cache
+        """
+
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.max_size <= 0:
+            return
+
+        self.__entries[key] = (monotonic() + ttl, value)
+        self.__entries.move_to_end(key)
+
+        while len(self.__entries) > self.max_size:
+            self.__entries.popitem(last = False)
+
+
+    def pop(self, key: Hashable):
+        """
+        Remove the key, if it is cached
+        """
+
+        self.__entries.pop(key, None)
+
+
+    def clear(self):
+        self.__entries.clear()
+
+
+    def __len__(self) -> int:
+        return len(self.__entries)
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+
+from datetime import datetime, timedelta, timezone
+from time import time
+
+from app.db.base_storage import BaseStorage
+
+
+logger = logging.getLogger(__name__)
+
+
+class ClickCounter:
+    """
+    Aggregate redirect clicks in memory and flush them to the storage in bulk.
+
+    Counting a click is a dict update without any awaits, the storage sees one
+    update per URL every 'flush_interval' (or earlier, if 'max_pending' URLs
+    are waiting) and once more on stop
+    """
+
+    def __init__(self,
+                 storage: BaseStorage,
+                 *,
+                 flush_interval: timedelta = timedelta(seconds = 5),
+                 max_pending: int = 10000):
+
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self.__storage = storage
+
+        # 'internal_url' -> [clicks, timestamp of the last click]
+        self.__pending: dict[str, list] = {}
+
+        self.__full = asyncio.Event()
+        self.__task: asyncio.Task | None = None
+
+
+    def hit(self, internal_url: str):
+        """
+        Count a click on the URL
+        """
+
+        pending = self.__pending.get(internal_url)
+        if pending:
+            pending[0] += 1
+            pending[1] = time()
+            return
+
+        self.__pending[internal_url] = [1, time()]
+        if len(self.__pending) >= self.max_pending:
+            self.__full.set()
+
+
+    def start(self):
+        """
+        Start flushing the clicks in background
+        """
+
+        self.__task = asyncio.create_task(self.__run())
+
+
+    async def stop(self):
+        """
+        Stop the background flushing and flush the remaining clicks
+        """
+
+        if self.__task:
+            self.__task.cancel()
+            await asyncio.gather(self.__task, return_exceptions = True)
+            self.__task = None
+
+        await self.flush()
+
+
+    async def flush(self):
+        """
+        Write the pending clicks to the storage.
+
+        If the write fails, the clicks are kept to be written with the next flush
+        """
+
+        if not self.__pending:
+            return
+
+        pending, self.__pending = self.__pending, {}
+        self.__full.clear()
+
+        clicks = {internal_url: (count, datetime.fromtimestamp(last_access, timezone.utc))
+                  for internal_url, (count, last_access) in pending.items()}
+
+        try:
+            await self.__storage.record_clicks(clicks)
+
+        except Exception:
+            for internal_url, (count, last_access) in pending.items():
+                current = self.__pending.setdefault(internal_url, [0, last_access])
+                current[0] += count
+                current[1] = max(current[1], last_access)
+
+            raise
+
+
+    async def __run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.__full.wait(), self.flush_interval.total_seconds())
+
+            except TimeoutError:
+                pass
+
+            try:
+                await self.flush()
+
+            except Exception:
+                logger.exception('Failed to flush %d clicks', len(self.__pending))
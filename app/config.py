@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import timedelta
 from dacite import from_dict, Config as DaciteConfig
 from pytimeparse import parse
@@ -14,6 +14,21 @@ def _parse_expire_time(expire_time: str) -> timedelta:
     return timedelta(seconds = parse(expire_time))
 
 
+@dataclass
+class ReadPreferenceConfig:
+    """
+    Members of the replica set that serve the reads by operation class:
+    'primary', 'primaryPreferred', 'secondary', 'secondaryPreferred' or 'nearest'.
+
+    The secondaries lag behind the primary, so a redirect from a secondary may
+    miss a new URL or still follow a disabled one for the replication lag.
+    The writes always go to the primary
+    """
+
+    redirect: str = 'primary'
+    read: str = 'primary'
+
+
 @dataclass
 class DatabaseConfig:
     """
@@ -24,6 +39,267 @@ class DatabaseConfig:
     port: int
     name: str
 
+    min_pool_size: int = 0 # Connections that are kept open, even if they are idle
+    max_pool_size: int = 100
+    max_idle_time: timedelta | None = None # Idle connections are closed after it
+
+    server_selection_timeout: timedelta = timedelta(seconds = 30)
+    connect_timeout: timedelta = timedelta(seconds = 20)
+    socket_timeout: timedelta | None = None
+
+    compressors: list[str] = field(default_factory = list) # 'zstd', 'snappy', 'zlib' by preference
+    write_concern: int | str = 1 # The number of members or 'majority'
+    journal: bool = False
+
+    read_preference: ReadPreferenceConfig = field(default_factory = ReadPreferenceConfig)
+
+
+@dataclass
+class StorageConfig:
+    """
+    Settings to select the storage backend
+
+    'mongo' requires the 'database' section, 'memory' keeps everything
+    in the process memory and loses it on restart, 'log' keeps everything
+    in an append-only log inside the 'path' directory
+    """
+
+    backend: str = 'mongo'
+
+    path: str = 'data'
+    sync: bool = False # fsync the log after every write
+
+
+@dataclass
+class UrlConfig:
+    """
+    Settings to allocate short URLs
+    """
+
+    min_length: int = 6
+    block_size: int = 1000 # IDs reserved from the storage at once
+
+    batch_limit: int = 1000 # URLs in a single batch creation request
+    batch_body_limit: int = 4 * 1024 * 1024 # Bytes of the body of a batch creation request
+
+    # Shuffle the allocated URLs, so the next ones can not be guessed
+    secret_key: str | None = None
+
+    # Serve the redirects by a raw ASGI handler instead of the FastAPI route
+    fast_redirect: bool = False
+
+
+@dataclass
+class UrlFilterConfig:
+    """
+    Settings of the in-process cuckoo filter of every 'internal_url', that
+    answers the lookups of the missing URLs without the storage.
+
+    A worker only learns about the URLs created through it, so the misses are
+    answered by the filter only for the storages of a single process ('memory'
+    and 'log'). With MongoDB, the filter only rules out the collisions of the
+    allocated URLs with the legacy ones.
+
+    If 'snapshot' is set, the filter is saved there on shutdown and loaded
+    on start instead of reading every URL from the storage
+    """
+
+    enabled: bool = False
+    capacity: int = 1_000_000 # Expected number of URLs
+    false_positive_rate: float = 0.001
+    snapshot: str | None = None
+
+
+@dataclass
+class RedirectTableConfig:
+    """
+    Settings of the redirect table shared by the workers of the host.
+
+    It takes 'slots * (18 + key_size + value_size)' bytes, the URLs with
+    longer targets are not cached. The changes made by other hosts are seen after 'ttl'
+    """
+
+    enabled: bool = False
+    path: str = '/dev/shm/urlshortener-redirects'
+    slots: int = 1_000_000
+    key_size: int = 16
+    value_size: int = 100
+    window: int = 8 # Slots a URL can be placed in
+    ttl: timedelta = timedelta(minutes = 1)
+
+
+@dataclass
+class InvalidationConfig:
+    """
+    Settings to drop the changed URLs and users from the caches of every worker.
+
+    'local' reaches the caches of this worker only, 'udp' also sends the
+    batches to the multicast 'group' that every worker of every host joins
+    """
+
+    backend: str = 'local' # or 'udp'
+    batch_interval: timedelta = timedelta(milliseconds = 50)
+    max_batch: int = 1000
+
+    group: str = '239.255.77.77'
+    port: int = 50777
+    multicast_ttl: int = 1 # Routers the datagrams pass, 1 keeps them in the local network
+    interface: str = '0.0.0.0'
+
+
+@dataclass
+class RateLimitRuleConfig:
+    """
+    Token bucket that lets 'requests' requests through every 'period' on
+    average, and up to 'burst' of them at once ('requests' by default)
+    """
+
+    requests: int
+    period: timedelta = timedelta(seconds = 1)
+    burst: int | None = None
+
+
+@dataclass
+class RateLimitGroupConfig:
+    """
+    Token buckets of a route group per client IP and per authenticated user,
+    a missing bucket does not limit the group
+    """
+
+    ip: RateLimitRuleConfig | None = None
+    user: RateLimitRuleConfig | None = None
+
+
+@dataclass
+class RateLimitConfig:
+    """
+    Settings to limit the request rates of the clients by route group:
+    'auth' is 'POST /user/token' and 'POST /user/regist', 'write' and 'read'
+    are the other '/user', '/url' and '/jobs' routes, 'redirect' is the
+    redirects. The other routes ('/healthz', '/metrics', etc.) are not limited.
+
+    The buckets live in a table of 'slots * 17' bytes, the least recently
+    used ones are evicted approximately. With 'shared', the table is mapped
+    from 'path' by every worker of the host, so the limits hold for the host
+    instead of every worker. With 'forwarded', the client IP is taken from
+    the last 'X-Forwarded-For' address, which is set by the proxy in front
+    of the application
+    """
+
+    enabled: bool = False
+    slots: int = 1_000_000
+    window: int = 8 # Slots a bucket can be placed in
+
+    shared: bool = False
+    path: str = '/dev/shm/urlshortener-rate-limits'
+
+    forwarded: bool = False
+
+    auth: RateLimitGroupConfig = field(default_factory = lambda: RateLimitGroupConfig(
+        ip = RateLimitRuleConfig(requests = 20, period = timedelta(minutes = 1), burst = 10),
+    ))
+    write: RateLimitGroupConfig = field(default_factory = lambda: RateLimitGroupConfig(
+        ip = RateLimitRuleConfig(requests = 100, burst = 200),
+        user = RateLimitRuleConfig(requests = 20, burst = 100),
+    ))
+    read: RateLimitGroupConfig = field(default_factory = lambda: RateLimitGroupConfig(
+        ip = RateLimitRuleConfig(requests = 200, burst = 400),
+        user = RateLimitRuleConfig(requests = 100, burst = 200),
+    ))
+    redirect: RateLimitGroupConfig = field(default_factory = lambda: RateLimitGroupConfig(
+        ip = RateLimitRuleConfig(requests = 200, burst = 400),
+    ))
+
+
+@dataclass
+class ClicksConfig:
+    """
+    Settings to count redirect clicks
+    """
+
+    flush_interval: timedelta = timedelta(seconds = 5)
+    max_pending: int = 10000 # URLs with unflushed clicks that trigger an early flush
+
+
+@dataclass
+class JobsConfig:
+    """
+    Settings of the background jobs (deletion of the users with their URLs, etc.).
+
+    A job handles at most 'batch_size' documents every 'batch_pause'
+    """
+
+    batch_size: int = 1000
+    batch_pause: timedelta = timedelta(milliseconds = 100)
+    lease: timedelta = timedelta(seconds = 30) # The job of a crashed worker is resumed after it
+    poll_interval: timedelta = timedelta(seconds = 10)
+    max_running: int = 2 # Jobs resumed by a worker at once
+    retention: timedelta = timedelta(days = 7) # The finished jobs are removed after it
+
+
+@dataclass
+class CacheConfig:
+    """
+    Settings to cache verified access tokens and users of the authenticated requests
+    """
+
+    token_ttl: timedelta = timedelta(minutes = 5)
+    token_max_size: int = 10000
+
+    user_ttl: timedelta = timedelta(seconds = 5)
+    user_max_size: int = 10000
+
+
+@dataclass
+class PasswordConfig:
+    """
+    Settings to hash passwords.
+
+    Changing 'rounds' rehashes the passwords of the users on their next login
+    """
+
+    rounds: int = 12 # bcrypt cost
+    executor: str = 'thread' # or 'process'
+    workers: int = 4
+    max_queue: int = 64 # Hashing requests waiting for a worker before 503 is returned
+
+
+@dataclass
+class MetricsConfig:
+    """
+    Settings to record request and storage latency, served by '/metrics'
+    """
+
+    enabled: bool = True
+
+
+@dataclass
+class ProfilingConfig:
+    """
+    Settings to profile single requests on demand.
+
+    A request is profiled, if its 'X-Profile' header is equal to 'token',
+    and every 'sample_every' request, if it is not 0. The profiles are listed
+    by 'GET /debug/profiles' with the same header
+    """
+
+    enabled: bool = False
+    token: str | None = None
+    sample_every: int = 0
+
+    directory: str = 'profiles'
+    keep: int = 100 # The newest profiles that are kept in the directory
+    interval: timedelta = timedelta(milliseconds = 1) # Sampling interval
+
+
+@dataclass
+class StartupConfig:
+    """
+    Settings to warm up the worker before '/readyz' reports it as ready
+    """
+
+    warmup_connections: int = 4 # Pooled storage connections that are opened before the first request
+
 
 @dataclass
 class JWTConfig:
@@ -47,11 +323,98 @@ class Config:
       host: 'localhost'
       port: 27017
       name: 'urlshortener'
+      min_pool_size: 10
+      max_pool_size: 100
+      max_idle_time: '5m'
+      server_selection_timeout: '5s'
+      socket_timeout: '10s'
+      compressors: ['zstd', 'snappy', 'zlib']
+      write_concern: 'majority'
+      read_preference:
+        redirect: 'secondaryPreferred'
+        read: 'primary'
 
     jwt:
       secret_key: '21a573afbd1a20db203fc268836e64304edd260eeb5bebc44f7bf012861703d8'
       algorithm: 'HS256'
       access_token_expire_time: '2d'
+
+    storage:
+      backend: 'mongo' # or 'memory', 'log'
+      path: 'data'
+
+    url:
+      min_length: 6
+      block_size: 1000
+      batch_limit: 1000
+      batch_body_limit: 4194304
+      secret_key: 'use "openssl rand -hex 32" to get the random key'
+      fast_redirect: true
+
+    url_filter:
+      enabled: false
+      capacity: 1000000
+      false_positive_rate: 0.001
+      snapshot: 'data/url_filter.snapshot'
+
+    redirect_table:
+      enabled: false
+      path: '/dev/shm/urlshortener-redirects'
+      slots: 1000000
+      value_size: 100
+      ttl: '1m'
+
+    invalidation:
+      backend: 'local' # or 'udp'
+      batch_interval: '0.05s'
+      group: '239.255.77.77'
+      port: 50777
+
+    rate_limit:
+      enabled: true
+      shared: true
+      auth:
+        ip:
+          requests: 20
+          period: '1m'
+          burst: 10
+      write:
+        ip:
+          requests: 100
+        user:
+          requests: 20
+          burst: 100
+
+    clicks:
+      flush_interval: '5s'
+
+    jobs:
+      batch_size: 1000
+      batch_pause: '0.1s'
+      lease: '30s'
+      retention: '7d'
+
+    cache:
+      token_ttl: '5m'
+      user_ttl: '5s'
+
+    password:
+      rounds: 12
+      executor: 'thread' # or 'process'
+      workers: 4
+      max_queue: 64
+
+    metrics:
+      enabled: true
+
+    profiling:
+      enabled: false
+      token: 'use "openssl rand -hex 32" to get the random key'
+      sample_every: 0
+      directory: 'profiles'
+
+    startup:
+      warmup_connections: 4
     """
     
     __dacite_config = DaciteConfig(type_hooks = {
@@ -59,8 +422,21 @@ class Config:
     })
 
 
-    database: DatabaseConfig
     jwt: JWTConfig
+    database: DatabaseConfig | None = None
+    storage: StorageConfig = field(default_factory = StorageConfig)
+    url: UrlConfig = field(default_factory = UrlConfig)
+    url_filter: UrlFilterConfig = field(default_factory = UrlFilterConfig)
+    redirect_table: RedirectTableConfig = field(default_factory = RedirectTableConfig)
+    invalidation: InvalidationConfig = field(default_factory = InvalidationConfig)
+    rate_limit: RateLimitConfig = field(default_factory = RateLimitConfig)
+    clicks: ClicksConfig = field(default_factory = ClicksConfig)
+    jobs: JobsConfig = field(default_factory = JobsConfig)
+    cache: CacheConfig = field(default_factory = CacheConfig)
+    password: PasswordConfig = field(default_factory = PasswordConfig)
+    metrics: MetricsConfig = field(default_factory = MetricsConfig)
+    profiling: ProfilingConfig = field(default_factory = ProfilingConfig)
+    startup: StartupConfig = field(default_factory = StartupConfig)
 
 
     @staticmethod
@@ -1,11 +1,69 @@
 from abc import ABC, abstractmethod
-from .models import User, Url
+from datetime import datetime
+from typing import AsyncIterator
+from .models import User, Url, UrlTarget, Job
+from .exceptions import DatabaseError
+
+
+# Class of every storage operation, the classes are routed to the database
+# members and measured separately. The rest ('setup', 'close', etc.) are 'admin'
+OPERATION_CLASSES = {
+    'resolve': 'redirect',
+
+    'get_user': 'read',
+    'user_exists': 'read',
+    'get_url': 'read',
+    'get_reusable_url': 'read',
+    'list_urls': 'read',
+    'get_url_owner': 'read',
+    'get_original_url': 'read',
+    'url_exists': 'read',
+    'get_job': 'read',
+
+    'create_user': 'write',
+    'update_user_password': 'write',
+    'delete_user': 'write',
+    'mark_user_deleting': 'write',
+    'delete_user_urls': 'write',
+    'create_url': 'write',
+    'create_urls': 'write',
+    'create_reusable_url': 'write',
+    'enable_url': 'write',
+    'disable_url': 'write',
+    'delete_url': 'write',
+    'record_clicks': 'write',
+    'reserve_ids': 'write',
+    'save_job': 'write',
+    'claim_jobs': 'write',
+}
+
+
+def operation_class(operation: str) -> str:
+    return OPERATION_CLASSES.get(operation, 'admin')
+
 
 class BaseStorage(ABC):
     """
     Base storage for users and URLs
     """
     
+    async def setup(self):
+        """
+        Prepare the storage before serving requests (create indexes, etc.)
+        """
+
+        pass
+
+
+    async def warm_up(self, connections: int):
+        """
+        Open up to 'connections' pooled connections, so the first requests
+        do not wait for them
+        """
+
+        pass
+
+
     @abstractmethod
     async def create_user(self, user: User):
         """
@@ -28,6 +86,17 @@ class BaseStorage(ABC):
         pass
 
     
+    @abstractmethod
+    async def update_user_password(self, username: str, hashed_password: str):
+        """
+        Replace the hashed password of the user.
+
+        Raise UserNotExistError, if the user does not exist
+        """
+        
+        pass
+
+    
     @abstractmethod
     async def delete_user(self, username: str):
         """
@@ -39,6 +108,28 @@ class BaseStorage(ABC):
         pass
     
 
+    @abstractmethod
+    async def mark_user_deleting(self, username: str):
+        """
+        Set True to the 'deleting' field of the user
+
+        Raise UserNotExistError, if the user does not exist
+        """
+
+        pass
+
+
+    @abstractmethod
+    async def delete_user_urls(self, username: str, limit: int) -> list[str]:
+        """
+        Delete up to 'limit' URLs of the user and return their 'internal_url'.
+
+        Fewer than 'limit' URLs are returned only when the user has no URLs left
+        """
+
+        pass
+    
+
     @abstractmethod
     async def user_exists(self, username: str) -> bool:
         """
@@ -53,9 +144,10 @@ class BaseStorage(ABC):
                          *, 
                          owner_username: str, 
                          original_url: str, 
-                         internal_url: str):
+                         internal_url: str,
+                         expires_at: datetime | None = None):
         """
-        Create a URL by provided parameters.
+        Create a URL by provided parameters, it never expires, if 'expires_at' is None.
 
         Raise UserNotExistError, if the user does not exist and UrlExistsError,
         if the URL with provided 'internal_url' already exists
@@ -64,6 +156,48 @@ class BaseStorage(ABC):
         pass
 
 
+    @abstractmethod
+    async def create_urls(self, urls: list[Url]) -> list[DatabaseError | None]:
+        """
+        Create URLs in bulk.
+
+        Return the error of every URL in the same order: None, if the URL
+        was created, UserNotExistError, if its owner does not exist and
+        UrlExistsError, if its 'internal_url' already exists
+        """
+        
+        pass
+
+
+    @abstractmethod
+    async def create_reusable_url(self,
+                                  *,
+                                  owner_username: str,
+                                  original_url: str,
+                                  internal_url: str) -> Url:
+        """
+        Create the URL, that is found by 'get_reusable_url' later, and return it.
+
+        If the user already has a reusable URL with the same 'reuse_key' (created
+        by a concurrent request), that URL is returned instead, so only one is
+        created. Raise UserNotExistError, if the user does not exist
+        """
+
+        pass
+
+
+    @abstractmethod
+    async def get_reusable_url(self, owner_username: str, original_url: str) -> Url | None:
+        """
+        Return the URL of the user created by 'create_reusable_url' with the
+        same 'reuse_key' of 'original_url' or None.
+
+        The URL of another 'original_url' with the same key may be returned
+        """
+
+        pass
+
+
     @abstractmethod
     async def get_url(self, internal_url: str) -> Url | None:
         """
@@ -73,6 +207,47 @@ class BaseStorage(ABC):
         pass
 
 
+    @abstractmethod
+    async def list_urls(self,
+                        owner_username: str,
+                        *,
+                        after: str | None = None,
+                        limit: int = 100,
+                        active: bool | None = None) -> list[Url]:
+        """
+        Return up to 'limit' URLs of the user sorted by 'internal_url'.
+
+        Only the URLs that follow 'after' are returned, so the last 'internal_url'
+        of a page is the cursor of the next one. If 'active' is provided, only
+        active or inactive URLs are returned
+        """
+        
+        pass
+
+
+    @abstractmethod
+    def iter_urls(self, owner_username: str, batch_size: int = 1000) -> AsyncIterator[list[Url]]:
+        """
+        Return an iterator over every URL of the user sorted by 'internal_url'
+        in batches of up to 'batch_size', only a batch is held in memory.
+
+        The URLs created or deleted during the iteration may be missed
+        """
+
+        pass
+
+
+    @abstractmethod
+    def iter_internal_urls(self, batch_size: int = 10000) -> AsyncIterator[list[str]]:
+        """
+        Return an iterator over 'internal_url' of every URL in batches of up to 'batch_size'.
+
+        The URLs created or deleted during the iteration may be missed
+        """
+
+        pass
+
+
     @abstractmethod
     async def get_url_owner(self, internal_url: str) -> str:
         """
@@ -95,6 +270,18 @@ class BaseStorage(ABC):
         pass
     
     
+    @abstractmethod
+    async def resolve(self, internal_url: str) -> UrlTarget | None:
+        """
+        Return the redirect target, the 'active' flag and the expiration of the URL in one lookup.
+
+        If the URL was not found, None is returned. The expired URLs may be
+        returned until the storage purges them
+        """
+        
+        pass
+    
+    
     @abstractmethod
     async def enable_url(self, internal_url: str):
         """
@@ -137,6 +324,67 @@ class BaseStorage(ABC):
         pass
 
 
+    @abstractmethod
+    async def record_clicks(self, clicks: dict[str, tuple[int, datetime]]):
+        """
+        Add the click counts to the URLs and move their 'last_access' forward.
+
+        'clicks' maps 'internal_url' to the number of clicks and the time of
+        the last one. Unknown URLs are skipped
+        """
+        
+        pass
+
+
+    @abstractmethod
+    async def reserve_ids(self, count: int) -> int:
+        """
+        Atomically reserve 'count' sequential IDs for new URLs and return the first one.
+
+        The reserved IDs are never returned again, even after a restart
+        """
+        
+        pass
+
+
+    @abstractmethod
+    async def save_job(self, job: Job, *, runner: str | None = None) -> bool:
+        """
+        Create or replace the job by 'job_id'.
+
+        With 'runner', the job is replaced only if the stored job is still
+        held by the runner, so a runner that lost its lease never overwrites
+        the next one. Return False, if the job was not saved
+        """
+
+        pass
+
+
+    @abstractmethod
+    async def get_job(self, job_id: str) -> Job | None:
+        """
+        Return the job by 'job_id' or None, if the job does not exist
+        """
+
+        pass
+
+
+    @abstractmethod
+    async def claim_jobs(self,
+                         runner: str,
+                         lease_until: datetime,
+                         limit: int,
+                         *,
+                         exclude: tuple[str, ...] = ()) -> list[Job]:
+        """
+        Atomically hand up to 'limit' unfinished jobs, whose lease is missing or
+        expired, to the runner until 'lease_until' and return them.
+        The jobs with the 'job_id' from 'exclude' are never claimed
+        """
+
+        pass
+
+
     @abstractmethod
     async def close():
         """
@@ -0,0 +1,964 @@
+import fcntl
+import json
+import logging
+import os
+
+from asyncio import Lock, Task, create_task, to_thread
+from contextlib import asynccontextmanager
+from dataclasses import replace
+from datetime import datetime, timedelta, timezone
+from time import time
+from mmap import mmap, ACCESS_READ
+from struct import Struct
+from typing import AsyncIterator
+from zlib import crc32
+from dacite import Config as DaciteConfig
+
+from .base_storage import BaseStorage
+from .models import User, Url, UrlTarget, Job, FINISHED_JOB_STATES, UNFINISHED_JOB_STATES, reuse_key, utc_timestamp
+from .owner_index import OwnerIndex
+
+from .exceptions import DatabaseError, UserExistsError, UrlExistsError, UserNotExistError, UrlNotExistError
+
+
+logger = logging.getLogger(__name__)
+
+
+_FILE_HEADER = b'URLLOG01'
+
+# crc32 of the operation and the payload, payload length, operation
+_RECORD_HEADER = Struct('<IIB')
+
+# Username length, hashed password length
+_USER_HEADER = Struct('<HH')
+
+# Flags, 'internal_url' length, owner length, 'original_url' length
+_URL_HEADER = Struct('<BHHI')
+
+# Flags of the URL record, the expiration timestamp follows 'original_url'
+# only if it is set, so the records of the older logs are read as they are
+_URL_ACTIVE = 1
+_URL_EXPIRES = 2
+_URL_REUSABLE = 4
+_URL_EXPIRES_AT = Struct('<d')
+
+# The end of the reserved IDs
+_RESERVED_IDS = Struct('<Q')
+
+# Clicks, timestamp of the last access, 'internal_url' length
+_CLICKS_ENTRY = Struct('<QdH')
+
+_OP_PUT_USER = 1
+_OP_DELETE_USER = 2
+_OP_PUT_URL = 3
+_OP_DELETE_URL = 4
+_OP_RESERVE_IDS = 5
+_OP_CLICKS = 6
+_OP_USER_DELETING = 7
+_OP_PUT_JOB = 8
+
+# The jobs are kept as JSON, the datetimes in the ISO format
+_JOB_DACITE_CONFIG = DaciteConfig(type_hooks = {datetime: datetime.fromisoformat})
+
+
+def _encode_record(op: int, payload: bytes) -> bytes:
+    checksum = crc32(payload, crc32(bytes((op,))))
+    return _RECORD_HEADER.pack(checksum, len(payload), op) + payload
+
+
+def _encode_user(username: str, hashed_password: str) -> bytes:
+    username_bytes = username.encode()
+    password_bytes = hashed_password.encode()
+
+    return (_USER_HEADER.pack(len(username_bytes), len(password_bytes))
+            + username_bytes + password_bytes)
+
+
+def _encode_url(original_url: str,
+                internal_url: str,
+                owner: str,
+                active: bool,
+                expires_at: datetime | None = None,
+                reusable: bool = False) -> bytes:
+
+    internal_bytes = internal_url.encode()
+    owner_bytes = owner.encode()
+    original_bytes = original_url.encode()
+
+    flags = (_URL_ACTIVE if active else 0) | (_URL_REUSABLE if reusable else 0)
+    expiration = b''
+    if expires_at is not None:
+        flags |= _URL_EXPIRES
+        expiration = _URL_EXPIRES_AT.pack(utc_timestamp(expires_at))
+
+    header = _URL_HEADER.pack(flags, len(internal_bytes), len(owner_bytes), len(original_bytes))
+    return header + internal_bytes + owner_bytes + original_bytes + expiration
+
+
+def _decode_expires_at(payload: memoryview, flags: int, end: int) -> datetime | None:
+    """
+    Return the expiration of the URL record, whose 'original_url' ends at 'end'
+    """
+
+    if not flags & _URL_EXPIRES:
+        return None
+
+    expires_at, = _URL_EXPIRES_AT.unpack_from(payload, end)
+    return datetime.fromtimestamp(expires_at, timezone.utc)
+
+
+def _encode_job(job: Job) -> bytes:
+    return json.dumps(job.to_dict(), default = datetime.isoformat).encode()
+
+
+def _decode_job(payload: memoryview) -> Job:
+    return Job.from_dict(json.loads(bytes(payload)), _JOB_DACITE_CONFIG)
+
+
+def _encode_clicks(clicks: dict[str, tuple[int, float]]) -> bytes:
+    entries = []
+
+    for internal_url, (count, last_access) in clicks.items():
+        internal_bytes = internal_url.encode()
+        entries.append(_CLICKS_ENTRY.pack(count, last_access, len(internal_bytes)) + internal_bytes)
+
+    return b''.join(entries)
+
+
+class LogStorage(BaseStorage):
+    """
+    Embedded storage that keeps users and URLs in an append-only log on the local disk.
+
+    Every change appends a checksummed record, and in-memory hash indexes map
+    usernames and 'internal_url' to the offset of their latest record. Reads are
+    served from a memory map of the log, so a lookup is one dict probe plus
+    a slice of the mapped file.
+
+    On start the indexes are rebuilt by scanning the log, and a torn record at
+    the tail (left by a crash in the middle of a write) is truncated. Once the
+    superseded records take more than 'compact_ratio' of the file, the live
+    records are copied into a new log in a background thread.
+
+    Clicks are appended as separate records and their totals are kept in
+    memory, so counting never rewrites URL records.
+
+    The indexes live in the process, so the log belongs to a single process:
+    it is locked on open, and a second process fails to open it
+    """
+
+    def __init__(self,
+                 path: str,
+                 *,
+                 sync: bool = False,
+                 compact_ratio: float = 0.5,
+                 compact_min_bytes: int = 64 * 1024 * 1024,
+                 job_retention: timedelta = timedelta(days = 7)):
+
+        self.sync = sync
+        self.compact_ratio = compact_ratio
+        self.compact_min_bytes = compact_min_bytes
+        self.job_retention = job_retention
+
+        os.makedirs(path, exist_ok = True)
+        self.__log_path = os.path.join(path, 'urls.log')
+
+        # The compaction replaces the log, so the lock is taken on a separate file
+        self.__lock_path = os.path.join(path, 'urls.lock')
+
+        self.__lock = Lock()
+        self.__compaction: Task | None = None
+
+        self.__users: dict[str, int] = {}
+        self.__urls: dict[str, int] = {}
+
+        self.__urls_by_owner = OwnerIndex()
+
+        # (owner, 'reuse_key') -> 'internal_url' of the reusable URL
+        self.__reusable_urls: dict[tuple[str, int], str] = {}
+
+        # 'internal_url' -> the number of clicks and the timestamp of the last one
+        self.__clicks: dict[str, tuple[int, float]] = {}
+
+        self.__deleting_users: set[str] = set()
+
+        # The jobs are few, so they are kept in memory by 'job_id'
+        self.__jobs: dict[str, Job] = {}
+
+        self.__live_bytes = 0
+        self.__next_id = 0
+
+        self.__map: mmap | None = None
+        self.__view: memoryview | None = None
+        self.__mapped_size = 0
+
+        self.__open_log()
+
+
+    async def create_user(self, user: User):
+        async with self.__writing():
+            if user.username in self.__users:
+                raise UserExistsError(f'User {user.username} already exists')
+
+            offset = self.__append(_OP_PUT_USER, _encode_user(user.username, user.hashed_password))
+
+            self.__users[user.username] = offset
+            self.__urls_by_owner.add_owner(user.username)
+
+        self.__maybe_compact()
+
+
+    async def get_user(self, username: str) -> User | None:
+        offset = self.__users.get(username)
+        if offset is None:
+            return None
+
+        payload = self.__payload(offset)
+        username_length, password_length = _USER_HEADER.unpack_from(payload)
+
+        start = _USER_HEADER.size + username_length
+        hashed_password = str(payload[start:start + password_length], 'utf-8')
+
+        return User(username = username,
+                    hashed_password = hashed_password,
+                    deleting = username in self.__deleting_users)
+
+
+    async def update_user_password(self, username: str, hashed_password: str):
+        async with self.__writing():
+            offset = self.__users.get(username)
+            if offset is None:
+                raise UserNotExistError(f'User {username} does not exist')
+
+            self.__users[username] = self.__append(_OP_PUT_USER, _encode_user(username, hashed_password))
+            self.__live_bytes -= self.__record_size(offset)
+
+        self.__maybe_compact()
+
+
+    async def delete_user(self, username: str):
+        async with self.__writing():
+            if username not in self.__users:
+                raise UserNotExistError(f'User {username} does not exist')
+
+            # The URLs of the user are dropped by the same record during replay
+            self.__append(_OP_DELETE_USER, username.encode())
+            self.__drop_user(username)
+
+        self.__maybe_compact()
+
+
+    async def mark_user_deleting(self, username: str):
+        async with self.__writing():
+            if username not in self.__users:
+                raise UserNotExistError(f'User {username} does not exist')
+
+            self.__append(_OP_USER_DELETING, username.encode())
+            self.__deleting_users.add(username)
+
+
+    async def delete_user_urls(self, username: str, limit: int) -> list[str]:
+        async with self.__writing():
+            internal_urls = self.__urls_by_owner.page(username, None, limit)
+            self.__append_many([(_OP_DELETE_URL, internal_url.encode()) for internal_url in internal_urls])
+
+            for internal_url in internal_urls:
+                self.__clicks.pop(internal_url, None)
+                self.__urls_by_owner.remove(username, internal_url)
+                self.__forget_reusable(self.__urls[internal_url])
+                self.__live_bytes -= self.__record_size(self.__urls.pop(internal_url))
+
+        self.__maybe_compact()
+        return internal_urls
+
+
+    async def user_exists(self, username: str) -> bool:
+        return username in self.__users
+
+
+    async def create_url(self,
+                         *,
+                         owner_username: str,
+                         original_url: str,
+                         internal_url: str,
+                         expires_at: datetime | None = None):
+
+        async with self.__writing():
+            if owner_username not in self.__users:
+                raise UserNotExistError(f'User {owner_username} does not exist')
+
+            if internal_url in self.__urls:
+                raise UrlExistsError(f'URL "{internal_url}" already exists')
+
+            payload = _encode_url(original_url, internal_url, owner_username, True, expires_at)
+            self.__urls[internal_url] = self.__append(_OP_PUT_URL, payload)
+            self.__urls_by_owner.add(owner_username, internal_url)
+
+
+    async def create_urls(self, urls: list[Url]) -> list[DatabaseError | None]:
+        errors: list[DatabaseError | None] = []
+        created: dict[str, Url] = {}
+        records = []
+
+        async with self.__writing():
+            for url in urls:
+                if url.owner not in self.__users:
+                    errors.append(UserNotExistError(f'User {url.owner} does not exist'))
+
+                elif url.internal_url in self.__urls or url.internal_url in created:
+                    errors.append(UrlExistsError(f'URL "{url.internal_url}" already exists'))
+
+                else:
+                    created[url.internal_url] = url
+                    records.append((_OP_PUT_URL, _encode_url(url.original_url,
+                                                             url.internal_url,
+                                                             url.owner,
+                                                             url.active,
+                                                             url.expires_at)))
+                    errors.append(None)
+
+            # The whole batch is written at once
+            offsets = self.__append_many(records)
+
+            for url, offset in zip(created.values(), offsets):
+                self.__urls[url.internal_url] = offset
+                self.__urls_by_owner.add(url.owner, url.internal_url)
+
+        return errors
+
+
+    async def create_reusable_url(self,
+                                  *,
+                                  owner_username: str,
+                                  original_url: str,
+                                  internal_url: str) -> Url:
+
+        key = (owner_username, reuse_key(original_url))
+
+        async with self.__writing():
+            if owner_username not in self.__users:
+                raise UserNotExistError(f'User {owner_username} does not exist')
+
+            existing_url = self.__reusable_urls.get(key)
+            if existing_url:
+                return self.__read_url(self.__urls[existing_url])
+
+            if internal_url in self.__urls:
+                raise UrlExistsError(f'URL "{internal_url}" already exists')
+
+            payload = _encode_url(original_url, internal_url, owner_username, True, reusable = True)
+            self.__urls[internal_url] = self.__append(_OP_PUT_URL, payload)
+            self.__urls_by_owner.add(owner_username, internal_url)
+            self.__reusable_urls[key] = internal_url
+
+            url = self.__read_url(self.__urls[internal_url])
+
+        self.__maybe_compact()
+        return url
+
+
+    async def get_reusable_url(self, owner_username: str, original_url: str) -> Url | None:
+        internal_url = self.__reusable_urls.get((owner_username, reuse_key(original_url)))
+        if not internal_url:
+            return None
+
+        return self.__read_url(self.__urls[internal_url])
+
+
+    async def get_url(self, internal_url: str) -> Url | None:
+        offset = self.__urls.get(internal_url)
+        if offset is None:
+            return None
+
+        return self.__read_url(offset)
+
+
+    async def list_urls(self,
+                        owner_username: str,
+                        *,
+                        after: str | None = None,
+                        limit: int = 100,
+                        active: bool | None = None) -> list[Url]:
+
+        predicate = None
+        if active is not None:
+            # The flags are the first byte of the URL record
+            predicate = lambda internal_url: bool(self.__payload(self.__urls[internal_url])[0] & _URL_ACTIVE) == active
+
+        page = self.__urls_by_owner.page(owner_username, after, limit, predicate)
+        return [self.__read_url(self.__urls[internal_url]) for internal_url in page]
+
+
+    async def iter_urls(self, owner_username: str, batch_size: int = 1000) -> AsyncIterator[list[Url]]:
+        after = None
+
+        while True:
+            # The page is read without awaits, so it never holds a deleted URL
+            page = self.__urls_by_owner.page(owner_username, after, batch_size)
+            batch = [self.__read_url(self.__urls[internal_url]) for internal_url in page]
+            if batch:
+                yield batch
+
+            if len(page) < batch_size:
+                break
+
+            after = page[-1]
+
+
+    async def iter_internal_urls(self, batch_size: int = 10000) -> AsyncIterator[list[str]]:
+        internal_urls = list(self.__urls)
+
+        for start in range(0, len(internal_urls), batch_size):
+            yield internal_urls[start:start + batch_size]
+
+
+    async def get_url_owner(self, internal_url: str) -> str:
+        return self.__read_url(self.__get_url_offset(internal_url)).owner
+
+
+    async def get_original_url(self, internal_url: str) -> str:
+        return self.__read_url(self.__get_url_offset(internal_url)).original_url
+
+
+    async def resolve(self, internal_url: str) -> UrlTarget | None:
+        offset = self.__urls.get(internal_url)
+        if offset is None:
+            return None
+
+        payload = self.__payload(offset)
+        flags, internal_length, owner_length, original_length = _URL_HEADER.unpack_from(payload)
+
+        start = _URL_HEADER.size + internal_length + owner_length
+        end = start + original_length
+
+        return UrlTarget(original_url = str(payload[start:end], 'utf-8'),
+                         active = bool(flags & _URL_ACTIVE),
+                         expires_at = _decode_expires_at(payload, flags, end))
+
+
+    async def enable_url(self, internal_url: str):
+        await self.__set_url_active(internal_url, True)
+
+
+    async def disable_url(self, internal_url: str):
+        await self.__set_url_active(internal_url, False)
+
+
+    async def delete_url(self, internal_url: str):
+        async with self.__writing():
+            offset = self.__get_url_offset(internal_url)
+            url = self.__read_url(offset)
+
+            self.__append(_OP_DELETE_URL, internal_url.encode())
+
+            del self.__urls[internal_url]
+            self.__clicks.pop(internal_url, None)
+            self.__urls_by_owner.remove(url.owner, internal_url)
+            self.__forget_reusable(offset)
+            self.__live_bytes -= self.__record_size(offset)
+
+        self.__maybe_compact()
+
+
+    async def url_exists(self, internal_url: str) -> bool:
+        return internal_url in self.__urls
+
+
+    async def record_clicks(self, clicks: dict[str, tuple[int, datetime]]):
+        known_clicks = {internal_url: (count, last_access.timestamp())
+                        for internal_url, (count, last_access) in clicks.items()
+                        if internal_url in self.__urls}
+
+        if not known_clicks:
+            return
+
+        async with self.__writing():
+            self.__append(_OP_CLICKS, _encode_clicks(known_clicks))
+            self.__add_clicks(known_clicks)
+
+        self.__maybe_compact()
+
+
+    async def reserve_ids(self, count: int) -> int:
+        async with self.__writing():
+            first_id = self.__next_id
+
+            self.__append(_OP_RESERVE_IDS, _RESERVED_IDS.pack(first_id + count))
+            self.__next_id += count
+
+        self.__maybe_compact()
+        return first_id
+
+
+    async def save_job(self, job: Job, *, runner: str | None = None) -> bool:
+        async with self.__writing():
+            if runner is not None:
+                stored = self.__jobs.get(job.job_id)
+                if not stored or stored.runner != runner:
+                    return False
+
+            self.__append(_OP_PUT_JOB, _encode_job(job))
+            self.__jobs[job.job_id] = replace(job)
+
+        self.__maybe_compact()
+        return True
+
+
+    async def get_job(self, job_id: str) -> Job | None:
+        job = self.__jobs.get(job_id)
+        return replace(job) if job else None
+
+
+    async def claim_jobs(self,
+                         runner: str,
+                         lease_until: datetime,
+                         limit: int,
+                         *,
+                         exclude: tuple[str, ...] = ()) -> list[Job]:
+        now = time()
+        claimed = []
+
+        async with self.__writing():
+            for job in self.__jobs.values():
+                if len(claimed) == limit:
+                    break
+
+                if job.job_id in exclude:
+                    continue
+
+                if job.state in UNFINISHED_JOB_STATES and (not job.lease_until or utc_timestamp(job.lease_until) < now):
+                    job.runner = runner
+                    job.lease_until = lease_until
+
+                    self.__append(_OP_PUT_JOB, _encode_job(job))
+                    claimed.append(replace(job))
+
+        self.__maybe_compact()
+        return claimed
+
+
+    async def close(self):
+        if self.__compaction:
+            await self.__compaction
+
+        self.__unmap()
+        self.__file.close()
+        self.__lock_file.close()
+
+
+    async def __set_url_active(self, internal_url: str, active: bool):
+        async with self.__writing():
+            offset = self.__get_url_offset(internal_url)
+            url = self.__read_url(offset)
+
+            reusable = bool(self.__payload(offset)[0] & _URL_REUSABLE)
+            payload = _encode_url(url.original_url, internal_url, url.owner, active, url.expires_at, reusable)
+            self.__urls[internal_url] = self.__append(_OP_PUT_URL, payload)
+            self.__live_bytes -= self.__record_size(offset)
+
+        self.__maybe_compact()
+
+
+    @asynccontextmanager
+    async def __writing(self):
+        """
+        Hold the writer lock. With 'sync', the records appended under it are
+        synced before it is released, once the indexes are updated
+        """
+
+        async with self.__lock:
+            file_size = self.__file_size
+            yield
+
+            if self.sync and self.__file_size != file_size:
+                # The other writers wait for the disk, the event loop does not
+                await to_thread(os.fsync, self.__file.fileno())
+
+
+    def __get_url_offset(self, internal_url: str) -> int:
+        offset = self.__urls.get(internal_url)
+        if offset is None:
+            raise UrlNotExistError(f'URL "{internal_url}" does not exist')
+
+        return offset
+
+
+    def __read_url(self, offset: int) -> Url:
+        payload = self.__payload(offset)
+        flags, internal_length, owner_length, original_length = _URL_HEADER.unpack_from(payload)
+
+        internal_end = _URL_HEADER.size + internal_length
+        owner_end = internal_end + owner_length
+        original_end = owner_end + original_length
+
+        internal_url = str(payload[_URL_HEADER.size:internal_end], 'utf-8')
+        clicks, last_access = self.__clicks.get(internal_url, (0, None))
+
+        return Url(internal_url = internal_url,
+                   owner = str(payload[internal_end:owner_end], 'utf-8'),
+                   original_url = str(payload[owner_end:original_end], 'utf-8'),
+                   active = bool(flags & _URL_ACTIVE),
+                   clicks = clicks,
+                   last_access = datetime.fromtimestamp(last_access, timezone.utc) if last_access else None,
+                   expires_at = _decode_expires_at(payload, flags, original_end))
+
+
+    def __forget_reusable(self, offset: int):
+        """
+        Drop the URL record at 'offset' from the reusable URLs, if it is one of them
+        """
+
+        if not self.__reusable_urls or not self.__payload(offset)[0] & _URL_REUSABLE:
+            return
+
+        url = self.__read_url(offset)
+        key = (url.owner, reuse_key(url.original_url))
+
+        if self.__reusable_urls.get(key) == url.internal_url:
+            del self.__reusable_urls[key]
+
+
+    def __add_clicks(self, clicks: dict[str, tuple[int, float]]):
+        for internal_url, (count, last_access) in clicks.items():
+            if internal_url not in self.__urls:
+                continue
+
+            total, previous_access = self.__clicks.get(internal_url, (0, 0.0))
+            self.__clicks[internal_url] = (total + count, max(previous_access, last_access))
+
+
+    def __drop_user(self, username: str):
+        self.__live_bytes -= self.__record_size(self.__users.pop(username))
+        self.__deleting_users.discard(username)
+
+        for internal_url in self.__urls_by_owner.drop_owner(username):
+            self.__clicks.pop(internal_url, None)
+            self.__forget_reusable(self.__urls[internal_url])
+            self.__live_bytes -= self.__record_size(self.__urls.pop(internal_url))
+
+
+    def __payload(self, offset: int) -> memoryview:
+        """
+        Return the payload of the record at 'offset' without copying it
+        """
+
+        if offset >= self.__mapped_size:
+            self.__remap()
+
+        _, length, _ = _RECORD_HEADER.unpack_from(self.__view, offset)
+        start = offset + _RECORD_HEADER.size
+
+        return self.__view[start:start + length]
+
+
+    def __record_size(self, offset: int) -> int:
+        if offset >= self.__mapped_size:
+            self.__remap()
+
+        _, length, _ = _RECORD_HEADER.unpack_from(self.__view, offset)
+        return _RECORD_HEADER.size + length
+
+
+    def __append(self, op: int, payload: bytes) -> int:
+        """
+        Append the record to the log and return its offset
+        """
+
+        return self.__append_many([(op, payload)])[0]
+
+
+    def __append_many(self, records: list[tuple[int, bytes]]) -> list[int]:
+        """
+        Append the records to the log with a single write and return their offsets
+        """
+
+        offsets = []
+        encoded_records = []
+
+        offset = self.__file_size
+        for op, payload in records:
+            record = _encode_record(op, payload)
+
+            offsets.append(offset)
+            encoded_records.append(record)
+
+            offset += len(record)
+            if op in (_OP_PUT_USER, _OP_PUT_URL):
+                self.__live_bytes += len(record)
+
+        self.__file.write(b''.join(encoded_records))
+        self.__file.flush()
+
+        self.__file_size = offset
+        return offsets
+
+
+    def __remap(self):
+        """
+        Map the whole log file, so the records appended since the last map are readable.
+
+        Appends are whole records, so a record that starts before the mapped size
+        is always mapped entirely
+        """
+
+        self.__unmap()
+
+        self.__map = mmap(self.__file.fileno(), 0, access = ACCESS_READ)
+        self.__view = memoryview(self.__map)
+        self.__mapped_size = self.__file_size
+
+
+    def __unmap(self):
+        if self.__view is not None:
+            self.__view.release()
+            self.__map.close()
+
+        self.__map = None
+        self.__view = None
+        self.__mapped_size = 0
+
+
+    def __open_log(self):
+        # The indexes of another process would not see the records appended by
+        # this one, and both would append at their own end of the file
+        self.__lock_file = open(self.__lock_path, 'wb')
+        try:
+            fcntl.flock(self.__lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        except BlockingIOError:
+            self.__lock_file.close()
+            raise DatabaseError(f'{self.__log_path} is used by another process, '
+                                'the log storage can not be shared by several workers')
+
+        if not os.path.exists(self.__log_path):
+            with open(self.__log_path, 'wb') as log_file:
+                log_file.write(_FILE_HEADER)
+                log_file.flush()
+                os.fsync(log_file.fileno())
+
+        self.__file = open(self.__log_path, 'r+b')
+        self.__file_size = self.__file.seek(0, os.SEEK_END)
+
+        self.__remap()
+        if bytes(self.__view[:len(_FILE_HEADER)]) != _FILE_HEADER:
+            raise DatabaseError(f'{self.__log_path} is not a URL log')
+
+        valid_size = self.__replay()
+        if valid_size < self.__file_size:
+            logger.warning('Truncating the torn tail of %s at offset %d (%d bytes)',
+                           self.__log_path, valid_size, self.__file_size - valid_size)
+
+            self.__unmap()
+            self.__file.truncate(valid_size)
+            self.__file_size = self.__file.seek(valid_size)
+            self.__remap()
+
+
+    def __replay(self) -> int:
+        """
+        Rebuild the indexes from the log and return the size of its valid part
+        """
+
+        view = self.__view
+        offset = len(_FILE_HEADER)
+
+        while offset + _RECORD_HEADER.size <= self.__file_size:
+            checksum, length, op = _RECORD_HEADER.unpack_from(view, offset)
+            start = offset + _RECORD_HEADER.size
+            end = start + length
+
+            if end > self.__file_size:
+                break
+
+            payload = view[start:end]
+            if crc32(payload, crc32(bytes((op,)))) != checksum:
+                break
+
+            self.__apply(op, offset, payload, end - offset)
+            offset = end
+
+        return offset
+
+
+    def __apply(self, op: int, offset: int, payload: memoryview, size: int):
+        """
+        Apply the replayed record to the indexes
+        """
+
+        if op == _OP_PUT_USER:
+            username_length, _ = _USER_HEADER.unpack_from(payload)
+            username = str(payload[_USER_HEADER.size:_USER_HEADER.size + username_length], 'utf-8')
+
+            self.__users[username] = offset
+            self.__urls_by_owner.add_owner(username)
+            self.__live_bytes += size
+
+        elif op == _OP_DELETE_USER:
+            self.__drop_user(str(payload, 'utf-8'))
+
+        elif op == _OP_PUT_URL:
+            flags, internal_length, owner_length, original_length = _URL_HEADER.unpack_from(payload)
+            internal_end = _URL_HEADER.size + internal_length
+            owner_end = internal_end + owner_length
+
+            internal_url = str(payload[_URL_HEADER.size:internal_end], 'utf-8')
+            owner = str(payload[internal_end:owner_end], 'utf-8')
+
+            if flags & _URL_REUSABLE:
+                original_url = str(payload[owner_end:owner_end + original_length], 'utf-8')
+                self.__reusable_urls[(owner, reuse_key(original_url))] = internal_url
+
+            previous = self.__urls.get(internal_url)
+            if previous is not None:
+                self.__live_bytes -= self.__record_size(previous)
+
+            if previous is None:
+                self.__urls_by_owner.add(owner, internal_url)
+
+            self.__urls[internal_url] = offset
+            self.__live_bytes += size
+
+        elif op == _OP_DELETE_URL:
+            internal_url = str(payload, 'utf-8')
+            previous = self.__urls.pop(internal_url)
+
+            self.__clicks.pop(internal_url, None)
+            self.__urls_by_owner.remove(self.__read_url(previous).owner, internal_url)
+            self.__forget_reusable(previous)
+            self.__live_bytes -= self.__record_size(previous)
+
+        elif op == _OP_RESERVE_IDS:
+            self.__next_id, = _RESERVED_IDS.unpack(payload)
+
+        elif op == _OP_CLICKS:
+            clicks = {}
+            position = 0
+
+            while position < len(payload):
+                count, last_access, internal_length = _CLICKS_ENTRY.unpack_from(payload, position)
+                position += _CLICKS_ENTRY.size
+
+                clicks[str(payload[position:position + internal_length], 'utf-8')] = (count, last_access)
+                position += internal_length
+
+            self.__add_clicks(clicks)
+
+        elif op == _OP_USER_DELETING:
+            self.__deleting_users.add(str(payload, 'utf-8'))
+
+        elif op == _OP_PUT_JOB:
+            job = _decode_job(payload)
+            self.__jobs[job.job_id] = job
+
+        else:
+            raise DatabaseError(f'Unknown operation {op} at offset {offset} of {self.__log_path}')
+
+
+    def __maybe_compact(self):
+        """
+        Start the compaction in background, if the log has too many superseded records
+        """
+
+        if self.__compaction and not self.__compaction.done():
+            return
+
+        garbage = self.__file_size - len(_FILE_HEADER) - self.__live_bytes
+        if garbage < self.compact_min_bytes or garbage < self.__file_size * self.compact_ratio:
+            return
+
+        self.__compaction = create_task(self.__compact())
+
+
+    def __prune_jobs(self):
+        """
+        Forget the jobs, that finished longer than 'job_retention' ago, so the compaction drops their records
+        """
+
+        oldest = time() - self.job_retention.total_seconds()
+
+        for job_id, job in list(self.__jobs.items()):
+            if job.state in FINISHED_JOB_STATES and utc_timestamp(job.updated_at) < oldest:
+                del self.__jobs[job_id]
+
+
+    async def __compact(self):
+        """
+        Copy the live records into a new log and swap it with the current one.
+
+        Writers wait for the compaction, while readers keep using the old map
+        """
+
+        async with self.__lock:
+            # Nothing is appended until the swap, so the readers never remap the
+            # log while the thread copies records out of the current map
+            self.__remap()
+
+            user_offsets = list(self.__users.items())
+            url_offsets = list(self.__urls.items())
+
+            # The state that is not kept in the indexed records is folded
+            # into the records at the end of the new log
+            trailer = _encode_record(_OP_RESERVE_IDS, _RESERVED_IDS.pack(self.__next_id))
+            if self.__clicks:
+                trailer += _encode_record(_OP_CLICKS, _encode_clicks(self.__clicks))
+
+            for username in self.__deleting_users:
+                trailer += _encode_record(_OP_USER_DELETING, username.encode())
+
+            self.__prune_jobs()
+            for job in self.__jobs.values():
+                trailer += _encode_record(_OP_PUT_JOB, _encode_job(job))
+
+            compacted_path = self.__log_path + '.compact'
+            new_users, new_urls, size = await to_thread(self.__write_compacted,
+                                                        compacted_path,
+                                                        user_offsets,
+                                                        url_offsets,
+                                                        trailer)
+
+            os.replace(compacted_path, self.__log_path)
+
+            self.__unmap()
+            self.__file.close()
+
+            self.__file = open(self.__log_path, 'r+b')
+            self.__file_size = self.__file.seek(0, os.SEEK_END)
+            self.__remap()
+
+            self.__users = new_users
+            self.__urls = new_urls
+            self.__live_bytes = size - len(_FILE_HEADER) - len(trailer)
+
+            logger.info('Compacted %s to %d bytes', self.__log_path, size)
+
+
+    def __write_compacted(self,
+                          compacted_path: str,
+                          user_offsets: list[tuple[str, int]],
+                          url_offsets: list[tuple[str, int]],
+                          trailer: bytes) -> tuple[dict[str, int], dict[str, int], int]:
+        """
+        Write the live records into 'compacted_path' and return their new offsets and the file size
+        """
+
+        new_users = {}
+        new_urls = {}
+
+        with open(compacted_path, 'wb') as compacted_file:
+            compacted_file.write(_FILE_HEADER)
+            offset = len(_FILE_HEADER)
+
+            for index, offsets in ((new_users, user_offsets), (new_urls, url_offsets)):
+                for key, old_offset in offsets:
+                    size = self.__record_size(old_offset)
+                    compacted_file.write(self.__view[old_offset:old_offset + size])
+
+                    index[key] = offset
+                    offset += size
+
+            compacted_file.write(trailer)
+            offset += len(trailer)
+
+            compacted_file.flush()
+            os.fsync(compacted_file.fileno())
+
+        return new_users, new_urls, offset
@@ -0,0 +1,369 @@
+from asyncio import Lock
+from dataclasses import replace
+from datetime import datetime
+from time import time
+from typing import AsyncIterator
+
+from .base_storage import BaseStorage
+from .models import User, Url, UrlTarget, Job, UNFINISHED_JOB_STATES, reuse_key, utc_timestamp
+from .owner_index import OwnerIndex
+
+from .exceptions import DatabaseError, UserExistsError, UrlExistsError, UserNotExistError, UrlNotExistError
+
+
+class _UserRecord:
+    __slots__ = ('username', 'hashed_password', 'deleting')
+
+    def __init__(self, username: str, hashed_password: str):
+        self.username = username
+        self.hashed_password = hashed_password
+        self.deleting = False
+
+
+class _UrlRecord:
+    __slots__ = ('original_url', 'internal_url', 'owner', 'active', 'clicks', 'last_access', 'expires_at')
+
+    def __init__(self,
+                 original_url: str,
+                 internal_url: str,
+                 owner: str,
+                 active: bool = True,
+                 expires_at: datetime | None = None):
+
+        self.original_url = original_url
+        self.internal_url = internal_url
+        self.owner = owner
+        self.active = active
+        self.expires_at = expires_at
+
+        self.clicks = 0
+        self.last_access: datetime | None = None
+
+
+class InMemoryStorage(BaseStorage):
+    """
+    Storage that keeps users and URLs in the process memory.
+
+    Every mutation holds the lock and never awaits while the indexes are
+    inconsistent, so concurrent coroutines always see a complete operation
+    """
+
+    def __init__(self):
+        self.__lock = Lock()
+
+        self.__users: dict[str, _UserRecord] = {}
+        self.__urls: dict[str, _UrlRecord] = {}
+
+        self.__urls_by_owner = OwnerIndex()
+
+        # (owner, 'reuse_key') -> 'internal_url' of the reusable URL
+        self.__reusable_urls: dict[tuple[str, int], str] = {}
+
+        self.__next_id = 0
+
+        # Copies of the saved jobs by 'job_id'
+        self.__jobs: dict[str, Job] = {}
+
+
+    async def create_user(self, user: User):
+        async with self.__lock:
+            if user.username in self.__users:
+                raise UserExistsError(f'User {user.username} already exists')
+
+            self.__users[user.username] = _UserRecord(user.username, user.hashed_password)
+            self.__urls_by_owner.add_owner(user.username)
+
+
+    async def get_user(self, username: str) -> User | None:
+        record = self.__users.get(username)
+        if not record:
+            return None
+
+        return User(username = record.username,
+                    hashed_password = record.hashed_password,
+                    deleting = record.deleting)
+
+
+    async def update_user_password(self, username: str, hashed_password: str):
+        record = self.__users.get(username)
+        if not record:
+            raise UserNotExistError(f'User {username} does not exist')
+
+        record.hashed_password = hashed_password
+
+
+    async def delete_user(self, username: str):
+        async with self.__lock:
+            if username not in self.__users:
+                raise UserNotExistError(f'User {username} does not exist')
+
+            del self.__users[username]
+            for internal_url in self.__urls_by_owner.drop_owner(username):
+                self.__forget_reusable(self.__urls.pop(internal_url))
+
+
+    async def mark_user_deleting(self, username: str):
+        record = self.__users.get(username)
+        if not record:
+            raise UserNotExistError(f'User {username} does not exist')
+
+        record.deleting = True
+
+
+    async def delete_user_urls(self, username: str, limit: int) -> list[str]:
+        async with self.__lock:
+            internal_urls = self.__urls_by_owner.page(username, None, limit)
+
+            for internal_url in internal_urls:
+                self.__forget_reusable(self.__urls.pop(internal_url))
+                self.__urls_by_owner.remove(username, internal_url)
+
+        return internal_urls
+
+
+    async def user_exists(self, username: str) -> bool:
+        return username in self.__users
+
+
+    async def create_url(self,
+                         *,
+                         owner_username: str,
+                         original_url: str,
+                         internal_url: str,
+                         expires_at: datetime | None = None):
+
+        async with self.__lock:
+            if owner_username not in self.__users:
+                raise UserNotExistError(f'User {owner_username} does not exist')
+
+            if internal_url in self.__urls:
+                raise UrlExistsError(f'URL "{internal_url}" already exists')
+
+            self.__urls[internal_url] = _UrlRecord(original_url, internal_url, owner_username, expires_at = expires_at)
+            self.__urls_by_owner.add(owner_username, internal_url)
+
+
+    async def create_urls(self, urls: list[Url]) -> list[DatabaseError | None]:
+        errors: list[DatabaseError | None] = []
+
+        async with self.__lock:
+            for url in urls:
+                if url.owner not in self.__users:
+                    errors.append(UserNotExistError(f'User {url.owner} does not exist'))
+
+                elif url.internal_url in self.__urls:
+                    errors.append(UrlExistsError(f'URL "{url.internal_url}" already exists'))
+
+                else:
+                    self.__urls[url.internal_url] = _UrlRecord(url.original_url,
+                                                               url.internal_url,
+                                                               url.owner,
+                                                               url.active,
+                                                               url.expires_at)
+                    self.__urls_by_owner.add(url.owner, url.internal_url)
+                    errors.append(None)
+
+        return errors
+
+
+    async def create_reusable_url(self,
+                                  *,
+                                  owner_username: str,
+                                  original_url: str,
+                                  internal_url: str) -> Url:
+
+        key = (owner_username, reuse_key(original_url))
+
+        async with self.__lock:
+            if owner_username not in self.__users:
+                raise UserNotExistError(f'User {owner_username} does not exist')
+
+            existing_url = self.__reusable_urls.get(key)
+            if existing_url:
+                return self.__to_url(self.__urls[existing_url])
+
+            if internal_url in self.__urls:
+                raise UrlExistsError(f'URL "{internal_url}" already exists')
+
+            record = self.__urls[internal_url] = _UrlRecord(original_url, internal_url, owner_username)
+            self.__urls_by_owner.add(owner_username, internal_url)
+            self.__reusable_urls[key] = internal_url
+
+        return self.__to_url(record)
+
+
+    async def get_reusable_url(self, owner_username: str, original_url: str) -> Url | None:
+        internal_url = self.__reusable_urls.get((owner_username, reuse_key(original_url)))
+        if not internal_url:
+            return None
+
+        return self.__to_url(self.__urls[internal_url])
+
+
+    async def get_url(self, internal_url: str) -> Url | None:
+        record = self.__urls.get(internal_url)
+        if not record:
+            return None
+
+        return self.__to_url(record)
+
+
+    async def list_urls(self,
+                        owner_username: str,
+                        *,
+                        after: str | None = None,
+                        limit: int = 100,
+                        active: bool | None = None) -> list[Url]:
+
+        predicate = None
+        if active is not None:
+            predicate = lambda internal_url: self.__urls[internal_url].active == active
+
+        page = self.__urls_by_owner.page(owner_username, after, limit, predicate)
+        return [self.__to_url(self.__urls[internal_url]) for internal_url in page]
+
+
+    async def iter_urls(self, owner_username: str, batch_size: int = 1000) -> AsyncIterator[list[Url]]:
+        after = None
+
+        while True:
+            # The page is read without awaits, so it never holds a deleted URL
+            page = self.__urls_by_owner.page(owner_username, after, batch_size)
+            batch = [self.__to_url(self.__urls[internal_url]) for internal_url in page]
+            if batch:
+                yield batch
+
+            if len(page) < batch_size:
+                break
+
+            after = page[-1]
+
+
+    async def iter_internal_urls(self, batch_size: int = 10000) -> AsyncIterator[list[str]]:
+        internal_urls = list(self.__urls)
+
+        for start in range(0, len(internal_urls), batch_size):
+            yield internal_urls[start:start + batch_size]
+
+
+    async def get_url_owner(self, internal_url: str) -> str:
+        return self.__get_url_record(internal_url).owner
+
+
+    async def get_original_url(self, internal_url: str) -> str:
+        return self.__get_url_record(internal_url).original_url
+
+
+    async def resolve(self, internal_url: str) -> UrlTarget | None:
+        record = self.__urls.get(internal_url)
+        if not record:
+            return None
+
+        return UrlTarget(original_url = record.original_url, active = record.active, expires_at = record.expires_at)
+
+
+    async def enable_url(self, internal_url: str):
+        self.__get_url_record(internal_url).active = True
+
+
+    async def disable_url(self, internal_url: str):
+        self.__get_url_record(internal_url).active = False
+
+
+    async def delete_url(self, internal_url: str):
+        async with self.__lock:
+            record = self.__get_url_record(internal_url)
+
+            del self.__urls[internal_url]
+            self.__urls_by_owner.remove(record.owner, internal_url)
+            self.__forget_reusable(record)
+
+
+    async def url_exists(self, internal_url: str) -> bool:
+        return internal_url in self.__urls
+
+
+    async def record_clicks(self, clicks: dict[str, tuple[int, datetime]]):
+        for internal_url, (count, last_access) in clicks.items():
+            record = self.__urls.get(internal_url)
+            if not record:
+                continue
+
+            record.clicks += count
+            if not record.last_access or record.last_access < last_access:
+                record.last_access = last_access
+
+
+    async def reserve_ids(self, count: int) -> int:
+        first_id = self.__next_id
+        self.__next_id += count
+
+        return first_id
+
+
+    async def save_job(self, job: Job, *, runner: str | None = None) -> bool:
+        if runner is not None:
+            stored = self.__jobs.get(job.job_id)
+            if not stored or stored.runner != runner:
+                return False
+
+        self.__jobs[job.job_id] = replace(job)
+        return True
+
+
+    async def get_job(self, job_id: str) -> Job | None:
+        job = self.__jobs.get(job_id)
+        return replace(job) if job else None
+
+
+    async def claim_jobs(self,
+                         runner: str,
+                         lease_until: datetime,
+                         limit: int,
+                         *,
+                         exclude: tuple[str, ...] = ()) -> list[Job]:
+        now = time()
+        claimed = []
+
+        for job in self.__jobs.values():
+            if len(claimed) == limit:
+                break
+
+            if job.job_id in exclude:
+                continue
+
+            if job.state in UNFINISHED_JOB_STATES and (not job.lease_until or utc_timestamp(job.lease_until) < now):
+                job.runner = runner
+                job.lease_until = lease_until
+                claimed.append(replace(job))
+
+        return claimed
+
+
+    async def close(self):
+        pass
+
+
+    @staticmethod
+    def __to_url(record: _UrlRecord) -> Url:
+        return Url(original_url = record.original_url,
+                   internal_url = record.internal_url,
+                   owner = record.owner,
+                   active = record.active,
+                   clicks = record.clicks,
+                   last_access = record.last_access,
+                   expires_at = record.expires_at)
+
+
+    def __forget_reusable(self, record: _UrlRecord):
+        key = (record.owner, reuse_key(record.original_url))
+        if self.__reusable_urls.get(key) == record.internal_url:
+            del self.__reusable_urls[key]
+
+
+    def __get_url_record(self, internal_url: str) -> _UrlRecord:
+        record = self.__urls.get(internal_url)
+        if not record:
+            raise UrlNotExistError(f'URL "{internal_url}" does not exist')
+
+        return record
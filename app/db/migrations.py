@@ -0,0 +1,31 @@
+"""
+Migrate the MongoDB documents to the current layout:
+
+    python -m app.db.migrations
+
+The users stop carrying the 'owned_urls' array, the URLs of a user are
+listed from the 'urls' collection instead. The migration can run while
+the application is serving requests
+"""
+
+import asyncio
+
+from app.config import Config
+from app.dependencies import create_mongo_storage
+
+
+async def migrate(config: Config):
+    storage = create_mongo_storage(config.database)
+
+    try:
+        await storage.setup()
+
+        migrated_users = await storage.drop_owned_urls()
+        print(f'Removed "owned_urls" from {migrated_users} users')
+
+    finally:
+        await storage.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(migrate(Config.load()))
@@ -1,41 +1,193 @@
 from abc import ABC
-from dataclasses import dataclass, asdict, field
-from typing import Any
+from dataclasses import dataclass, fields, MISSING
+from datetime import datetime, timezone
+from hashlib import blake2b
+from time import time
+from typing import Any, Callable
 from dacite import from_dict, Config as DaciteConfig
 
 
+def utc_timestamp(moment: datetime) -> float:
+    """
+    Return the POSIX timestamp of the moment, the naive ones (read from MongoDB) are in UTC
+    """
+
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo = timezone.utc)
+
+    return moment.timestamp()
+
+
+def reuse_key(original_url: str) -> int:
+    """
+    Return the signed 64-bit hash of the URL, that finds the reusable URL of
+    the owner in a compact index instead of the whole 'original_url'
+    """
+
+    return int.from_bytes(blake2b(original_url.encode(), digest_size = 8).digest(), 'little', signed = True)
+
+
+def _generate_to_dict(cls: type) -> Callable[[Any], dict[str, Any]]:
+    """
+    Return the 'to_dict' of the dataclass, that builds the dict of the fields in a single expression
+    """
+
+    items = ', '.join(f'{field.name!r}: self.{field.name}' for field in fields(cls))
+    source = f'def to_dict(self):\n    return {{{items}}}\n'
+
+    namespace = {}
+    exec(source, namespace)
+    return namespace['to_dict']
+
+
+def _generate_from_dict(cls: type) -> Callable[..., Any]:
+    """
+    Return the 'from_dict' of the dataclass, that passes the values of the dict
+    to the constructor without checking their types.
+
+    The missing optional fields take their defaults, the unknown keys ('_id'
+    of MongoDB, etc.) are ignored. The conversions by a dacite config are
+    left to dacite
+    """
+
+    namespace = {'_dacite_from_dict': from_dict}
+    arguments = []
+
+    for field in fields(cls):
+        if field.default is not MISSING:
+            namespace[f'_default_{field.name}'] = field.default
+            arguments.append(f'{field.name} = dict.get({field.name!r}, _default_{field.name})')
+
+        elif field.default_factory is not MISSING:
+            namespace[f'_factory_{field.name}'] = field.default_factory
+            arguments.append(f'{field.name} = dict[{field.name!r}] if {field.name!r} in dict else _factory_{field.name}()')
+
+        else:
+            arguments.append(f'{field.name} = dict[{field.name!r}]')
+
+    source = (
+        'def from_dict(cls, dict, config = None):\n'
+        '    if dict is None:\n'
+        '        return None\n'
+        '    if config is not None:\n'
+        '        return _dacite_from_dict(cls, dict, config)\n'
+        f'    return cls({", ".join(arguments)})\n'
+    )
+
+    exec(source, namespace)
+    return namespace['from_dict']
+
+
 class DatabaseModel(ABC):
     """
-    Base class for all database models
+    Base class for all database models.
+
+    The models are slotted dataclasses. 'to_dict' and 'from_dict' are
+    generated for every model on their first call, and replace these ones
     """
-    
+
+    __slots__ = ()
+
+
     def to_dict(self) -> dict[str, Any]:
-        return asdict(self)
+        """
+        Return the fields of the model as a shallow dict
+        """
+
+        to_dict = _generate_to_dict(type(self))
+        type(self).to_dict = to_dict
+
+        return to_dict(self)
 
 
     @classmethod
     def from_dict(cls, 
                   dict: dict[str, Any], 
                   config: DaciteConfig | None = None) -> 'DatabaseModel':
-        
-        if dict is None:
-            return None
-        
+        """
+        Return the model built from the dict, or None for None.
+
+        The values are not type checked, unless a dacite config is passed
+        """
+
+        from_dict = _generate_from_dict(cls)
+        cls.from_dict = classmethod(from_dict)
+
         return from_dict(cls, dict, config)
 
 
-@dataclass(kw_only = True)
+@dataclass(kw_only = True, slots = True)
 class User(DatabaseModel):
     username: str
     hashed_password: str
 
-    owned_urls: list[str] = field(default_factory = list)
+    # The user is being deleted by a background job and can not log in
+    deleting: bool = False
 
 
-@dataclass(kw_only = True)
+@dataclass(kw_only = True, slots = True)
 class Url(DatabaseModel):
     original_url: str
     internal_url: str
 
     owner: str
     active: bool = True
+
+    clicks: int = 0
+    last_access: datetime | None = None
+
+    # None, if the URL never expires
+    expires_at: datetime | None = None
+
+
+@dataclass(kw_only = True, slots = True)
+class UrlTarget(DatabaseModel):
+    """
+    The part of the URL that is needed to serve a redirect
+    """
+
+    original_url: str
+    active: bool = True
+    expires_at: datetime | None = None
+
+
+    def expired(self, now: float | None = None) -> bool:
+        """
+        Return True, if the URL has expired by 'now' (the current timestamp by default)
+        """
+
+        if self.expires_at is None:
+            return False
+
+        return utc_timestamp(self.expires_at) <= (time() if now is None else now)
+
+
+# States of the jobs that are claimed by the runners
+UNFINISHED_JOB_STATES = ('pending', 'running')
+
+# States of the jobs that are removed after the retention period
+FINISHED_JOB_STATES = ('done', 'failed')
+
+
+@dataclass(kw_only = True, slots = True)
+class Job(DatabaseModel):
+    """
+    Background operation of the storage ('delete_user', etc.) on the 'target'.
+
+    'processed' is the number of the documents that were handled, the job is
+    saved after every batch. 'runner' holds the job until 'lease_until'
+    """
+
+    job_id: str
+    kind: str
+    target: str
+
+    state: str = 'pending' # 'running', 'done' or 'failed'
+    processed: int = 0
+    error: str | None = None
+
+    created_at: datetime
+    updated_at: datetime
+
+    runner: str | None = None
+    lease_until: datetime | None = None
@@ -1,148 +1,501 @@
-from typing import Any
-from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection
+import asyncio
+
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
 
 from .base_storage import BaseStorage
-from .models import User, Url
+from .models import User, Url, UrlTarget, Job, FINISHED_JOB_STATES, UNFINISHED_JOB_STATES, reuse_key
+
+from .exceptions import DatabaseError, UserExistsError, UrlExistsError, UserNotExistError, UrlNotExistError
+
+_DUPLICATE_KEY_ERROR_CODE = 11000
+
+_READ_PREFERENCES = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+
+
+def _read_preference(mode: str):
+    if mode not in _READ_PREFERENCES:
+        raise ValueError(f'Unknown read preference "{mode}"')
+
+    return _READ_PREFERENCES[mode]()
+
+
+def _milliseconds(delta: timedelta | None) -> int | None:
+    return int(delta.total_seconds() * 1000) if delta is not None else None
 
-from .exceptions import UserExistsError, UrlExistsError, UserNotExistError, UrlNotExistError
 
 class MongoStorage(BaseStorage):
-    def __init__(self, host: str, port: int, database: str):
+    """
+    Storage on top of MongoDB.
+
+    The writes go to the primary, the redirects ('resolve') and the other reads
+    follow their own read preferences, so the redirects can be served by the
+    secondaries. The checks inside the writes always read from the primary
+    """
+
+    def __init__(self,
+                 host: str,
+                 port: int,
+                 database: str,
+                 *,
+                 min_pool_size: int = 0,
+                 max_pool_size: int = 100,
+                 max_idle_time: timedelta | None = None,
+                 server_selection_timeout: timedelta = timedelta(seconds = 30),
+                 connect_timeout: timedelta = timedelta(seconds = 20),
+                 socket_timeout: timedelta | None = None,
+                 compressors: list[str] | None = None,
+                 write_concern: int | str = 1,
+                 journal: bool = False,
+                 redirect_read_preference: str = 'primary',
+                 read_preference: str = 'primary',
+                 job_retention: timedelta = timedelta(days = 7)):
+
         self.host = host
         self.port = port
-
-        self.__client = AsyncIOMotorClient(host, port)
+        self.job_retention = job_retention
+
+        options: dict[str, Any] = {}
+        if compressors:
+            # The driver skips the compressors that are not installed ('zstandard', 'python-snappy')
+            options['compressors'] = compressors
+
+        self.__client = AsyncIOMotorClient(host,
+                                           port,
+                                           minPoolSize = min_pool_size,
+                                           maxPoolSize = max_pool_size,
+                                           maxIdleTimeMS = _milliseconds(max_idle_time),
+                                           serverSelectionTimeoutMS = _milliseconds(server_selection_timeout),
+                                           connectTimeoutMS = _milliseconds(connect_timeout),
+                                           socketTimeoutMS = _milliseconds(socket_timeout),
+                                           w = write_concern,
+                                           journal = journal,
+                                           **options)
         self.__database = self.__client[database]
 
         self.__users = self.__database['users']
         self.__urls = self.__database['urls']
+        self.__counters = self.__database['counters']
+        self.__jobs = self.__database['jobs']
+
+        self.__redirect_read_preference = _read_preference(redirect_read_preference)
+        self.__redirect_urls = self.__urls.with_options(read_preference = self.__redirect_read_preference)
+
+        reads = _read_preference(read_preference)
+        self.__read_users = self.__users.with_options(read_preference = reads)
+        self.__read_urls = self.__urls.with_options(read_preference = reads)
+
+
+    async def setup(self):
+        await self.__users.create_index([('username', ASCENDING)], unique = True)
+        await self.__urls.create_index([('internal_url', ASCENDING)], unique = True)
+        await self.__urls.create_index([('owner', ASCENDING), ('internal_url', ASCENDING)])
+
+        # MongoDB removes the expired URLs itself (once a minute), the URLs without
+        # the expiration are left out of the index, so it only grows with the expiring ones
+        await self.__urls.create_index([('expires_at', ASCENDING)],
+                                       expireAfterSeconds = 0,
+                                       partialFilterExpression = {'expires_at': {'$type': 'date'}})
+
+        # Only the reusable URLs carry 'reuse_key', a 64-bit hash of 'original_url',
+        # it keeps one of them per owner and target
+        await self.__urls.create_index([('owner', ASCENDING), ('reuse_key', ASCENDING)],
+                                       unique = True,
+                                       partialFilterExpression = {'reuse_key': {'$exists': True}})
+
+        await self.__jobs.create_index([('job_id', ASCENDING)], unique = True)
+        await self.__jobs.create_index([('state', ASCENDING), ('lease_until', ASCENDING)])
+
+        # Only the finished jobs carry 'finished_at', so the unfinished ones never expire
+        retention = int(self.job_retention.total_seconds())
+        try:
+            await self.__jobs.create_index([('finished_at', ASCENDING)], expireAfterSeconds = retention)
+
+        # The index was created with another retention
+        except OperationFailure:
+            await self.__database.command('collMod', 'jobs', index = {'keyPattern': {'finished_at': ASCENDING},
+                                                                      'expireAfterSeconds': retention})
+
+
+    async def warm_up(self, connections: int):
+        # Concurrent commands can not share a connection, so the pool opens one for each.
+        # The redirects may be served by another member, its pool is warmed up as well
+        read_preferences = [Primary()]
+        if self.__redirect_read_preference != Primary():
+            read_preferences.append(self.__redirect_read_preference)
+
+        await asyncio.gather(*(self.__client.admin.command('ping', read_preference = read_preference)
+                               for read_preference in read_preferences
+                               for _ in range(connections)))
 
 
     async def create_user(self, user: User):
-        if await self.user_exists(user.username):
+        try:
+            await self.__users.insert_one(user.to_dict())
+
+        except DuplicateKeyError:
             raise UserExistsError(f'User {user.username} already exists')
-        
-        await self.__users.insert_one(user.to_dict())
 
-    
+
     async def get_user(self, username: str) -> User | None:
-        user_dict = await self.__users.find_one({'username': username})
+        # The users that have not been migrated yet still carry the 'owned_urls' array
+        user_dict = await self.__read_users.find_one({'username': username}, {'owned_urls': 0})
         return User.from_dict(user_dict)
-    
+
+
+    async def update_user_password(self, username: str, hashed_password: str):
+        result = await self.__users.update_one({'username': username},
+                                               {'$set': {'hashed_password': hashed_password}})
+        if result.matched_count == 0:
+            raise UserNotExistError(f'User {username} does not exist')
+
 
     async def delete_user(self, username: str):
-        await self.__raise_if_user_not_exist(username)
+        result = await self.__users.delete_one({'username': username})
+        if result.deleted_count == 0:
+            raise UserNotExistError(f'User {username} does not exist')
 
-        await self.__users.delete_one({'username': username})
         await self.__urls.delete_many({'owner': username})
 
 
+    async def mark_user_deleting(self, username: str):
+        result = await self.__users.update_one({'username': username},
+                                               {'$set': {'deleting': True}})
+        if result.matched_count == 0:
+            raise UserNotExistError(f'User {username} does not exist')
+
+
+    async def delete_user_urls(self, username: str, limit: int) -> list[str]:
+        # The page is read from the owner index, so every batch deletes the same amount of documents
+        cursor = self.__urls.find({'owner': username}, {'internal_url': 1, '_id': 0})
+        cursor = cursor.sort('internal_url', ASCENDING).limit(limit)
+
+        internal_urls = [url_dict['internal_url'] async for url_dict in cursor]
+        if internal_urls:
+            await self.__urls.delete_many({'owner': username, 'internal_url': {'$in': internal_urls}})
+
+        return internal_urls
+
+
     async def user_exists(self, username: str) -> bool:
-        documents_count = await self.__users.count_documents({'username': username})
+        documents_count = await self.__read_users.count_documents({'username': username}, limit = 1)
         return not documents_count == 0
-    
+
 
     async def create_url(self,
-                         *, 
-                         owner_username: str, 
-                         original_url: str, 
-                         internal_url: str):
-
-        await self.__raise_if_user_not_exist(owner_username)
-        
-        if await self.url_exists(internal_url):
+                         *,
+                         owner_username: str,
+                         original_url: str,
+                         internal_url: str,
+                         expires_at: datetime | None = None):
+
+        new_url = Url(original_url = original_url,
+                      internal_url = internal_url,
+                      owner = owner_username,
+                      expires_at = expires_at)
+
+        try:
+            await self.__urls.insert_one(new_url.to_dict())
+
+        except DuplicateKeyError:
             raise UrlExistsError(f'URL "{internal_url}" already exists')
-        
+
+        if not await self.__owner_exists(owner_username):
+            await self.__urls.delete_one({'internal_url': internal_url})
+            raise UserNotExistError(f'User {owner_username} does not exist')
+
+
+    async def create_urls(self, urls: list[Url]) -> list[DatabaseError | None]:
+        errors: list[DatabaseError | None] = [None] * len(urls)
+        if not urls:
+            return errors
+
+        try:
+            await self.__urls.insert_many([url.to_dict() for url in urls], ordered = False)
+
+        except BulkWriteError as error:
+            for write_error in error.details['writeErrors']:
+                index = write_error['index']
+
+                if write_error['code'] == _DUPLICATE_KEY_ERROR_CODE:
+                    errors[index] = UrlExistsError(f'URL "{urls[index].internal_url}" already exists')
+                else:
+                    errors[index] = DatabaseError(write_error['errmsg'])
+
+        inserted = [index for index, error in enumerate(errors) if error is None]
+        if not inserted:
+            return errors
+
+        owners = list({urls[index].owner for index in inserted})
+        existing_owners = {user['username'] async for user in self.__users.find(self.__owner_condition(owners),
+                                                                                {'username': 1, '_id': 0})}
+
+        # The URLs of the missing owners are rolled back
+        orphans = [index for index in inserted if urls[index].owner not in existing_owners]
+        if orphans:
+            await self.__urls.delete_many({'internal_url': {'$in': [urls[index].internal_url for index in orphans]}})
+
+            for index in orphans:
+                errors[index] = UserNotExistError(f'User {urls[index].owner} does not exist')
+
+        return errors
+
+
+    async def create_reusable_url(self,
+                                  *,
+                                  owner_username: str,
+                                  original_url: str,
+                                  internal_url: str) -> Url:
+
+        condition = {'owner': owner_username, 'reuse_key': reuse_key(original_url)}
+
         new_url = Url(original_url = original_url,
                       internal_url = internal_url,
                       owner = owner_username)
-        
-        await self.__urls.insert_one(new_url.to_dict())
-        await self.__append_owned_urls(owner_username, internal_url)
+        document = new_url.to_dict()
+        del document['owner']
+
+        try:
+            # Inserted only if the URL is still missing, the unique index
+            # turns the concurrent upserts into a single insert
+            url_dict = await self.__urls.find_one_and_update(condition,
+                                                             {'$setOnInsert': document},
+                                                             {'_id': 0},
+                                                             upsert = True,
+                                                             return_document = ReturnDocument.AFTER)
+
+        except DuplicateKeyError:
+            url_dict = await self.__urls.find_one(condition, {'_id': 0})
+            if not url_dict:
+                raise UrlExistsError(f'URL "{internal_url}" already exists')
+
+        # The new 'internal_url' is only taken, if this call inserted the URL
+        if not await self.__owner_exists(owner_username):
+            await self.__urls.delete_one({'internal_url': internal_url})
+            raise UserNotExistError(f'User {owner_username} does not exist')
+
+        return Url.from_dict(url_dict)
+
+
+    async def get_reusable_url(self, owner_username: str, original_url: str) -> Url | None:
+        url_dict = await self.__read_urls.find_one({'owner': owner_username, 'reuse_key': reuse_key(original_url)},
+                                                   {'_id': 0})
+        return Url.from_dict(url_dict)
 
 
     async def get_url(self, internal_url: str) -> Url | None:
-        url_dict = await self.__urls.find_one({'internal_url': internal_url})
+        url_dict = await self.__read_urls.find_one({'internal_url': internal_url})
         return Url.from_dict(url_dict)
-    
+
+
+    async def list_urls(self,
+                        owner_username: str,
+                        *,
+                        after: str | None = None,
+                        limit: int = 100,
+                        active: bool | None = None) -> list[Url]:
+
+        condition: dict[str, Any] = {'owner': owner_username}
+        if after is not None:
+            condition['internal_url'] = {'$gt': after}
+
+        if active is not None:
+            condition['active'] = active
+
+        cursor = self.__read_urls.find(condition, {'_id': 0}).sort('internal_url', ASCENDING).limit(limit)
+        return [Url.from_dict(url_dict) async for url_dict in cursor]
+
+
+    async def iter_urls(self, owner_username: str, batch_size: int = 1000) -> AsyncIterator[list[Url]]:
+        # A single cursor over the owner index, the driver fetches 'batch_size' documents at once
+        cursor = self.__read_urls.find({'owner': owner_username}, {'_id': 0}, batch_size = batch_size)
+        cursor = cursor.sort('internal_url', ASCENDING)
+
+        batch = []
+        async for url_dict in cursor:
+            batch.append(Url.from_dict(url_dict))
+
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
+
+
+    async def iter_internal_urls(self, batch_size: int = 10000) -> AsyncIterator[list[str]]:
+        # Read from the primary, so the new URLs are not missed, and only
+        # from the unique index, so the documents are never fetched
+        cursor = self.__urls.find({}, {'internal_url': 1, '_id': 0}, batch_size = batch_size)
+        cursor = cursor.hint([('internal_url', ASCENDING)])
+
+        batch = []
+        async for url_dict in cursor:
+            batch.append(url_dict['internal_url'])
+
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
+
 
     async def get_url_owner(self, internal_url: str) -> str:
-        await self.__raise_if_url_not_exist(internal_url)
+        return await self.__extract_url_field(internal_url, 'owner')
 
-        return await self.__extract_field(self.__urls,
-                                          'owner',
-                                          {'internal_url': internal_url})
-    
 
     async def get_original_url(self, internal_url: str) -> str:
-        await self.__raise_if_url_not_exist(internal_url)
+        return await self.__extract_url_field(internal_url, 'original_url')
+
+
+    async def resolve(self, internal_url: str) -> UrlTarget | None:
+        target_dict = await self.__redirect_urls.find_one({'internal_url': internal_url},
+                                                          {'original_url': 1, 'active': 1, 'expires_at': 1, '_id': 0})
+        return UrlTarget.from_dict(target_dict)
 
-        return await self.__extract_field(self.__urls,
-                                          'original_url',
-                                          {'internal_url': internal_url})
 
-    
     async def enable_url(self, internal_url: str):
         await self.__set_url_active(internal_url, True)
 
-    
+
     async def disable_url(self, internal_url: str):
         await self.__set_url_active(internal_url, False)
 
-    
-    async def delete_url(self, internal_url: str):
-        await self.__raise_if_url_not_exist(internal_url)
 
-        deleted_url = await self.__urls.find_one_and_delete({'internal_url': internal_url})
-        await self.__remove_owned_url(deleted_url['owner'], internal_url)
+    async def delete_url(self, internal_url: str):
+        result = await self.__urls.delete_one({'internal_url': internal_url})
+        if result.deleted_count == 0:
+            raise UrlNotExistError(f'URL "{internal_url}" does not exist')
 
 
     async def url_exists(self, internal_url: str) -> bool:
-        documents_count = await self.__urls.count_documents({'internal_url': internal_url})
+        documents_count = await self.__read_urls.count_documents({'internal_url': internal_url}, limit = 1)
         return not documents_count == 0
 
 
+    async def record_clicks(self, clicks: dict[str, tuple[int, datetime]]):
+        if not clicks:
+            return
+
+        updates = [UpdateOne({'internal_url': internal_url},
+                             {'$inc': {'clicks': count}, '$max': {'last_access': last_access}})
+                   for internal_url, (count, last_access) in clicks.items()]
+
+        await self.__urls.bulk_write(updates, ordered = False)
+
+
+    async def reserve_ids(self, count: int) -> int:
+        counter = await self.__counters.find_one_and_update({'_id': 'urls'},
+                                                            {'$inc': {'value': count}},
+                                                            upsert = True,
+                                                            return_document = ReturnDocument.AFTER)
+        return counter['value'] - count
+
+
+    async def save_job(self, job: Job, *, runner: str | None = None) -> bool:
+        document = job.to_dict()
+        if job.state in FINISHED_JOB_STATES:
+            document['finished_at'] = job.updated_at
+
+        if runner is None:
+            await self.__jobs.replace_one({'job_id': job.job_id}, document, upsert = True)
+            return True
+
+        result = await self.__jobs.replace_one({'job_id': job.job_id, 'runner': runner}, document)
+        return result.matched_count > 0
+
+
+    async def get_job(self, job_id: str) -> Job | None:
+        # The state of the job is read from the primary, so it never goes back
+        job_dict = await self.__jobs.find_one({'job_id': job_id}, {'_id': 0})
+        return Job.from_dict(job_dict)
+
+
+    async def claim_jobs(self,
+                         runner: str,
+                         lease_until: datetime,
+                         limit: int,
+                         *,
+                         exclude: tuple[str, ...] = ()) -> list[Job]:
+        condition = {
+            'job_id': {'$nin': list(exclude)},
+            'state': {'$in': list(UNFINISHED_JOB_STATES)},
+            '$or': [{'lease_until': None}, {'lease_until': {'$lt': datetime.now(timezone.utc)}}],
+        }
+
+        claimed = []
+        while len(claimed) < limit:
+            job_dict = await self.__jobs.find_one_and_update(condition,
+                                                             {'$set': {'runner': runner, 'lease_until': lease_until}},
+                                                             {'_id': 0},
+                                                             return_document = ReturnDocument.AFTER)
+            if not job_dict:
+                break
+
+            claimed.append(Job.from_dict(job_dict))
+
+        return claimed
+
+
+    async def drop_owned_urls(self) -> int:
+        """
+        Remove the legacy 'owned_urls' array from the user documents and
+        return the number of migrated users
+        """
+
+        result = await self.__users.update_many({'owned_urls': {'$exists': True}},
+                                                {'$unset': {'owned_urls': ''}})
+        return result.modified_count
+
+
     async def close(self):
         self.__client.close()
 
-    
-    async def __raise_if_user_not_exist(self, username: str):
-        if not await self.user_exists(username):
-            raise UserNotExistError(f'User {username} does not exist')
-        
-    
-    async def __raise_if_url_not_exist(self, internal_url: str):
-        if not await self.url_exists(internal_url):
+
+    async def __set_url_active(self, internal_url: str, active: bool):
+        result = await self.__urls.update_one({'internal_url': internal_url},
+                                              {'$set': {'active': active}})
+        if result.matched_count == 0:
             raise UrlNotExistError(f'URL "{internal_url}" does not exist')
 
 
-    async def __append_owned_urls(self, username: str, internal_url: str):
-        await self.__raise_if_user_not_exist(username)
+    async def __extract_url_field(self, internal_url: str, searched_field: str) -> Any:
+        """
+        Return a single field of the URL
 
-        await self.__users.update_one({'username': username}, 
-                                      {'$push': {'owned_urls': internal_url}})
-        
-    
-    async def __remove_owned_url(self, username: str, internal_str: str):
-        await self.__raise_if_user_not_exist(username)
+        Raise UrlNotExistError, if the URL does not exist
+        """
 
-        await self.__users.update_one({'username': username}, 
-                                      {'$pull': {'owned_urls': internal_str}})
-        
+        selected_field = await self.__read_urls.find_one({'internal_url': internal_url},
+                                                         {searched_field: 1, '_id': 0})
+        if not selected_field:
+            raise UrlNotExistError(f'URL "{internal_url}" does not exist')
 
-    async def __set_url_active(self, internal_url: str, active: bool):
-        await self.__raise_if_url_not_exist(internal_url)
-
-        await self.__urls.update_one({'internal_url': internal_url},
-                                     {'$set': {'active': active}})
-        
-        
-    async def __extract_field(self, 
-                                  collection: AsyncIOMotorCollection,
-                                  searched_field: str,
-                                  condition: dict[str, Any]) -> Any:
-        
-        selected_field = await collection.find_one(condition, 
-                                                   {searched_field: 1, '_id': 0})
-        
         return selected_field[searched_field]
+
+
+    @staticmethod
+    def __owner_condition(usernames: list[str]) -> dict[str, Any]:
+        return {'username': {'$in': usernames}, 'deleting': {'$ne': True}}
+
+
+    async def __owner_exists(self, username: str) -> bool:
+        """
+        Return True, if the user exists and is not being deleted.
+
+        Checked on the primary after the URLs are inserted, so the URLs inserted
+        after the owner's deletion started are rolled back instead of left behind
+        """
+
+        return await self.__users.count_documents(self.__owner_condition([username]), limit = 1) > 0
@@ -0,0 +1,150 @@
+from bisect import bisect_left, bisect_right, insort
+from itertools import chain
+from typing import Callable, Iterator
+
+
+# A block is split in halves, once it grows past twice the load
+_LOAD = 1000
+
+
+class _SortedBlocks:
+    """
+    Sorted list of strings kept in blocks of at most '2 * _LOAD' items, so an
+    insert moves a single block instead of the whole list, like
+    'sortedcontainers.SortedList'
+    """
+
+    __slots__ = ('blocks', 'maxes')
+
+    def __init__(self):
+        self.blocks: list[list[str]] = []
+
+        # The last item of every block
+        self.maxes: list[str] = []
+
+
+    def add(self, value: str):
+        if not self.blocks:
+            self.blocks.append([value])
+            self.maxes.append(value)
+            return
+
+        index = bisect_left(self.maxes, value)
+        if index == len(self.maxes):
+            index -= 1
+            self.blocks[index].append(value)
+            self.maxes[index] = value
+
+        else:
+            insort(self.blocks[index], value)
+
+        block = self.blocks[index]
+        if len(block) > 2 * _LOAD:
+            self.blocks.insert(index + 1, block[_LOAD:])
+            self.maxes.insert(index, block[_LOAD - 1])
+            del block[_LOAD:]
+
+
+    def remove(self, value: str):
+        index = bisect_left(self.maxes, value)
+        if index == len(self.maxes):
+            return
+
+        block = self.blocks[index]
+        position = bisect_left(block, value)
+        if position == len(block) or block[position] != value:
+            return
+
+        del block[position]
+
+        if not block:
+            del self.blocks[index]
+            del self.maxes[index]
+
+        elif position == len(block):
+            self.maxes[index] = block[-1]
+
+
+    def iter_after(self, after: str | None) -> Iterator[str]:
+        """
+        Iterate over the values that follow 'after', all of them if it is None
+        """
+
+        if after is None:
+            return chain.from_iterable(self.blocks)
+
+        index = bisect_right(self.maxes, after)
+        if index == len(self.blocks):
+            return iter(())
+
+        block = self.blocks[index]
+        return chain(block[bisect_right(block, after):], chain.from_iterable(self.blocks[index + 1:]))
+
+
+    def __iter__(self) -> Iterator[str]:
+        return chain.from_iterable(self.blocks)
+
+
+class OwnerIndex:
+    """
+    Index of 'internal_url' by owner, sorted inside every owner to serve
+    keyset pagination without sorting.
+
+    The codes are allocated in a shuffled order, so the URLs of every owner
+    are kept in sorted blocks, that take the inserts in O(log n) instead of
+    the O(n) of a single sorted list
+    """
+
+    def __init__(self):
+        self.__urls_by_owner: dict[str, _SortedBlocks] = {}
+
+
+    def add_owner(self, owner: str):
+        self.__urls_by_owner.setdefault(owner, _SortedBlocks())
+
+
+    def drop_owner(self, owner: str) -> list[str]:
+        """
+        Remove the owner and return the URLs it had
+        """
+
+        internal_urls = self.__urls_by_owner.pop(owner, None)
+        return list(internal_urls) if internal_urls else []
+
+
+    def add(self, owner: str, internal_url: str):
+        internal_urls = self.__urls_by_owner.get(owner)
+        if internal_urls is None:
+            internal_urls = self.__urls_by_owner[owner] = _SortedBlocks()
+
+        internal_urls.add(internal_url)
+
+
+    def remove(self, owner: str, internal_url: str):
+        internal_urls = self.__urls_by_owner.get(owner)
+        if internal_urls:
+            internal_urls.remove(internal_url)
+
+
+    def page(self,
+             owner: str,
+             after: str | None,
+             limit: int,
+             predicate: Callable[[str], bool] | None = None) -> list[str]:
+        """
+        Return up to 'limit' URLs of the owner that follow 'after' and match the predicate
+        """
+
+        internal_urls = self.__urls_by_owner.get(owner)
+        if not internal_urls:
+            return []
+
+        page = []
+        for internal_url in internal_urls.iter_after(after):
+            if not predicate or predicate(internal_url):
+                page.append(internal_url)
+
+                if len(page) == limit:
+                    break
+
+        return page
@@ -0,0 +1,181 @@
+from datetime import datetime
+from typing import Any, AsyncIterator
+
+from .base_storage import BaseStorage
+from .models import User, Url, UrlTarget, Job
+from .exceptions import DatabaseError
+
+
+class StorageWrapper(BaseStorage):
+    """
+    Storage that passes every call to the wrapped storage through '_call'.
+
+    Subclasses override '_call' to observe every call, or single methods to
+    change their behaviour
+    """
+
+    def __init__(self, storage: BaseStorage):
+        self.storage = storage
+
+
+    async def _call(self, method: str, *args, **kwargs) -> Any:
+        """
+        Call the method of the wrapped storage
+        """
+
+        return await getattr(self.storage, method)(*args, **kwargs)
+
+
+    async def setup(self):
+        return await self._call('setup')
+
+
+    async def warm_up(self, connections: int):
+        return await self._call('warm_up', connections)
+
+
+    async def create_user(self, user: User):
+        return await self._call('create_user', user)
+
+
+    async def get_user(self, username: str) -> User | None:
+        return await self._call('get_user', username)
+
+
+    async def update_user_password(self, username: str, hashed_password: str):
+        return await self._call('update_user_password', username, hashed_password)
+
+
+    async def delete_user(self, username: str):
+        return await self._call('delete_user', username)
+
+
+    async def mark_user_deleting(self, username: str):
+        return await self._call('mark_user_deleting', username)
+
+
+    async def delete_user_urls(self, username: str, limit: int) -> list[str]:
+        return await self._call('delete_user_urls', username, limit)
+
+
+    async def user_exists(self, username: str) -> bool:
+        return await self._call('user_exists', username)
+
+
+    async def create_url(self,
+                         *,
+                         owner_username: str,
+                         original_url: str,
+                         internal_url: str,
+                         expires_at: datetime | None = None):
+
+        return await self._call('create_url',
+                                owner_username = owner_username,
+                                original_url = original_url,
+                                internal_url = internal_url,
+                                expires_at = expires_at)
+
+
+    async def create_urls(self, urls: list[Url]) -> list[DatabaseError | None]:
+        return await self._call('create_urls', urls)
+
+
+    async def create_reusable_url(self,
+                                  *,
+                                  owner_username: str,
+                                  original_url: str,
+                                  internal_url: str) -> Url:
+
+        return await self._call('create_reusable_url',
+                                owner_username = owner_username,
+                                original_url = original_url,
+                                internal_url = internal_url)
+
+
+    async def get_reusable_url(self, owner_username: str, original_url: str) -> Url | None:
+        return await self._call('get_reusable_url', owner_username, original_url)
+
+
+    async def get_url(self, internal_url: str) -> Url | None:
+        return await self._call('get_url', internal_url)
+
+
+    async def list_urls(self,
+                        owner_username: str,
+                        *,
+                        after: str | None = None,
+                        limit: int = 100,
+                        active: bool | None = None) -> list[Url]:
+
+        return await self._call('list_urls',
+                                owner_username,
+                                after = after,
+                                limit = limit,
+                                active = active)
+
+
+    def iter_urls(self, owner_username: str, batch_size: int = 1000) -> AsyncIterator[list[Url]]:
+        # Not a single call, so it is not passed through '_call'
+        return self.storage.iter_urls(owner_username, batch_size)
+
+
+    def iter_internal_urls(self, batch_size: int = 10000) -> AsyncIterator[list[str]]:
+        # Not a single call, so it is not passed through '_call'
+        return self.storage.iter_internal_urls(batch_size)
+
+
+    async def get_url_owner(self, internal_url: str) -> str:
+        return await self._call('get_url_owner', internal_url)
+
+
+    async def get_original_url(self, internal_url: str) -> str:
+        return await self._call('get_original_url', internal_url)
+
+
+    async def resolve(self, internal_url: str) -> UrlTarget | None:
+        return await self._call('resolve', internal_url)
+
+
+    async def enable_url(self, internal_url: str):
+        return await self._call('enable_url', internal_url)
+
+
+    async def disable_url(self, internal_url: str):
+        return await self._call('disable_url', internal_url)
+
+
+    async def delete_url(self, internal_url: str):
+        return await self._call('delete_url', internal_url)
+
+
+    async def url_exists(self, internal_url: str) -> bool:
+        return await self._call('url_exists', internal_url)
+
+
+    async def record_clicks(self, clicks: dict[str, tuple[int, datetime]]):
+        return await self._call('record_clicks', clicks)
+
+
+    async def reserve_ids(self, count: int) -> int:
+        return await self._call('reserve_ids', count)
+
+
+    async def save_job(self, job: Job, *, runner: str | None = None) -> bool:
+        return await self._call('save_job', job, runner = runner)
+
+
+    async def get_job(self, job_id: str) -> Job | None:
+        return await self._call('get_job', job_id)
+
+
+    async def claim_jobs(self,
+                         runner: str,
+                         lease_until: datetime,
+                         limit: int,
+                         *,
+                         exclude: tuple[str, ...] = ()) -> list[Job]:
+        return await self._call('claim_jobs', runner, lease_until, limit, exclude = exclude)
+
+
+    async def close(self):
+        return await self._call('close')
@@ -1,72 +1,325 @@
 from dataclasses import dataclass
-from typing import Annotated
+from datetime import timedelta
+from typing import Annotated, TYPE_CHECKING
 
 from jwt.exceptions import InvalidTokenError, ExpiredSignatureError
 
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 
-from app.schemas.user import UserInfo
-from app.config import Config
+from app.config import Config, DatabaseConfig, InvalidationConfig
 
 from app.db.models import User
 from app.db.base_storage import BaseStorage
-from app.db.mongo_storage import MongoStorage
 
 from app.auth.auth import Auth
+from app.auth.password_hasher import PasswordHasher
+from app.unique_url import UrlAllocator
+from app.clicks import ClickCounter
+from app.jobs import JobRunner
+from app.cache import TTLCache
+from app.metrics import Metrics, InstrumentedStorage
+from app.profiling import ProfileStore
+from app.url_filter import CuckooFilter, FilteredStorage
+from app.shared_table import SharedRedirectTable, SharedTableStorage
+from app.invalidation import URL, USER, LocalBus, UdpBus, PublishingStorage, drop_keys
+from app.rate_limit import RateLimiter, create_rate_limiter
+
+if TYPE_CHECKING:
+    from app.db.mongo_storage import MongoStorage
 
 
 @dataclass
 class AppDependencies:
     """
-    Global dependencies for the application (authenticator and database)
+    Global dependencies for the application (authenticator and database).
+
+    They are built by the lifespan of the application and stored in 'app.state.dependencies'
     """
     
+    config: Config
     auth: Auth
     storage: BaseStorage
+    allocator: UrlAllocator
+    clicks: ClickCounter
+    jobs: JobRunner
+
+    # Users of the authenticated requests by username
+    users: TTLCache
+
+    metrics: Metrics
+
+    # None, if profiling is disabled
+    profiles: ProfileStore | None
+
+    # None, if the URL filter is disabled
+    url_filter: CuckooFilter | None
+
+    # None, if the shared redirect table is disabled
+    redirect_table: SharedRedirectTable | None
+
+    invalidations: LocalBus
+
+    # None, if the rate limits are disabled
+    rate_limiter: RateLimiter | None
 
 
-    def get_auth(self) -> Auth:
-        return self.auth
+    async def start(self):
+        """
+        Prepare the storage, open the pooled connections, start the password
+        hashing workers and the background tasks
+        """
 
+        await self.storage.setup()
+        await self.storage.warm_up(self.config.startup.warmup_connections)
+        await self.auth.warm_up()
 
-    def get_storage(self) -> BaseStorage:
-        return self.storage
+        self.clicks.start()
+        await self.invalidations.start()
+        await self.jobs.start()
 
 
-def init_dependencies() -> AppDependencies:
+    async def close(self):
+        """
+        Flush the pending clicks and release the connections and the workers
+        """
+
+        try:
+            await self.jobs.stop()
+            await self.clicks.stop()
+            await self.invalidations.stop()
+
+        finally:
+            try:
+                await self.storage.close()
+
+            finally:
+                self.auth.close()
+
+                if self.rate_limiter:
+                    self.rate_limiter.close()
+
+
+def create_mongo_storage(config: DatabaseConfig, job_retention: timedelta = timedelta(days = 7)) -> 'MongoStorage':
     """
-    Load config from 'config.yaml' file
+    Create MongoStorage with the pool, timeouts and read preferences of the config
+    """
+
+    from app.db.mongo_storage import MongoStorage
+
+    return MongoStorage(config.host,
+                        config.port,
+                        config.name,
+                        min_pool_size = config.min_pool_size,
+                        max_pool_size = config.max_pool_size,
+                        max_idle_time = config.max_idle_time,
+                        server_selection_timeout = config.server_selection_timeout,
+                        connect_timeout = config.connect_timeout,
+                        socket_timeout = config.socket_timeout,
+                        compressors = config.compressors,
+                        write_concern = config.write_concern,
+                        journal = config.journal,
+                        redirect_read_preference = config.read_preference.redirect,
+                        read_preference = config.read_preference.read,
+                        job_retention = job_retention)
+
+
+def create_storage(config: Config) -> BaseStorage:
+    """
+    Create the storage backend selected by 'storage.backend'.
+
+    The backends are imported on use, so a worker never imports the drivers it does not need
+
+    Raise ValueError, if the backend is unknown or its settings are missing
+    """
+
+    backend = config.storage.backend
+
+    if backend == 'memory':
+        from app.db.memory_storage import InMemoryStorage
+        return InMemoryStorage()
+
+    if backend == 'log':
+        from app.db.log_storage import LogStorage
+        return LogStorage(config.storage.path, sync = config.storage.sync, job_retention = config.jobs.retention)
+
+    if backend == 'mongo':
+        if not config.database:
+            raise ValueError('The "database" section is required by the "mongo" storage backend')
+
+        return create_mongo_storage(config.database, config.jobs.retention)
+
+    raise ValueError(f'Unknown storage backend "{backend}"')
+
+
+def create_invalidation_bus(config: InvalidationConfig, metrics: Metrics) -> LocalBus:
+    if config.backend == 'local':
+        return LocalBus(batch_interval = config.batch_interval,
+                        max_batch = config.max_batch,
+                        metrics = metrics)
+
+    if config.backend == 'udp':
+        return UdpBus(config.group,
+                      config.port,
+                      multicast_ttl = config.multicast_ttl,
+                      interface = config.interface,
+                      batch_interval = config.batch_interval,
+                      max_batch = config.max_batch,
+                      metrics = metrics)
+
+    raise ValueError(f'Unknown invalidation backend: {config.backend}')
+
+
+def init_dependencies(config: Config,
+                      metrics: Metrics,
+                      profiles: ProfileStore | None = None,
+                      storage: BaseStorage | None = None) -> AppDependencies:
+    """
+    Build the dependencies from the config.
+
+    'storage' replaces the configured storage backend (benchmarks, etc.)
     """
-    
-    config = Config.load()
     
     auth = Auth(config.jwt.secret_key, 
                 config.jwt.access_token_expire_time,
-                config.jwt.algorithm)
+                config.jwt.algorithm,
+                token_cache_size = config.cache.token_max_size,
+                token_cache_ttl = config.cache.token_ttl,
+                password_hasher = PasswordHasher(rounds = config.password.rounds,
+                                                 executor = config.password.executor,
+                                                 workers = config.password.workers,
+                                                 max_queue = config.password.max_queue))
     
-    storage = MongoStorage(config.database.host,
-                           config.database.port,
-                           config.database.name)
+    storage = storage or create_storage(config)
+    if config.metrics.enabled:
+        storage = InstrumentedStorage(storage, metrics)
+
+    # Outside of the instrumented storage, so the cached and filtered lookups are not measured as storage calls
+    redirect_table = table_storage = None
+    if config.redirect_table.enabled:
+        redirect_table = SharedRedirectTable(config.redirect_table.path,
+                                             slots = config.redirect_table.slots,
+                                             key_size = config.redirect_table.key_size,
+                                             value_size = config.redirect_table.value_size,
+                                             window = config.redirect_table.window)
+        storage = table_storage = SharedTableStorage(storage, redirect_table, ttl = config.redirect_table.ttl)
+
+    # The misses of the filter never reach the redirect table
+    url_filter = None
+    if config.url_filter.enabled:
+        url_filter = CuckooFilter(config.url_filter.capacity, config.url_filter.false_positive_rate)
+        # Only the storages of a single process have no URLs created by the other workers
+        storage = FilteredStorage(storage,
+                                  url_filter,
+                                  snapshot_path = config.url_filter.snapshot,
+                                  authoritative = config.storage.backend in ('memory', 'log'))
+
+    # Publishes the changes, that went through every other wrapper, to the caches of all workers
+    invalidations = create_invalidation_bus(config.invalidation, metrics)
+    storage = PublishingStorage(storage, invalidations)
+
+    allocator = UrlAllocator(storage,
+                             block_size = config.url.block_size,
+                             min_length = config.url.min_length,
+                             secret_key = config.url.secret_key,
+                             url_filter = url_filter)
+
+    clicks = ClickCounter(storage,
+                          flush_interval = config.clicks.flush_interval,
+                          max_pending = config.clicks.max_pending)
+
+    jobs = JobRunner(storage,
+                     batch_size = config.jobs.batch_size,
+                     batch_pause = config.jobs.batch_pause,
+                     lease = config.jobs.lease,
+                     poll_interval = config.jobs.poll_interval,
+                     max_running = config.jobs.max_running)
+
+    users = TTLCache(config.cache.user_max_size, config.cache.user_ttl)
+
+    rate_limiter = create_rate_limiter(config.rate_limit) if config.rate_limit.enabled else None
+
+    invalidations.subscribe('users', drop_keys(USER, users.pop))
+    if table_storage:
+        invalidations.subscribe('redirect_table', drop_keys(URL, table_storage.invalidate))
+
+    return AppDependencies(config,
+                           auth,
+                           storage,
+                           allocator,
+                           clicks,
+                           jobs,
+                           users,
+                           metrics,
+                           profiles,
+                           url_filter,
+                           redirect_table,
+                           invalidations,
+                           rate_limiter)
+
+
+def get_config(request: Request) -> Config:
+    return request.app.state.dependencies.config
+
+
+def get_auth(request: Request) -> Auth:
+    return request.app.state.dependencies.auth
 
-    return AppDependencies(auth, storage)
+
+def get_storage(request: Request) -> BaseStorage:
+    return request.app.state.dependencies.storage
+
+
+def get_allocator(request: Request) -> UrlAllocator:
+    return request.app.state.dependencies.allocator
+
+
+def get_clicks(request: Request) -> ClickCounter:
+    return request.app.state.dependencies.clicks
+
+
+def get_jobs(request: Request) -> JobRunner:
+    return request.app.state.dependencies.jobs
+
+
+def get_user_cache(request: Request) -> TTLCache:
+    return request.app.state.dependencies.users
+
+
+def get_metrics(request: Request) -> Metrics:
+    return request.app.state.dependencies.metrics
+
+
+def get_profiles(request: Request) -> ProfileStore | None:
+    return request.app.state.dependencies.profiles
 
 
-app_dependencies = init_dependencies()
 o2auth_scheme = OAuth2PasswordBearer(tokenUrl = '/user/token')
 
-AuthDependency = Annotated[Auth, Depends(app_dependencies.get_auth)]
-StorageDependency = Annotated[BaseStorage, Depends(app_dependencies.get_storage)]
+ConfigDependency = Annotated[Config, Depends(get_config)]
+AuthDependency = Annotated[Auth, Depends(get_auth)]
+StorageDependency = Annotated[BaseStorage, Depends(get_storage)]
+AllocatorDependency = Annotated[UrlAllocator, Depends(get_allocator)]
+ClicksDependency = Annotated[ClickCounter, Depends(get_clicks)]
+JobsDependency = Annotated[JobRunner, Depends(get_jobs)]
+UserCacheDependency = Annotated[TTLCache, Depends(get_user_cache)]
+MetricsDependency = Annotated[Metrics, Depends(get_metrics)]
+ProfilesDependency = Annotated[ProfileStore | None, Depends(get_profiles)]
 TokenDependency = Annotated[str, Depends(o2auth_scheme)]
 
 
 async def get_current_user(token: TokenDependency,
                            auth: AuthDependency,
-                           storage: StorageDependency) -> UserInfo:
+                           storage: StorageDependency,
+                           users: UserCacheDependency) -> User:
     """
-    Parse the JWT token and return the user from DB
+    Parse the JWT token and return the user from the cache or DB.
 
-    Raise HTTPException, if the token is expired or can not be decoded
+    The cached user may lag behind DB by the cache TTL, so read the user
+    from DB, if its data is returned to the client
+
+    Raise HTTPException, if the token is expired or can not be decoded, or
+    the user is being deleted
     """
     
     credentials_exception = HTTPException(
@@ -77,10 +330,17 @@ async def get_current_user(token: TokenDependency,
 
     try:
         username = auth.get_user_by_access_token(token)
-        if not await storage.user_exists(username):
+
+        user = users.get(username)
+        if user:
+            return user
+
+        user = await storage.get_user(username)
+        if not user or user.deleting:
             raise credentials_exception
-        
-        return await storage.get_user(username)
+
+        users.set(username, user)
+        return user
     
     except ExpiredSignatureError:
         raise HTTPException(
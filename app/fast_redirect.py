@@ -0,0 +1,110 @@
+import json
+
+from urllib.parse import quote
+
+from app.routes.redirect import NOT_FOUND_DETAIL, NOT_ACTIVE_DETAIL, EXPIRED_DETAIL
+
+
+REDIRECT_ROUTE_PATH = '/{internal_url}'
+
+# The characters that RedirectResponse keeps in the location as they are
+_LOCATION_SAFE = ":/%#?=@[]!$&'()*+,;"
+
+_EMPTY_CONTENT_LENGTH = (b'content-length', b'0')
+_EMPTY_BODY = {'type': 'http.response.body', 'body': b''}
+
+
+def _error_messages(status_code: int, detail: str) -> tuple[dict, dict]:
+    """
+    Return the messages of the JSON response that FastAPI sends for HTTPException
+    """
+
+    body = json.dumps({'detail': detail}, ensure_ascii = False, separators = (',', ':')).encode()
+    start = {
+        'type': 'http.response.start',
+        'status': status_code,
+        'headers': [(b'content-length', str(len(body)).encode()), (b'content-type', b'application/json')],
+    }
+
+    return start, {'type': 'http.response.body', 'body': body}
+
+
+_NOT_FOUND = _error_messages(404, NOT_FOUND_DETAIL)
+_NOT_ACTIVE = _error_messages(403, NOT_ACTIVE_DETAIL)
+_EXPIRED = _error_messages(410, EXPIRED_DETAIL)
+
+
+class FastRedirectMiddleware:
+    """
+    ASGI middleware that serves 'GET /{internal_url}' without the routing,
+    the dependency injection and the response classes of FastAPI.
+
+    The responses are the same as the ones of the redirect route. The single
+    segment paths of the other routes ('/metrics', '/docs', etc.) and every
+    other request are passed to the application
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+        # Found on the first request, once every router is included
+        self.__reserved_paths: frozenset[str] | None = None
+        self.__route = None
+
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'GET':
+            return await self.app(scope, receive, send)
+
+        path = scope['path']
+        if self.__reserved_paths is None:
+            self.__find_routes(scope['app'])
+
+        if path in self.__reserved_paths or path.find('/', 1) != -1 or len(path) < 2:
+            return await self.app(scope, receive, send)
+
+        internal_url = path[1:]
+        dependencies = scope['app'].state.dependencies
+
+        # Labels the request in the metrics like the redirect route does
+        scope['route'] = self.__route
+
+        target = await dependencies.storage.resolve(internal_url)
+        if not target:
+            start, body = _NOT_FOUND
+
+        elif target.expired():
+            start, body = _EXPIRED
+
+        elif not target.active:
+            start, body = _NOT_ACTIVE
+
+        else:
+            dependencies.clicks.hit(internal_url)
+
+            location = quote(target.original_url, safe = _LOCATION_SAFE).encode('latin-1')
+            start = {
+                'type': 'http.response.start',
+                'status': 307,
+                'headers': [_EMPTY_CONTENT_LENGTH, (b'location', location)],
+            }
+            body = _EMPTY_BODY
+
+        await send(start)
+        await send(body)
+
+
+    def __find_routes(self, app):
+        reserved_paths = set()
+
+        for route in app.routes:
+            route_path = getattr(route, 'path', '')
+
+            if route_path == REDIRECT_ROUTE_PATH:
+                self.__route = route
+
+            # The routes of the application, that match single segment paths before the redirect
+            elif route_path.count('/') == 1 and '{' not in route_path:
+                reserved_paths.add(route_path)
+
+        self.__reserved_paths = frozenset(reserved_paths)
@@ -0,0 +1,372 @@
+import asyncio
+import logging
+import os
+import socket
+
+from datetime import timedelta
+from struct import Struct
+from time import time
+from typing import Any, Callable
+
+from app.db.base_storage import BaseStorage
+from app.db.storage_wrapper import StorageWrapper
+from app.metrics import Metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Kinds of the invalidated keys
+URL = 'url'
+USER = 'user'
+
+# (kind, key)
+Invalidation = tuple[str, str]
+
+_KIND_CODES = {URL: 1, USER: 2}
+_KINDS = {code: kind for kind, code in _KIND_CODES.items()}
+
+# magic, sender, time of the first publish in the batch
+_DATAGRAM_HEADER = Struct('<4s16sd')
+_DATAGRAM_MAGIC = b'INV1'
+
+# kind, key length
+_ENTRY_HEADER = Struct('<BH')
+
+# Stays below the Ethernet MTU, so the datagrams are never fragmented
+_MAX_DATAGRAM = 1400
+
+# URLs deleted before their owner at once
+_DELETE_BATCH = 1000
+
+
+class Subscriber:
+    """
+    Callback of the invalidated keys.
+
+    'lag' is the time between the first publish of the last delivered batch
+    and its delivery, 'max_lag' is the largest one seen
+    """
+
+    def __init__(self, name: str, callback: Callable[[list[Invalidation]], Any]):
+        self.name = name
+        self.callback = callback
+
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.delivered = 0
+
+
+def drop_keys(kind: str, drop: Callable[[str], Any]) -> Callable[[list[Invalidation]], None]:
+    """
+    Return the callback that calls 'drop' with every invalidated key of the kind
+    """
+
+    def callback(invalidations: list[Invalidation]):
+        for invalidation_kind, key in invalidations:
+            if invalidation_kind == kind:
+                drop(key)
+
+    return callback
+
+
+class LocalBus:
+    """
+    Invalidation bus of a single worker.
+
+    Publishing is a dict update without any awaits. The same key published
+    several times is delivered once, and the subscribers get the keys in
+    batches every 'batch_interval' (or earlier, if 'max_batch' keys are waiting)
+    """
+
+    def __init__(self,
+                 *,
+                 batch_interval: timedelta = timedelta(milliseconds = 50),
+                 max_batch: int = 1000,
+                 metrics: Metrics | None = None):
+
+        self.batch_interval = batch_interval
+        self.max_batch = max_batch
+        self.metrics = metrics
+
+        self.subscribers: list[Subscriber] = []
+
+        # Invalidation -> time of its first publish
+        self.__pending: dict[Invalidation, float] = {}
+
+        self.__full = asyncio.Event()
+        self.__task: asyncio.Task | None = None
+
+
+    def subscribe(self, name: str, callback: Callable[[list[Invalidation]], Any]) -> Subscriber:
+        subscriber = Subscriber(name, callback)
+        self.subscribers.append(subscriber)
+
+        return subscriber
+
+
+    def publish(self, kind: str, key: str):
+        """
+        Invalidate the key in every worker
+        """
+
+        self.__pending.setdefault((kind, key), time())
+        if len(self.__pending) >= self.max_batch:
+            self.__full.set()
+
+
+    async def start(self):
+        """
+        Start delivering the batches in background
+        """
+
+        self.__task = asyncio.create_task(self.__run())
+
+
+    async def stop(self):
+        """
+        Stop the background delivery and deliver the remaining keys
+        """
+
+        if self.__task:
+            self.__task.cancel()
+            await asyncio.gather(self.__task, return_exceptions = True)
+            self.__task = None
+
+        await self.flush()
+
+
+    async def flush(self):
+        if not self.__pending:
+            return
+
+        pending, self.__pending = self.__pending, {}
+        self.__full.clear()
+
+        invalidations = list(pending)
+        published_at = min(pending.values())
+
+        try:
+            await self._send(invalidations, published_at)
+
+        finally:
+            self._deliver(invalidations, published_at)
+
+
+    async def _send(self, invalidations: list[Invalidation], published_at: float):
+        """
+        Send the batch to the other workers
+        """
+
+        pass
+
+
+    def _deliver(self, invalidations: list[Invalidation], published_at: float):
+        for subscriber in self.subscribers:
+            try:
+                subscriber.callback(invalidations)
+
+            except Exception:
+                logger.exception('Subscriber "%s" failed to invalidate %d keys', subscriber.name, len(invalidations))
+                continue
+
+            subscriber.lag = max(0.0, time() - published_at)
+            subscriber.max_lag = max(subscriber.max_lag, subscriber.lag)
+            subscriber.delivered += len(invalidations)
+
+            if self.metrics:
+                self.metrics.observe_invalidation_lag(subscriber.name, subscriber.lag)
+
+
+    async def __run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.__full.wait(), self.batch_interval.total_seconds())
+
+            except TimeoutError:
+                pass
+
+            try:
+                await self.flush()
+
+            except Exception:
+                logger.exception('Failed to send the invalidations')
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, bus: 'UdpBus'):
+        self.bus = bus
+
+
+    def datagram_received(self, data: bytes, address):
+        self.bus._receive(data)
+
+
+class UdpBus(LocalBus):
+    """
+    Invalidation bus of every worker of every host that joins the UDP multicast
+    group, no broker is involved.
+
+    Every batch is delivered to the local subscribers and sent to the group
+    in datagrams that fit into a single packet. A lost datagram is not resent,
+    so the caches still need a TTL to bound the staleness
+    """
+
+    def __init__(self,
+                 group: str,
+                 port: int,
+                 *,
+                 multicast_ttl: int = 1,
+                 interface: str = '0.0.0.0',
+                 **kwargs):
+
+        super().__init__(**kwargs)
+
+        self.group = group
+        self.port = port
+        self.multicast_ttl = multicast_ttl
+        self.interface = interface
+
+        # The own datagrams are looped back, they are recognized by the sender
+        self.__sender = os.urandom(16)
+        self.__transport: asyncio.DatagramTransport | None = None
+
+
+    async def start(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+
+        try:
+            # Every worker of the host binds the same port and gets its own copy of the datagrams
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, 'SO_REUSEPORT'):
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+            sock.bind(('', self.port))
+
+            membership = socket.inet_aton(self.group) + socket.inet_aton(self.interface)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.multicast_ttl)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.interface))
+
+            sock.setblocking(False)
+
+        except OSError:
+            sock.close()
+            raise
+
+        self.__transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: _DatagramProtocol(self),
+            sock = sock,
+        )
+
+        await super().start()
+
+
+    async def stop(self):
+        try:
+            await super().stop()
+
+        finally:
+            if self.__transport:
+                self.__transport.close()
+                self.__transport = None
+
+
+    async def _send(self, invalidations: list[Invalidation], published_at: float):
+        if not self.__transport:
+            return
+
+        header = _DATAGRAM_HEADER.pack(_DATAGRAM_MAGIC, self.__sender, published_at)
+        datagram = bytearray(header)
+
+        for kind, key in invalidations:
+            key_bytes = key.encode()
+            entry = _ENTRY_HEADER.pack(_KIND_CODES[kind], len(key_bytes)) + key_bytes
+
+            if len(datagram) + len(entry) > _MAX_DATAGRAM and len(datagram) > len(header):
+                self.__transport.sendto(bytes(datagram), (self.group, self.port))
+                datagram = bytearray(header)
+
+            datagram += entry
+
+        if len(datagram) > len(header):
+            self.__transport.sendto(bytes(datagram), (self.group, self.port))
+
+
+    def _receive(self, data: bytes):
+        if len(data) < _DATAGRAM_HEADER.size:
+            return
+
+        magic, sender, published_at = _DATAGRAM_HEADER.unpack_from(data)
+        if magic != _DATAGRAM_MAGIC or sender == self.__sender:
+            return
+
+        invalidations = []
+        offset = _DATAGRAM_HEADER.size
+
+        while offset + _ENTRY_HEADER.size <= len(data):
+            kind_code, key_length = _ENTRY_HEADER.unpack_from(data, offset)
+            offset += _ENTRY_HEADER.size
+
+            kind = _KINDS.get(kind_code)
+            if kind:
+                invalidations.append((kind, data[offset:offset + key_length].decode(errors = 'replace')))
+
+            offset += key_length
+
+        if invalidations:
+            self._deliver(invalidations, published_at)
+
+
+class PublishingStorage(StorageWrapper):
+    """
+    Storage that publishes the URLs and users it changed to the invalidation bus
+    """
+
+    def __init__(self, storage: BaseStorage, bus: LocalBus):
+        super().__init__(storage)
+        self.bus = bus
+
+
+    async def enable_url(self, internal_url: str):
+        await self.storage.enable_url(internal_url)
+        self.bus.publish(URL, internal_url)
+
+
+    async def disable_url(self, internal_url: str):
+        await self.storage.disable_url(internal_url)
+        self.bus.publish(URL, internal_url)
+
+
+    async def delete_url(self, internal_url: str):
+        await self.storage.delete_url(internal_url)
+        self.bus.publish(URL, internal_url)
+
+
+    async def update_user_password(self, username: str, hashed_password: str):
+        await self.storage.update_user_password(username, hashed_password)
+        self.bus.publish(USER, username)
+
+
+    async def mark_user_deleting(self, username: str):
+        await self.storage.mark_user_deleting(username)
+        self.bus.publish(USER, username)
+
+
+    async def delete_user_urls(self, username: str, limit: int) -> list[str]:
+        internal_urls = await self.storage.delete_user_urls(username, limit)
+
+        for internal_url in internal_urls:
+            self.bus.publish(URL, internal_url)
+
+        return internal_urls
+
+
+    async def delete_user(self, username: str):
+        # The URLs would be deleted with the user, so they are deleted and
+        # published in batches before, instead of listing all of them at once
+        while await self.delete_user_urls(username, _DELETE_BATCH):
+            pass
+
+        await self.storage.delete_user(username)
+        self.bus.publish(USER, username)
@@ -0,0 +1,254 @@
+import asyncio
+import logging
+
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+from app.db.base_storage import BaseStorage
+from app.db.models import Job
+from app.db.exceptions import UserNotExistError
+
+
+logger = logging.getLogger(__name__)
+
+# Kinds of the jobs
+DELETE_USER = 'delete_user'
+
+
+class LeaseLostError(Exception):
+    """
+    The job was claimed by another runner, after the lease of this one expired
+    """
+
+
+class JobRunner:
+    """
+    Run the heavy storage operations in background, in batches of 'batch_size'
+    documents with a 'batch_pause' after every batch, so they never take the
+    whole storage from the requests.
+
+    The job is saved after every batch with the lease of this runner. The jobs
+    left by a stopped worker are released, the ones of a crashed worker are
+    claimed once their lease expires, and both continue from the last saved
+    batch. Repeating a batch does no harm. A runner, that finds its job
+    claimed by another one on a save, stops the job without saving it.
+
+    The poller also extends the leases of the running jobs, so a batch longer
+    than the lease does not let another runner (or this one) claim the job again
+    """
+
+    def __init__(self,
+                 storage: BaseStorage,
+                 *,
+                 batch_size: int = 1000,
+                 batch_pause: timedelta = timedelta(milliseconds = 100),
+                 lease: timedelta = timedelta(seconds = 30),
+                 poll_interval: timedelta = timedelta(seconds = 10),
+                 max_running: int = 2):
+
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.max_running = max_running
+
+        self.runner_id = uuid4().hex
+
+        self.__storage = storage
+
+        # 'job_id' -> the job run by this runner and its task
+        self.__jobs: dict[str, Job] = {}
+        self.__tasks: dict[str, asyncio.Task] = {}
+
+        # Keeps the lease renewals from overwriting the final save of the job
+        self.__save_lock = asyncio.Lock()
+
+        self.__poller: asyncio.Task | None = None
+
+
+    async def start(self):
+        """
+        Start claiming the unfinished jobs in background, the first ones right away
+        """
+
+        self.__poller = asyncio.create_task(self.__poll())
+
+
+    async def stop(self):
+        """
+        Stop the running jobs and release them to the other runners
+        """
+
+        tasks = list(self.__tasks.values())
+        if self.__poller:
+            tasks.append(self.__poller)
+            self.__poller = None
+
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions = True)
+
+        for job in list(self.__jobs.values()):
+            job.runner = None
+            job.lease_until = None
+
+            try:
+                await self.__storage.save_job(job, runner = self.runner_id)
+
+            except Exception:
+                logger.exception('Failed to release the job %s', job.job_id)
+
+        self.__jobs.clear()
+        self.__tasks.clear()
+
+
+    async def delete_user(self, username: str) -> Job:
+        """
+        Forbid the user to log in and start deleting the user with the URLs
+
+        Raise UserNotExistError, if the user does not exist
+        """
+
+        await self.__storage.mark_user_deleting(username)
+
+        now = datetime.now(timezone.utc)
+        job = Job(job_id = uuid4().hex,
+                  kind = DELETE_USER,
+                  target = username,
+                  created_at = now,
+                  updated_at = now,
+                  runner = self.runner_id,
+                  lease_until = now + self.lease)
+
+        await self.__storage.save_job(job)
+        self.__run(job)
+
+        return job
+
+
+    async def get_job(self, job_id: str) -> Job | None:
+        """
+        Return the job by 'job_id', the jobs of this runner are returned without the storage lookup
+        """
+
+        return self.__jobs.get(job_id) or await self.__storage.get_job(job_id)
+
+
+    def __run(self, job: Job):
+        self.__jobs[job.job_id] = job
+        self.__tasks[job.job_id] = asyncio.create_task(self.__execute(job))
+
+
+    async def __execute(self, job: Job):
+        try:
+            try:
+                job.state = 'running'
+
+                if job.kind == DELETE_USER:
+                    await self.__delete_user(job)
+
+                else:
+                    raise ValueError(f'Unknown job kind "{job.kind}"')
+
+                job.state = 'done'
+
+            except (asyncio.CancelledError, LeaseLostError):
+                raise
+
+            except Exception as error:
+                logger.exception('The job %s (%s of "%s") failed', job.job_id, job.kind, job.target)
+
+                job.state = 'failed'
+                job.error = str(error) or type(error).__name__
+
+            job.runner = None
+            job.lease_until = None
+            await self.__save(job)
+
+        except LeaseLostError:
+            logger.warning('The job %s was claimed by another runner, stopping it', job.job_id)
+
+        except Exception:
+            logger.exception('Failed to save the job %s', job.job_id)
+
+        # The cancelled jobs are kept for 'stop' to release them
+        self.__jobs.pop(job.job_id, None)
+        self.__tasks.pop(job.job_id, None)
+
+
+    async def __delete_user(self, job: Job):
+        while True:
+            internal_urls = await self.__storage.delete_user_urls(job.target, self.batch_size)
+
+            job.processed += len(internal_urls)
+            await self.__save(job)
+
+            if len(internal_urls) < self.batch_size:
+                break
+
+            await asyncio.sleep(self.batch_pause.total_seconds())
+
+        try:
+            await self.__storage.delete_user(job.target)
+
+        # Deleted by the previous run of the job, that was stopped before saving it
+        except UserNotExistError:
+            pass
+
+
+    async def __save(self, job: Job):
+        """
+        Save the progress of the job and extend the lease, if the job is still run by this runner
+
+        Raise LeaseLostError, if another runner holds the job in the storage
+        """
+
+        async with self.__save_lock:
+            job.updated_at = datetime.now(timezone.utc)
+            if job.runner == self.runner_id:
+                job.lease_until = job.updated_at + self.lease
+
+            if not await self.__storage.save_job(job, runner = self.runner_id):
+                raise LeaseLostError(f'The job {job.job_id} is held by another runner')
+
+
+    async def __renew(self):
+        """
+        Extend the leases of the running jobs
+        """
+
+        for job in list(self.__jobs.values()):
+            async with self.__save_lock:
+                # Released by its final save
+                if job.runner != self.runner_id:
+                    continue
+
+                job.lease_until = datetime.now(timezone.utc) + self.lease
+
+                # The job stops on its next save
+                if not await self.__storage.save_job(job, runner = self.runner_id):
+                    logger.warning('The job %s was claimed by another runner', job.job_id)
+
+
+    async def __poll(self):
+        while True:
+            try:
+                await self.__renew()
+
+                free = self.max_running - len(self.__jobs)
+                if free > 0:
+                    lease_until = datetime.now(timezone.utc) + self.lease
+
+                    # A running job is never claimed twice, even if its lease expired
+                    for job in await self.__storage.claim_jobs(self.runner_id,
+                                                               lease_until,
+                                                               free,
+                                                               exclude = tuple(self.__jobs)):
+                        logger.info('Resuming the job %s (%s of "%s")', job.job_id, job.kind, job.target)
+                        self.__run(job)
+
+            except Exception:
+                logger.exception('Failed to claim the jobs')
+
+            await asyncio.sleep(self.poll_interval.total_seconds())
@@ -1,9 +1,89 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 
-from app.routes import user, url, redirect
+from app.config import Config
+from app.db.base_storage import BaseStorage
+from app.dependencies import init_dependencies
+from app.fast_redirect import FastRedirectMiddleware
+from app.metrics import Metrics, MetricsMiddleware
+from app.profiling import ProfileStore, ProfilingMiddleware
+from app.rate_limit import RateLimitMiddleware
+from app.routes import health, user, url, jobs, metrics, profiles, redirect
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Build and warm up the dependencies before the first request, and close
+    them after the last one. '/readyz' passes only in between
+    """
+
+    dependencies = init_dependencies(app.state.config,
+                                     app.state.metrics,
+                                     app.state.profiles,
+                                     app.state.storage)
+    app.state.dependencies = dependencies
+
+    try:
+        await dependencies.start()
+        app.state.ready = True
+
+        yield
+
+    finally:
+        app.state.ready = False
+        await dependencies.close()
+
+
+def create_app(config: Config, storage: BaseStorage | None = None) -> FastAPI:
+    """
+    Create the application, the dependencies are built by its lifespan.
+
+    'storage' replaces the configured storage backend (benchmarks, etc.)
+    """
+
+    app = FastAPI(lifespan = lifespan)
+
+    app.state.config = config
+    app.state.storage = storage
+    app.state.ready = False
+
+    # The middlewares are added before the start, so their dependencies are built here
+    app.state.metrics = Metrics()
+    app.state.profiles = None
+
+    # The innermost one, so the fast redirects are still measured and profiled
+    if config.url.fast_redirect:
+        app.add_middleware(FastRedirectMiddleware)
+
+    # In front of the fast redirects, so they are limited too
+    if config.rate_limit.enabled:
+        app.add_middleware(RateLimitMiddleware, forwarded = config.rate_limit.forwarded)
+
+    if config.profiling.enabled:
+        app.state.profiles = ProfileStore(config.profiling.directory, config.profiling.keep)
+
+        app.add_middleware(ProfilingMiddleware,
+                           store = app.state.profiles,
+                           token = config.profiling.token,
+                           sample_every = config.profiling.sample_every,
+                           interval = config.profiling.interval.total_seconds())
+
+    if config.metrics.enabled:
+        app.add_middleware(MetricsMiddleware, metrics = app.state.metrics)
+
+    app.include_router(health.router)
+    app.include_router(user.router)
+    app.include_router(url.router)
+    app.include_router(jobs.router)
+    app.include_router(metrics.router)
+    app.include_router(profiles.router)
+
+    # Must be the last one, as it matches any single segment path
+    app.include_router(redirect.router)
+
+    return app
 
-app = FastAPI()
 
-app.include_router(user.router)
-app.include_router(url.router)
-app.include_router(redirect.router)
\ No newline at end of file
+app = create_app(Config.load())
@@ -0,0 +1,200 @@
+from bisect import bisect_left
+from collections import Counter
+from time import perf_counter
+from typing import Any
+
+from app.db.base_storage import operation_class
+from app.db.storage_wrapper import StorageWrapper
+
+
+# Upper bounds of the histogram buckets in seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PROMETHEUS_MEDIA_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    """
+    Histogram with fixed buckets.
+
+    The event loop runs a single observation at a time, so the counts are
+    plain list items without any locks
+    """
+
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self):
+        # The last bucket counts the values above the largest bound
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+
+    def observe(self, value: float):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels: Any) -> str:
+    return ','.join(f'{name}="{_escape(str(value))}"' for name, value in labels.items())
+
+
+class Metrics:
+    """
+    Request and storage metrics that are rendered in the Prometheus text format
+    """
+
+    def __init__(self):
+        # (method, route template, status code) -> latency
+        self.requests: dict[tuple[str, str, int], Histogram] = {}
+
+        # storage method -> latency
+        self.storage_operations: dict[str, Histogram] = {}
+
+        # (storage method, exception type) -> count
+        self.storage_errors: Counter[tuple[str, str]] = Counter()
+
+        # invalidation subscriber -> time from the publish to the delivery
+        self.invalidation_lags: dict[str, Histogram] = {}
+
+
+    def observe_request(self, method: str, route: str, status_code: int, seconds: float):
+        key = (method, route, status_code)
+
+        histogram = self.requests.get(key)
+        if not histogram:
+            histogram = self.requests[key] = Histogram()
+
+        histogram.observe(seconds)
+
+
+    def observe_storage_operation(self, operation: str, seconds: float):
+        histogram = self.storage_operations.get(operation)
+        if not histogram:
+            histogram = self.storage_operations[operation] = Histogram()
+
+        histogram.observe(seconds)
+
+
+    def count_storage_error(self, operation: str, error_type: str):
+        self.storage_errors[(operation, error_type)] += 1
+
+
+    def observe_invalidation_lag(self, subscriber: str, seconds: float):
+        histogram = self.invalidation_lags.get(subscriber)
+        if not histogram:
+            histogram = self.invalidation_lags[subscriber] = Histogram()
+
+        histogram.observe(seconds)
+
+
+    def render(self) -> str:
+        """
+        Return the metrics in the Prometheus text format
+        """
+
+        lines = []
+
+        self.__render_histograms(lines,
+                                 'http_request_duration_seconds',
+                                 'Latency of the HTTP requests by route template and status code',
+                                 {_labels(method = method, route = route, status = status_code): histogram
+                                  for (method, route, status_code), histogram in self.requests.items()})
+
+        self.__render_histograms(lines,
+                                 'storage_operation_duration_seconds',
+                                 'Latency of the storage operations by operation class',
+                                 {_labels(operation = operation, operation_class = operation_class(operation)): histogram
+                                  for operation, histogram in self.storage_operations.items()})
+
+        self.__render_histograms(lines,
+                                 'invalidation_lag_seconds',
+                                 'Time from the publish of the invalidation to its delivery by subscriber',
+                                 {_labels(subscriber = subscriber): histogram
+                                  for subscriber, histogram in self.invalidation_lags.items()})
+
+        lines.append('# HELP storage_errors_total Errors raised by the storage operations by exception type')
+        lines.append('# TYPE storage_errors_total counter')
+        for (operation, error_type), count in self.storage_errors.items():
+            lines.append(f'storage_errors_total{{{_labels(operation = operation, error = error_type)}}} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+    @staticmethod
+    def __render_histograms(lines: list[str], name: str, description: str, histograms: dict[str, Histogram]):
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} histogram')
+
+        for labels, histogram in histograms.items():
+            total = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                total += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {total}')
+
+            total += histogram.counts[-1]
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {total}')
+            lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+            lines.append(f'{name}_count{{{labels}}} {total}')
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that records the latency of every HTTP request by its route template
+    """
+
+    def __init__(self, app, metrics: Metrics):
+        self.app = app
+        self.metrics = metrics
+
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+
+            await send(message)
+
+        started = perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+
+        finally:
+            # The router stores the matched route in the scope, the paths without
+            # a route are not labelled one by one to keep the label set bounded
+            route = scope.get('route')
+            route_path = getattr(route, 'path', None) or 'unmatched'
+
+            self.metrics.observe_request(scope['method'], route_path, status_code, perf_counter() - started)
+
+
+class InstrumentedStorage(StorageWrapper):
+    """
+    Storage that records the latency and errors of every call of the wrapped storage
+    """
+
+    def __init__(self, storage, metrics: Metrics):
+        super().__init__(storage)
+        self.metrics = metrics
+
+
+    async def _call(self, method: str, *args, **kwargs) -> Any:
+        started = perf_counter()
+        try:
+            return await super()._call(method, *args, **kwargs)
+
+        except Exception as error:
+            self.metrics.count_storage_error(method, type(error).__name__)
+            raise
+
+        finally:
+            self.metrics.observe_storage_operation(method, perf_counter() - started)
@@ -0,0 +1,250 @@
+import asyncio
+import hmac
+import os
+import re
+import sys
+import threading
+
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from time import perf_counter
+
+
+# The leaf of the stacks sampled while the request was waiting (for the storage, etc.)
+AWAITING_FRAME = '[awaiting]'
+
+PROFILE_SUFFIX = '.collapsed'
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'.replace(';', ',')
+
+
+def _coroutine_chain(coro) -> list:
+    """
+    Return the frames of the suspended coroutine and everything it awaits, outermost first
+    """
+
+    frames = []
+
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is None:
+            break
+
+        frames.append(frame)
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+
+    return frames
+
+
+class StackSampler:
+    """
+    Sample the stacks of a single asyncio task from a background thread.
+
+    While the task runs, the stack of the event loop thread is sampled. While it
+    is suspended, the chain of the awaiting coroutines is sampled instead, so the
+    time spent awaiting the storage shows up under the awaiting call
+    """
+
+    def __init__(self, task: asyncio.Task, interval: float):
+        self.interval = interval
+        self.samples: Counter[str] = Counter()
+
+        self.__task = task
+        self.__loop = task.get_loop()
+        self.__thread_id = threading.get_ident()
+
+        self.__stopped = threading.Event()
+        self.__thread = threading.Thread(target = self.__run, name = 'profiler', daemon = True)
+
+
+    def start(self):
+        self.__thread.start()
+
+
+    def stop(self):
+        """
+        Stop sampling, the thread finishes its last sample before 'join' returns
+        """
+
+        self.__stopped.set()
+
+
+    def join(self):
+        self.__thread.join()
+
+
+    def __run(self):
+        while not self.__stopped.wait(self.interval):
+            try:
+                self.__sample()
+
+            # The loop thread keeps changing the frames while they are walked
+            except (AttributeError, RuntimeError, ValueError):
+                pass
+
+
+    def __sample(self):
+        if asyncio.current_task(self.__loop) is self.__task:
+            frame = sys._current_frames().get(self.__thread_id)
+
+            frames = []
+            while frame is not None:
+                frames.append(frame)
+                frame = frame.f_back
+
+            labels = [_frame_label(frame) for frame in reversed(frames)]
+
+        else:
+            labels = [_frame_label(frame) for frame in _coroutine_chain(self.__task.get_coro())]
+            labels.append(AWAITING_FRAME)
+
+        # The thread may wake up only after 'stop', once the task awaits something else
+        if not self.__stopped.is_set():
+            self.samples[';'.join(labels)] += 1
+
+
+@dataclass
+class ProfileInfo:
+    name: str
+    size: int
+    created_at: datetime
+
+
+class ProfileStore:
+    """
+    Directory with the recent profiles in the collapsed stack format,
+    only the 'keep' newest profiles are kept
+    """
+
+    def __init__(self, directory: str, keep: int = 100):
+        self.directory = directory
+        self.keep = keep
+
+        os.makedirs(directory, exist_ok = True)
+
+
+    def save(self, method: str, path: str, duration: float, samples: Counter[str]) -> str:
+        """
+        Write the profile and return its name
+        """
+
+        started_at = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S.%f')
+        safe_path = re.sub(r'[^A-Za-z0-9_.-]+', '_', path).strip('_')[:64] or 'root'
+        name = f'{started_at}-{method}-{safe_path}-{duration * 1000:.0f}ms{PROFILE_SUFFIX}'
+
+        with open(os.path.join(self.directory, name), 'w') as profile_file:
+            for stack, count in samples.most_common():
+                profile_file.write(f'{stack} {count}\n')
+
+        self.__rotate()
+        return name
+
+
+    def list(self) -> list[ProfileInfo]:
+        """
+        Return the stored profiles, the newest first
+        """
+
+        profiles = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(PROFILE_SUFFIX):
+                stat = entry.stat()
+                profiles.append(ProfileInfo(name = entry.name,
+                                            size = stat.st_size,
+                                            created_at = datetime.fromtimestamp(stat.st_mtime, timezone.utc)))
+
+        return sorted(profiles, key = lambda profile: profile.name, reverse = True)
+
+
+    def path(self, name: str) -> str | None:
+        """
+        Return the path of the profile or None, if it does not exist
+        """
+
+        if os.path.basename(name) != name or not name.endswith(PROFILE_SUFFIX):
+            return None
+
+        path = os.path.join(self.directory, name)
+        return path if os.path.isfile(path) else None
+
+
+    def __rotate(self):
+        for profile in self.list()[self.keep:]:
+            try:
+                os.remove(os.path.join(self.directory, profile.name))
+
+            except FileNotFoundError:
+                pass
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware that profiles the requests with the 'X-Profile' header equal
+    to the configured token, and every 'sample_every' request, if it is set.
+
+    A single request is profiled at a time, the other requests only pay for
+    the trigger check
+    """
+
+    def __init__(self,
+                 app,
+                 store: ProfileStore,
+                 *,
+                 token: str | None = None,
+                 sample_every: int = 0,
+                 interval: float = 0.001):
+
+        self.app = app
+        self.store = store
+        self.sample_every = sample_every
+        self.interval = interval
+
+        self.__token = token.encode() if token else None
+        self.__requests = 0
+        self.__profiling = False
+
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not self.__triggered(scope) or self.__profiling:
+            return await self.app(scope, receive, send)
+
+        self.__profiling = True
+        sampler = StackSampler(asyncio.current_task(), self.interval)
+
+        started = perf_counter()
+        sampler.start()
+
+        try:
+            await self.app(scope, receive, send)
+
+        finally:
+            duration = perf_counter() - started
+            sampler.stop()
+
+            # Joining the sampler and writing the profile (with the listing of
+            # the directory to rotate it) block, so they run off the event loop
+            try:
+                await asyncio.to_thread(sampler.join)
+                await asyncio.to_thread(self.store.save, scope['method'], scope['path'], duration, sampler.samples)
+
+            finally:
+                self.__profiling = False
+
+
+    def __triggered(self, scope) -> bool:
+        if self.sample_every:
+            self.__requests += 1
+            if self.__requests >= self.sample_every:
+                self.__requests = 0
+                return True
+
+        if self.__token:
+            for name, value in scope['headers']:
+                if name == b'x-profile':
+                    return hmac.compare_digest(value, self.__token)
+
+        return False
@@ -0,0 +1,442 @@
+import fcntl
+import json
+import math
+import os
+
+from contextlib import contextmanager
+from hashlib import blake2b
+from mmap import mmap
+from struct import Struct
+from time import time
+from typing import NamedTuple
+
+from jwt.exceptions import InvalidTokenError
+
+from app.config import RateLimitConfig, RateLimitRuleConfig, RateLimitGroupConfig
+
+
+_LAYOUT_VERSION = 1
+
+# magic, layout version, slots, probe window
+_HEADER = Struct('<8sIQH')
+_HEADER_SIZE = 64
+_MAGIC = b'URLRTL01'
+
+# The position of the CLOCK hand, right after the header fields
+_HAND = Struct('<I')
+_HAND_OFFSET = _HEADER.size
+
+# Route groups
+AUTH = 'auth'
+WRITE = 'write'
+READ = 'read'
+REDIRECT = 'redirect'
+
+_AUTH_PATHS = frozenset(('/user/token', '/user/regist'))
+_API_PREFIXES = ('/user/', '/url/', '/jobs/')
+_READ_METHODS = frozenset(('GET', 'HEAD'))
+
+TOO_MANY_REQUESTS_DETAIL = 'Too many requests, try again later'
+
+
+class Limit(NamedTuple):
+    """
+    Token bucket of 'burst' tokens, that gets a token every 'interval' seconds
+    """
+
+    interval: float
+    burst: int
+
+
+    @classmethod
+    def from_config(cls, config: RateLimitRuleConfig | None) -> 'Limit | None':
+        if config is None:
+            return None
+
+        return cls(config.period.total_seconds() / config.requests, config.burst or config.requests)
+
+
+class Decision(NamedTuple):
+    """
+    Result of a request to the buckets, reported by the tightest bucket:
+    its size, the tokens left, the seconds until it is full again and the
+    seconds until the request can be repeated (0, if it is allowed)
+    """
+
+    allowed: bool
+    limit: int
+    remaining: int
+    reset: float
+    retry_after: float
+
+
+class BucketTable:
+    """
+    Hash table of the token buckets in an array of 'slots' 64-bit key
+    digests, an array of their theoretical arrival times and an array of the
+    reference bits, 17 bytes per bucket.
+
+    A bucket is kept as the time it becomes full again (the generic cell rate
+    algorithm), so a request adds 'interval' to the time and is allowed, if
+    the time does not run more than 'burst' intervals ahead of now. The
+    bucket, that is full again, is the same as a missing one and its slot is
+    free. A key goes to one of 'window' slots after its digest, the slot of a
+    new key is a free one or the first slot without the reference bit after
+    the CLOCK hand, so the evicted buckets are the ones used least recently
+    in the window, approximately. An evicted bucket starts full again.
+
+    Without 'path' the table lives in the worker memory. With 'path' the
+    file is mapped by every worker of the host ('/dev/shm' keeps it in
+    memory), and the requests of all workers are serialized by 'flock' of
+    the file. The file name carries the layout, so the workers with other
+    settings never share a file
+    """
+
+    def __init__(self, path: str | None = None, *, slots: int = 1_000_000, window: int = 8):
+        self.slots = slots
+        self.window = window
+
+        # The windows of the last slots do not wrap around, so they take 'window' more slots
+        length = slots + window
+        self.__digests_offset = _HEADER_SIZE
+        self.__times_offset = self.__digests_offset + length * 8
+        self.__references_offset = self.__times_offset + length * 8
+        size = self.__references_offset + length
+
+        self.path = None
+        self.__file = None
+
+        if path is None:
+            self.__map = mmap(-1, size)
+
+        else:
+            self.path = f'{path}-{slots}w{window}.v{_LAYOUT_VERSION}'
+            self.__file = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+
+            try:
+                with self.__writer():
+                    header = _HEADER.pack(_MAGIC, _LAYOUT_VERSION, slots, window)
+
+                    # A new file, or the one left by a worker that crashed while creating it
+                    if os.fstat(self.__file).st_size != size or os.pread(self.__file, _HEADER.size, 0) != header:
+                        os.ftruncate(self.__file, 0)
+                        os.ftruncate(self.__file, size)
+                        os.pwrite(self.__file, header, 0)
+
+                self.__map = mmap(self.__file, size)
+
+            except BaseException:
+                os.close(self.__file)
+                raise
+
+        view = memoryview(self.__map)
+        self.__digests = view[self.__digests_offset:self.__times_offset].cast('Q')
+        self.__times = view[self.__times_offset:self.__references_offset].cast('d')
+        self.__references = view[self.__references_offset:]
+        view.release()
+
+
+    def take(self, buckets: list[tuple[bytes, Limit]]) -> Decision:
+        """
+        Take a token from every bucket, the tokens are taken only if every
+        bucket has one. 'buckets' are the keys with their limits, at least one
+        """
+
+        with self.__writer():
+            now = time()
+
+            located = []
+            decision = None
+
+            for key, limit in buckets:
+                start, digest = self.__start(key)
+                index = self.__locate(start, digest, now)
+                arrival = max(self.__times[index] if index is not None else 0.0, now) + limit.interval
+
+                # Seconds the bucket runs ahead of now, 'burst' intervals at most
+                ahead = arrival - now
+                capacity = limit.burst * limit.interval
+
+                if ahead > capacity:
+                    retry_after = ahead - capacity
+                    if decision is None or decision.allowed or retry_after > decision.retry_after:
+                        decision = Decision(False, limit.burst, 0, ahead - limit.interval, retry_after)
+
+                    continue
+
+                remaining = int((capacity - ahead) / limit.interval + 1e-9)
+                if decision is None or (decision.allowed and remaining < decision.remaining):
+                    decision = Decision(True, limit.burst, remaining, ahead, 0.0)
+
+                located.append((start, digest, index, arrival))
+
+            if decision.allowed:
+                for start, digest, index, arrival in located:
+                    if index is None:
+                        index = self.__claim(start, digest, now)
+
+                    self.__times[index] = arrival
+                    self.__references[index] = 1
+
+            return decision
+
+
+    def close(self):
+        self.__digests.release()
+        self.__times.release()
+        self.__references.release()
+        self.__map.close()
+
+        if self.__file is not None:
+            os.close(self.__file)
+
+
+    @contextmanager
+    def __writer(self):
+        if self.__file is None:
+            yield
+            return
+
+        fcntl.flock(self.__file, fcntl.LOCK_EX)
+        try:
+            yield
+
+        finally:
+            fcntl.flock(self.__file, fcntl.LOCK_UN)
+
+
+    def __start(self, key: bytes) -> tuple[int, int]:
+        """
+        Return the first slot of the window and the digest of the key, 0 is the digest of the free slot
+        """
+
+        digest = int.from_bytes(blake2b(key, digest_size = 8).digest(), 'little')
+        return digest % self.slots, digest or 1
+
+
+    def __locate(self, start: int, digest: int, now: float) -> int | None:
+        """
+        Return the slot of the bucket, that is not full yet, or None
+        """
+
+        for index in range(start, start + self.window):
+            if self.__digests[index] == digest and self.__times[index] > now:
+                return index
+
+        return None
+
+
+    def __claim(self, start: int, digest: int, now: float) -> int:
+        """
+        Return the slot for the new bucket of the key: a free one or the one
+        of a full bucket, otherwise the first slot without the reference bit
+        after the CLOCK hand, clearing the bits it passes
+        """
+
+        index = None
+        for candidate in range(start, start + self.window):
+            if not self.__digests[candidate] or self.__times[candidate] <= now:
+                index = candidate
+                break
+
+        if index is None:
+            hand = _HAND.unpack_from(self.__map, _HAND_OFFSET)[0]
+            _HAND.pack_into(self.__map, _HAND_OFFSET, (hand + 1) & 0xffffffff)
+
+            # Two passes at most, the first one clears every reference bit
+            index = start + hand % self.window
+            for step in range(2 * self.window):
+                candidate = start + (hand + step) % self.window
+
+                if not self.__references[candidate]:
+                    index = candidate
+                    break
+
+                self.__references[candidate] = 0
+
+        self.__digests[index] = digest
+        return index
+
+
+class RateLimiter:
+    """
+    Token buckets of the route groups per client IP and per authenticated user
+    """
+
+    def __init__(self, table: BucketTable, groups: dict[str, tuple[Limit | None, Limit | None]]):
+        self.table = table
+
+        # route group -> the limits per IP and per user
+        self.groups = groups
+
+
+    def take(self, group: str, ip: str | None, username: str | None) -> Decision | None:
+        """
+        Take a token from the buckets of the client in the group, return None,
+        if none of them limits the request
+        """
+
+        ip_limit, user_limit = self.groups.get(group, (None, None))
+
+        buckets = []
+        if ip_limit and ip:
+            buckets.append((f'{group}\0ip\0{ip}'.encode(), ip_limit))
+
+        if user_limit and username:
+            buckets.append((f'{group}\0user\0{username}'.encode(), user_limit))
+
+        if not buckets:
+            return None
+
+        return self.table.take(buckets)
+
+
+    def close(self):
+        self.table.close()
+
+
+def create_rate_limiter(config: RateLimitConfig) -> RateLimiter:
+    table = BucketTable(config.path if config.shared else None,
+                        slots = config.slots,
+                        window = config.window)
+
+    groups: dict[str, RateLimitGroupConfig] = {
+        AUTH: config.auth,
+        WRITE: config.write,
+        READ: config.read,
+        REDIRECT: config.redirect,
+    }
+
+    return RateLimiter(table, {
+        group: (Limit.from_config(limits.ip), Limit.from_config(limits.user))
+        for group, limits in groups.items()
+    })
+
+
+def _headers(decision: Decision) -> list[tuple[bytes, bytes]]:
+    headers = [
+        (b'ratelimit-limit', str(decision.limit).encode()),
+        (b'ratelimit-remaining', str(decision.remaining).encode()),
+        (b'ratelimit-reset', str(math.ceil(decision.reset)).encode()),
+    ]
+
+    if not decision.allowed:
+        headers.append((b'retry-after', str(max(1, math.ceil(decision.retry_after))).encode()))
+
+    return headers
+
+
+_TOO_MANY_REQUESTS_BODY = json.dumps({'detail': TOO_MANY_REQUESTS_DETAIL}, separators = (',', ':')).encode()
+
+
+class RateLimitMiddleware:
+    """
+    ASGI middleware that takes a token from the buckets of the client before
+    the request is handled, and answers 429 with 'Retry-After', if a bucket
+    is empty. The limited responses carry 'RateLimit-Limit', 'RateLimit-Remaining'
+    and 'RateLimit-Reset' of the tightest bucket.
+
+    The user is the owner of the Bearer token, the invalid tokens are limited
+    by IP only and rejected by the route later
+    """
+
+    def __init__(self, app, *, forwarded: bool = False):
+        self.app = app
+        self.forwarded = forwarded
+
+        # Found on the first request, once every router is included
+        self.__reserved_paths: frozenset[str] | None = None
+
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        if self.__reserved_paths is None:
+            self.__find_routes(scope['app'])
+
+        group = self.__route_group(scope['method'], scope['path'])
+        if group is None:
+            return await self.app(scope, receive, send)
+
+        dependencies = scope['app'].state.dependencies
+
+        ip, token = self.__client(scope)
+
+        username = None
+        if token:
+            try:
+                username = dependencies.auth.get_user_by_access_token(token)
+
+            except InvalidTokenError:
+                pass
+
+        decision = dependencies.rate_limiter.take(group, ip, username)
+        if decision is None:
+            return await self.app(scope, receive, send)
+
+        headers = _headers(decision)
+
+        if not decision.allowed:
+            await send({
+                'type': 'http.response.start',
+                'status': 429,
+                'headers': [
+                    (b'content-length', str(len(_TOO_MANY_REQUESTS_BODY)).encode()),
+                    (b'content-type', b'application/json'),
+                    *headers,
+                ],
+            })
+            await send({'type': 'http.response.body', 'body': _TOO_MANY_REQUESTS_BODY})
+            return
+
+        async def send_with_headers(message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = [*message.get('headers', ()), *headers]
+
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+
+    def __route_group(self, method: str, path: str) -> str | None:
+        if path in _AUTH_PATHS:
+            return AUTH
+
+        if path.startswith(_API_PREFIXES):
+            return READ if method in _READ_METHODS else WRITE
+
+        # The redirects are the single segment paths, that are not taken by the other routes
+        if method in _READ_METHODS and len(path) > 1 and path.find('/', 1) == -1 and path not in self.__reserved_paths:
+            return REDIRECT
+
+        return None
+
+
+    def __find_routes(self, app):
+        # The routes of the application, that match single segment paths before the redirect
+        self.__reserved_paths = frozenset(
+            route.path for route in app.routes
+            if getattr(route, 'path', '').count('/') == 1 and '{' not in route.path
+        )
+
+
+    def __client(self, scope) -> tuple[str | None, str | None]:
+        """
+        Return the IP of the client and its Bearer token
+        """
+
+        client = scope.get('client')
+        ip = client[0] if client else None
+
+        token = None
+        for name, value in scope['headers']:
+            if name == b'authorization':
+                scheme, _, credentials = value.decode('latin-1').partition(' ')
+                if scheme.lower() == 'bearer' and credentials:
+                    token = credentials.strip()
+
+            elif name == b'x-forwarded-for' and self.forwarded:
+                ip = value.decode('latin-1').rsplit(',', 1)[-1].strip() or ip
+
+        return ip, token
@@ -0,0 +1,50 @@
+from typing import Any, TypeVar
+
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+
+ModelT = TypeVar('ModelT', bound = BaseModel)
+
+
+def construct(model: type[ModelT], values: dict[str, Any]) -> ModelT:
+    """
+    Return the model of the values, that were checked by the storage already,
+    without validating them again.
+
+    Unlike 'model_construct', which is slower than the validation itself,
+    every field has to be in 'values' and no defaults are filled
+    """
+
+    fields = model.model_fields
+
+    instance = model.__new__(model)
+    object.__setattr__(instance, '__dict__', {name: values[name] for name in fields})
+    object.__setattr__(instance, '__pydantic_fields_set__', set(fields))
+    object.__setattr__(instance, '__pydantic_extra__', None)
+    object.__setattr__(instance, '__pydantic_private__', None)
+
+    return instance
+
+
+class ModelResponse(JSONResponse):
+    """
+    JSON response of a Pydantic model, or a list of them, that is serialized
+    by the model's own serializer.
+
+    FastAPI validates the returned value against the response model again and
+    encodes it twice, the routes that build their response models from the
+    storage records (with 'construct') return this response instead.
+    The route keeps 'response_model' for the documentation
+    """
+
+    def render(self, content: BaseModel | list[BaseModel]) -> bytes:
+        if isinstance(content, list):
+            return b'[' + b','.join(self.__dump(item) for item in content) + b']'
+
+        return self.__dump(content)
+
+
+    @staticmethod
+    def __dump(model: BaseModel) -> bytes:
+        return model.__pydantic_serializer__.to_json(model)
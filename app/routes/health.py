@@ -0,0 +1,28 @@
+from fastapi import APIRouter, HTTPException, Request, status
+
+
+router = APIRouter(tags = ['Health'])
+
+
+@router.get('/healthz')
+async def liveness():
+    """
+    The worker is running
+    """
+
+    return {'status': 'ok'}
+
+
+@router.get('/readyz')
+async def readiness(request: Request):
+    """
+    The worker has warmed up and is not shutting down
+    """
+
+    if not request.app.state.ready:
+        raise HTTPException(
+            status_code = status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail = 'The application is not ready'
+        )
+
+    return {'status': 'ready'}
@@ -0,0 +1,27 @@
+from fastapi import APIRouter, HTTPException, status
+
+from app.schemas.job import JobInfo
+from app.dependencies import JobsDependency
+
+
+router = APIRouter(
+    prefix = '/jobs',
+    tags = ['Jobs'],
+)
+
+
+@router.get('/{job_id}')
+async def get_job(job_id: str, jobs: JobsDependency) -> JobInfo:
+    """
+    Return the state of the job, the random 'job_id' is its only credential,
+    so the job of a deleted user can still be followed
+    """
+
+    job = await jobs.get_job(job_id)
+    if not job:
+        raise HTTPException(
+            status_code = status.HTTP_404_NOT_FOUND,
+            detail = 'The job was not found'
+        )
+
+    return JobInfo(**job.to_dict())
@@ -0,0 +1,13 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from app.metrics import PROMETHEUS_MEDIA_TYPE
+from app.dependencies import MetricsDependency
+
+
+router = APIRouter(tags = ['Metrics'])
+
+
+@router.get('/metrics', response_class = PlainTextResponse)
+async def get_metrics(metrics: MetricsDependency):
+    return PlainTextResponse(metrics.render(), media_type = PROMETHEUS_MEDIA_TYPE)
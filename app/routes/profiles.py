@@ -0,0 +1,60 @@
+import hmac
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, Header, HTTPException, status
+from fastapi.responses import FileResponse
+
+from app.profiling import ProfileInfo, ProfileStore
+from app.dependencies import ConfigDependency, ProfilesDependency
+
+
+async def must_have_profile_token(config: ConfigDependency,
+                                  profiles: ProfilesDependency,
+                                  x_profile: Annotated[str | None, Header()] = None) -> ProfileStore:
+    """
+    Return the profile store
+
+    Raise HTTPException, if profiling is disabled or the 'X-Profile' header is wrong
+    """
+
+    if not profiles:
+        raise HTTPException(
+            status_code = status.HTTP_404_NOT_FOUND,
+            detail = 'Profiling is disabled'
+        )
+
+    # Starlette decodes the headers as latin-1, and 'compare_digest' only takes ASCII strings
+    token = config.profiling.token
+    if not token or not x_profile or not hmac.compare_digest(x_profile.encode('latin-1'), token.encode()):
+        raise HTTPException(
+            status_code = status.HTTP_403_FORBIDDEN,
+            detail = 'The profiling token is wrong'
+        )
+
+    return profiles
+
+
+ProfileStoreDependency = Annotated[ProfileStore, Depends(must_have_profile_token)]
+
+
+router = APIRouter(
+    prefix = '/debug/profiles',
+    tags = ['Profiling'],
+)
+
+
+@router.get('/')
+async def list_profiles(profiles: ProfileStoreDependency) -> list[ProfileInfo]:
+    return profiles.list()
+
+
+@router.get('/{name}')
+async def get_profile(name: str, profiles: ProfileStoreDependency):
+    path = profiles.path(name)
+    if not path:
+        raise HTTPException(
+            status_code = status.HTTP_404_NOT_FOUND,
+            detail = f'The profile "{name}" was not found'
+        )
+
+    return FileResponse(path, media_type = 'text/plain')
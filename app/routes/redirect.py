@@ -1,35 +1,64 @@
+from typing import Annotated
+
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.responses import RedirectResponse
 
-from app.dependencies import StorageDependency
+from app.db.models import UrlTarget
+from app.dependencies import ClicksDependency, StorageDependency
+
+
+# Also sent by FastRedirectMiddleware, so both paths answer the same
+NOT_FOUND_DETAIL = 'The page was not found!'
+NOT_ACTIVE_DETAIL = 'The URL is not active!'
+EXPIRED_DETAIL = 'The URL has expired!'
 
 
 router = APIRouter()
 
 
-async def url_must_be_active(internal_url: str, 
-                             storage: StorageDependency):
-    
-    url = await storage.get_url(internal_url)
-    if not url.active:
+async def url_must_be_active(internal_url: str,
+                             storage: StorageDependency) -> UrlTarget:
+    """
+    Resolve the URL with a single storage lookup and return its redirect target
+
+    Raise HTTPException, if the URL does not exist, has expired or is not active
+    """
+
+    target = await storage.resolve(internal_url)
+    if not target:
         raise HTTPException(
-            status_code = status.HTTP_403_FORBIDDEN,
-            detail = 'The URL is not active!'
+            status_code = status.HTTP_404_NOT_FOUND,
+            detail = NOT_FOUND_DETAIL,
         )
-    
 
-@router.get('/{internal_url}', dependencies = [Depends(url_must_be_active)])
-async def get_redirect(internal_url: str, storage: StorageDependency):
-    if not await storage.url_exists(internal_url):
+    # Until the storage purges it
+    if target.expired():
         raise HTTPException(
-            status_code = status.HTTP_404_NOT_FOUND,
-            detail = 'The page was not found!',
+            status_code = status.HTTP_410_GONE,
+            detail = EXPIRED_DETAIL,
+        )
+
+    if not target.active:
+        raise HTTPException(
+            status_code = status.HTTP_403_FORBIDDEN,
+            detail = NOT_ACTIVE_DETAIL
         )
-    
-    redirect_url = await storage.get_original_url(internal_url)
-    return RedirectResponse(url = redirect_url)
+
+    return target
+
+
+ActiveUrlDependency = Annotated[UrlTarget, Depends(url_must_be_active)]
+
+
+@router.get('/{internal_url}')
+async def get_redirect(internal_url: str,
+                       target: ActiveUrlDependency,
+                       clicks: ClicksDependency):
+
+    clicks.hit(internal_url)
+    return RedirectResponse(url = target.original_url)
 
 
 @router.get('/')
 async def get_empty_redirect():
-    return RedirectResponse(url = 'https://google.com')
\ No newline at end of file
+    return RedirectResponse(url = 'https://google.com')
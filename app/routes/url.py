@@ -1,13 +1,32 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+import json
+import logging
 
-from app.schemas.url import UrlCreateIn, UrlCreateOut, UrlInfo
-from app.unique_url import generate_url
-from app.dependencies import CurrentUserDependency, StorageDependency
+from typing import AsyncIterator
 
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
 
-async def must_be_url_owner(internal_url: str | None, 
-                            user: CurrentUserDependency,
-                            storage: StorageDependency):
+from app.db.base_storage import BaseStorage
+from app.db.exceptions import DatabaseError
+from app.db.models import Url
+from app.unique_url import UrlAllocator
+from app.responses import ModelResponse, construct
+from app.schemas.url import UrlCreateIn, UrlCreateOut, UrlImportIn, UrlInfo, UrlBatchItemOut
+from app.dependencies import AllocatorDependency, ConfigDependency, CurrentUserDependency, StorageDependency
+
+
+logger = logging.getLogger(__name__)
+
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+# The longer lines of the imported body are reported without being parsed
+MAX_IMPORT_LINE = 64 * 1024
+
+
+async def must_be_url_owner(user: CurrentUserDependency,
+                            storage: StorageDependency,
+                            internal_url: str | None = None):
     """
     Raise HTTPException if the URL does not exist or the user is not the owner
     """
@@ -36,34 +55,354 @@ router = APIRouter(
 )
 
 
-@router.post('/')
+@router.post('/', response_model = UrlCreateOut)
 async def create_url(current_user: CurrentUserDependency, 
                      new_url: UrlCreateIn,
-                     storage: StorageDependency) -> UrlCreateOut:
-    
-    internal_url = generate_url()
+                     storage: StorageDependency,
+                     allocator: AllocatorDependency,
+                     reuse: bool = False) -> ModelResponse:
+    """
+    Create the URL. With 'reuse', the URL created with 'reuse' before for the
+    same 'original_url' is returned instead, if it still exists
+    """
+
+    if reuse:
+        if new_url.expires_at or new_url.ttl:
+            raise HTTPException(
+                status_code = status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail = 'The reused URLs can not expire'
+            )
+
+        url = await storage.get_reusable_url(current_user.username, new_url.original_url)
+        if not url:
+            url = await storage.create_reusable_url(owner_username = current_user.username,
+                                                    original_url = new_url.original_url,
+                                                    internal_url = await allocator.allocate())
+
+        # Otherwise, another URL has the same hash, and a new one is created without reuse
+        if url.original_url == new_url.original_url:
+            return ModelResponse(UrlCreateOut.from_url(url))
+
+    internal_url = await allocator.allocate()
+    expires_at = new_url.expiration()
 
     await storage.create_url(owner_username = current_user.username,
                              original_url = new_url.original_url,
-                             internal_url = internal_url)
+                             internal_url = internal_url,
+                             expires_at = expires_at)
     
-    return UrlCreateOut(original_url = new_url.original_url,
-                        owner = current_user.username, 
-                        active = True, 
-                        internal_url = internal_url)
+    return ModelResponse(UrlCreateOut.from_url(Url(original_url = new_url.original_url,
+                                                   internal_url = internal_url,
+                                                   owner = current_user.username,
+                                                   expires_at = expires_at)))
+
+
+def parse_batch(body: bytes, content_type: str) -> list[UrlCreateIn | str]:
+    """
+    Parse the body of the batch creation request (JSON array or NDJSON)
+
+    Return the parsed URL or the validation error of every item, raise
+    HTTPException, if the body is not an array or can not be decoded
+    """
+
+    try:
+        if content_type.startswith(NDJSON_MEDIA_TYPE):
+            items = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            items = json.loads(body)
+
+    except ValueError:
+        raise HTTPException(
+            status_code = status.HTTP_400_BAD_REQUEST,
+            detail = 'The body is not valid JSON or NDJSON'
+        )
+
+    if not isinstance(items, list):
+        raise HTTPException(
+            status_code = status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail = 'The body must be an array of URLs'
+        )
+
+    parsed_items = []
+    for item in items:
+        try:
+            parsed_items.append(UrlCreateIn.model_validate(item))
+
+        except ValidationError as error:
+            parsed_items.append(str(error))
+
+    return parsed_items
+
+
+async def read_body(request: Request, max_size: int) -> bytes:
+    """
+    Return the body of the request
+
+    Raise HTTPException, once the body grows past 'max_size' bytes, so a
+    large body is never kept in memory
+    """
+
+    too_large_exception = HTTPException(
+        status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail = f'The body can not be larger than {max_size} bytes'
+    )
+
+    content_length = request.headers.get('content-length', '')
+    if content_length.isdigit() and int(content_length) > max_size:
+        raise too_large_exception
+
+    size = 0
+    chunks = []
+
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_size:
+            raise too_large_exception
+
+        chunks.append(chunk)
+
+    return b''.join(chunks)
+
+
+@router.post('/batch', response_model = list[UrlBatchItemOut])
+async def create_urls(request: Request,
+                      current_user: CurrentUserDependency,
+                      storage: StorageDependency,
+                      allocator: AllocatorDependency,
+                      config: ConfigDependency) -> ModelResponse:
+    """
+    Create up to 'url.batch_limit' URLs from a JSON array or NDJSON body of
+    up to 'url.batch_body_limit' bytes, and return the result of every item in order
+    """
+
+    body = await read_body(request, config.url.batch_body_limit)
+    items = parse_batch(body, request.headers.get('content-type', ''))
+    if len(items) > config.url.batch_limit:
+        raise HTTPException(
+            status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail = f'The batch can not contain more than {config.url.batch_limit} URLs'
+        )
+
+    new_urls = []
+    for item in items:
+        if isinstance(item, UrlCreateIn):
+            new_urls.append(Url(original_url = item.original_url,
+                                internal_url = await allocator.allocate(),
+                                owner = current_user.username,
+                                expires_at = item.expiration()))
+
+    errors = iter(await storage.create_urls(new_urls))
+    new_urls = iter(new_urls)
+
+    results = []
+    for item in items:
+        if not isinstance(item, UrlCreateIn):
+            results.append(construct(UrlBatchItemOut, {'url': None, 'error': item}))
+            continue
+
+        url, error = next(new_urls), next(errors)
+        if error:
+            results.append(construct(UrlBatchItemOut, {'url': None, 'error': str(error)}))
+        else:
+            results.append(construct(UrlBatchItemOut, {'url': UrlCreateOut.from_url(url), 'error': None}))
+
+    return ModelResponse(results)
+
+
+class DuplexStreamingResponse(StreamingResponse):
+    """
+    Streaming response that is sent while the request body is still read.
+
+    StreamingResponse reads the request messages itself to notice the
+    disconnect, so it would take the body from the content generator. Here the
+    generator reads them, and the disconnect ends it with ClientDisconnect
+    """
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+
+        if self.background is not None:
+            await self.background()
+
+
+async def read_lines(chunks: AsyncIterator[bytes], max_length: int) -> AsyncIterator[bytes | None]:
+    """
+    Split the streamed body into lines, a line longer than 'max_length' is returned as None
+    """
+
+    buffer = b''
+    too_long = False
+
+    async for chunk in chunks:
+        lines = (buffer + chunk).split(b'\n')
+        buffer = lines.pop()
+
+        for line in lines:
+            yield None if too_long or len(line) > max_length else line
+            too_long = False
+
+        # The rest of the long line is dropped, until its end is found
+        if len(buffer) > max_length:
+            buffer = b''
+            too_long = True
+
+    if too_long or buffer:
+        yield None if too_long else buffer
+
+
+def validation_message(error: ValidationError) -> str:
+    return '; '.join(detail['msg'] for detail in error.errors(include_url = False))
+
+
+async def import_lines(lines: AsyncIterator[bytes | None],
+                       owner: str,
+                       storage: BaseStorage,
+                       allocator: UrlAllocator,
+                       chunk_size: int,
+                       keep_urls: bool = False) -> AsyncIterator[bytes]:
+    """
+    Create the URLs from the NDJSON lines in chunks and return the NDJSON report:
+    the error of every failed line and the progress after every chunk.
+
+    With 'keep_urls', the lines with 'internal_url' keep it, a URL that is
+    taken already is reported as the error of its line.
+
+    The response is already started, so a storage error (a driver one as
+    well) ends the report with the last progress line, that has the error
+    and 'done' false
+    """
+
+    processed = created = failed = 0
+
+    urls: list[Url] = []
+    url_lines: list[int] = []
+    report: list[str] = []
+
+    async def write_urls():
+        nonlocal created, failed
+
+        errors = await storage.create_urls(urls)
+        for line_number, error in zip(url_lines, errors):
+            if error:
+                failed += 1
+                report.append(json.dumps({'line': line_number, 'error': str(error)}))
+            else:
+                created += 1
+
+        urls.clear()
+        url_lines.clear()
+
+    def storage_failure(error: Exception) -> bytes:
+        if isinstance(error, DatabaseError):
+            return flush_report(error = str(error), done = False)
+
+        logger.exception('Failed to import the URLs of %s', owner)
+        return flush_report(error = 'The storage is unavailable', done = False)
+
+    def flush_report(**extra) -> bytes:
+        report.append(json.dumps({'processed': processed, 'created': created, 'failed': failed, **extra}))
+        chunk = ('\n'.join(report) + '\n').encode()
+        report.clear()
+
+        return chunk
+
+    # The next lines are read only once the chunk is written, so a fast
+    # client waits for the storage instead of filling the memory
+    async for line in lines:
+        processed += 1
+
+        if line is None:
+            failed += 1
+            report.append(json.dumps({'line': processed, 'error': f'The line is longer than {MAX_IMPORT_LINE} bytes'}))
+
+        elif line.strip():
+            try:
+                item = UrlImportIn.model_validate_json(line)
+
+            except ValidationError as error:
+                failed += 1
+                report.append(json.dumps({'line': processed, 'error': validation_message(error)}))
+
+            else:
+                if keep_urls and item.internal_url:
+                    internal_url = item.internal_url
+                else:
+                    internal_url = await allocator.allocate()
+
+                urls.append(Url(original_url = item.original_url,
+                                internal_url = internal_url,
+                                owner = owner,
+                                active = item.active,
+                                expires_at = item.expiration()))
+                url_lines.append(processed)
+
+        if len(urls) == chunk_size:
+            try:
+                await write_urls()
+
+            except Exception as error:
+                yield storage_failure(error)
+                return
+
+            yield flush_report()
+
+        # The body of invalid lines is reported in chunks as well
+        elif len(report) >= chunk_size:
+            yield flush_report()
+
+    if urls:
+        try:
+            await write_urls()
+
+        except Exception as error:
+            yield storage_failure(error)
+            return
+
+    yield flush_report(done = True)
+
+
+@router.post('/import')
+async def import_urls(request: Request,
+                      current_user: CurrentUserDependency,
+                      storage: StorageDependency,
+                      allocator: AllocatorDependency,
+                      config: ConfigDependency,
+                      keep_urls: bool = False) -> StreamingResponse:
+    """
+    Create the URLs from a streamed NDJSON body of URL creation requests of
+    any size (the lines of 'GET /user/me/urls/export' are accepted as well,
+    they keep their 'active' flag).
+
+    With 'keep_urls', the lines with 'internal_url' keep the short URL, the
+    ones that are taken already fail with '"URL ... already exists"'.
+
+    The URLs are written in chunks of 'url.batch_limit'. The response is
+    streamed as NDJSON: '{"line": ..., "error": ...}' for every failed line
+    and '{"processed": ..., "created": ..., "failed": ...}' after every chunk,
+    the last one carries '"done": true'
+    """
+
+    lines = read_lines(request.stream(), MAX_IMPORT_LINE)
+    return DuplexStreamingResponse(import_lines(lines,
+                                                current_user.username,
+                                                storage,
+                                                allocator,
+                                                config.url.batch_limit,
+                                                keep_urls),
+                                   media_type = NDJSON_MEDIA_TYPE)
 
 
-@router.get('/{internal_url}/info')
+@router.get('/{internal_url}/info', response_model = UrlInfo)
 async def get_url(internal_url: str, 
-                  storage: StorageDependency) -> UrlInfo:
+                  storage: StorageDependency) -> ModelResponse:
     
-    return await storage.get_url(internal_url)
+    return ModelResponse(UrlInfo.from_url(await storage.get_url(internal_url)))
 
 
-@router.put('/{internal_url}')
+@router.put('/{internal_url}', response_model = UrlInfo)
 async def change_url_active(internal_url: str, 
                             active: bool,
-                            storage: StorageDependency) -> UrlInfo:
+                            storage: StorageDependency) -> ModelResponse:
     
     if active:
         await storage.enable_url(internal_url)
@@ -71,14 +410,14 @@ async def change_url_active(internal_url: str,
     else:
         await storage.disable_url(internal_url)
 
-    return await storage.get_url(internal_url)
+    return ModelResponse(UrlInfo.from_url(await storage.get_url(internal_url)))
 
 
-@router.delete('/{internal_url}')
+@router.delete('/{internal_url}', response_model = UrlInfo)
 async def delete_url(internal_url: str,
-                     storage: StorageDependency) -> UrlInfo:
+                     storage: StorageDependency) -> ModelResponse:
     
     url = await storage.get_url(internal_url)
     await storage.delete_url(internal_url)
 
-    return url
+    return ModelResponse(UrlInfo.from_url(url))
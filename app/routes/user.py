@@ -1,14 +1,26 @@
-from typing import Annotated
-from fastapi import APIRouter, Depends, HTTPException, status
+import json
+
+from datetime import datetime
+from time import time
+from typing import Annotated, AsyncIterator
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 
-from app.db.models import User
-from app.db.exceptions import UserExistsError
+from app.db.base_storage import BaseStorage
+from app.db.models import User, utc_timestamp
+from app.db.exceptions import UserExistsError, UserNotExistError
+from app.auth.exceptions import HasherBusyError
 
 from app.schemas.user import UserInfo, UserRegisterIn, UserRegisterOut
 from app.schemas.token import AccessToken
+from app.schemas.url import UrlInfo, UrlPage
+from app.schemas.job import JobInfo
+from app.routes.url import NDJSON_MEDIA_TYPE
+from app.responses import ModelResponse, construct
 
-from app.dependencies import AuthDependency, CurrentUserDependency, StorageDependency
+from app.dependencies import (AuthDependency, CurrentUserDependency, JobsDependency, StorageDependency,
+                              UserCacheDependency)
 
 
 router = APIRouter(
@@ -17,21 +29,112 @@ router = APIRouter(
 )
 
 
+hasher_busy_exception = HTTPException(
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE,
+    detail = 'The server is busy, try again later',
+    headers = {'Retry-After': '1'}
+)
+
+
 async def authenticate_user(username: str, 
                             password: str,
                             auth: AuthDependency,
                             storage: StorageDependency) -> bool:
+    """
+    Return True, if the password is correct.
+
+    The password is rehashed, if its hash was made with another bcrypt cost
+
+    Raise HasherBusyError, if too many passwords are being hashed
+    """
     
     user = await storage.get_user(username)
-    if not user:
+    if not user or user.deleting:
         return False
     
-    return auth.verify_password(password, user.hashed_password)
+    verified, new_hash = await auth.verify_password(password, user.hashed_password)
+    if verified and new_hash:
+        await storage.update_user_password(username, new_hash)
+
+    return verified
 
 
-@router.get('/me')
-async def get_me(current_user: CurrentUserDependency) -> UserInfo:
-    return current_user    
+@router.get('/me', response_model = UserInfo)
+async def get_me(current_user: CurrentUserDependency) -> ModelResponse:
+    return ModelResponse(UserInfo.from_user(current_user))
+
+
+@router.delete('/me', status_code = status.HTTP_202_ACCEPTED)
+async def delete_me(current_user: CurrentUserDependency,
+                    jobs: JobsDependency,
+                    users: UserCacheDependency,
+                    response: Response) -> JobInfo:
+    """
+    Start deleting the user with the URLs in background and return the job,
+    that is followed by 'GET /jobs/{job_id}'. The user can not log in from now on
+    """
+
+    try:
+        job = await jobs.delete_user(current_user.username)
+
+    except UserNotExistError:
+        raise HTTPException(
+            status_code = status.HTTP_404_NOT_FOUND,
+            detail = 'The user was not found'
+        )
+
+    users.pop(current_user.username)
+
+    response.headers['Location'] = f'/jobs/{job.job_id}'
+    return JobInfo(**job.to_dict())
+
+
+@router.get('/me/urls', response_model = UrlPage)
+async def get_my_urls(current_user: CurrentUserDependency,
+                      storage: StorageDependency,
+                      after: str | None = None,
+                      limit: Annotated[int, Query(ge = 1, le = 1000)] = 100,
+                      active: bool | None = None) -> ModelResponse:
+    """
+    Return a page of the user's URLs sorted by 'internal_url', starting after
+    the 'after' cursor and optionally filtered by the 'active' flag
+    """
+
+    urls = await storage.list_urls(current_user.username,
+                                   after = after,
+                                   limit = limit,
+                                   active = active)
+
+    next_cursor = urls[-1].internal_url if len(urls) == limit else None
+    return ModelResponse(construct(UrlPage, {'urls': [UrlInfo.from_url(url) for url in urls],
+                                             'next_cursor': next_cursor}))
+
+
+async def export_lines(storage: BaseStorage, username: str) -> AsyncIterator[bytes]:
+    """
+    Return the URLs of the user as NDJSON, a chunk per storage batch.
+
+    The expired URLs, that are not purged yet, are skipped, they could not be imported anyway
+    """
+
+    async for urls in storage.iter_urls(username):
+        now = time()
+        yield ''.join(json.dumps(url.to_dict(), default = datetime.isoformat) + '\n'
+                      for url in urls
+                      if url.expires_at is None or utc_timestamp(url.expires_at) > now).encode()
+
+
+@router.get('/me/urls/export')
+async def export_my_urls(current_user: CurrentUserDependency,
+                         storage: StorageDependency) -> StreamingResponse:
+    """
+    Stream every URL of the user as NDJSON sorted by 'internal_url', the
+    lines are accepted by 'POST /url/import'
+    """
+
+    return StreamingResponse(export_lines(storage, current_user.username),
+                             media_type = NDJSON_MEDIA_TYPE,
+                             headers = {'Content-Disposition': 'attachment; filename="urls.ndjson"'})
 
 
 @router.post('/regist')
@@ -39,12 +142,15 @@ async def create_user(user: UserRegisterIn,
                       storage: StorageDependency,
                       auth: AuthDependency) -> UserRegisterOut:
 
-    new_user = User(username = user.username, 
-                    hashed_password = auth.hash_password(user.password))
-    
     try:
+        new_user = User(username = user.username, 
+                        hashed_password = await auth.hash_password(user.password))
+    
         await storage.create_user(new_user)
 
+    except HasherBusyError:
+        raise hasher_busy_exception
+
     except UserExistsError:
         raise HTTPException(
             status_code = status.HTTP_400_BAD_REQUEST,
@@ -59,10 +165,14 @@ async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm,
                                  auth: AuthDependency,
                                  storage: StorageDependency):
     
-    authenticated = await authenticate_user(form_data.username,
-                                            form_data.password,
-                                            auth, 
-                                            storage)
+    try:
+        authenticated = await authenticate_user(form_data.username,
+                                                form_data.password,
+                                                auth, 
+                                                storage)
+    
+    except HasherBusyError:
+        raise hasher_busy_exception
     
     if not authenticated:
         raise HTTPException(
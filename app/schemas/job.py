@@ -0,0 +1,20 @@
+from datetime import datetime
+
+from pydantic import BaseModel
+
+
+class JobInfo(BaseModel):
+    """
+    Represent the state of the background job
+
+    'processed' is the number of the documents (URLs, etc.) handled so far
+    """
+
+    job_id: str
+    kind: str
+    state: str
+    processed: int = 0
+    error: str | None = None
+
+    created_at: datetime
+    updated_at: datetime
@@ -1,4 +1,15 @@
-from pydantic import BaseModel
+from datetime import datetime, timedelta, timezone
+
+from pydantic import BaseModel, model_validator
+
+from app.db.models import Url
+from app.responses import construct
+from app.unique_url import ALPHABET
+
+
+MAX_INTERNAL_URL_LENGTH = 64
+
+_INTERNAL_URL_CHARACTERS = frozenset(ALPHABET)
 
 
 class UrlBase(BaseModel):
@@ -18,13 +29,83 @@ class UrlInfo(UrlBase):
     active: bool
     internal_url: str
 
+    clicks: int = 0
+    last_access: datetime | None = None
+    expires_at: datetime | None = None
+
+
+    @classmethod
+    def from_url(cls, url: Url) -> 'UrlInfo':
+        """
+        Return the model of the stored URL without validating it again
+        """
+
+        return construct(cls, url.to_dict())
+
 
 class UrlCreateIn(UrlBase):
     """
     Represent URL creation request
+
+    The URL expires at 'expires_at' (UTC, if the time zone is missing) or
+    'ttl' after its creation, it never expires, if neither is set
     """
     
-    pass
+    expires_at: datetime | None = None
+    ttl: timedelta | None = None
+
+
+    @model_validator(mode = 'after')
+    def check_expiration(self) -> 'UrlCreateIn':
+        if self.expires_at and self.ttl:
+            raise ValueError('Only one of "expires_at" and "ttl" can be set')
+
+        if self.ttl is not None and self.ttl <= timedelta(0):
+            raise ValueError('"ttl" must be positive')
+
+        if self.expires_at:
+            if self.expires_at.tzinfo is None:
+                self.expires_at = self.expires_at.replace(tzinfo = timezone.utc)
+
+            if self.expires_at <= datetime.now(timezone.utc):
+                raise ValueError('"expires_at" must be in the future')
+
+        return self
+
+
+    def expiration(self) -> datetime | None:
+        """
+        Return the time the URL expires at
+        """
+
+        if self.ttl:
+            return datetime.now(timezone.utc) + self.ttl
+
+        return self.expires_at
+
+
+class UrlImportIn(UrlCreateIn):
+    """
+    Represent a line of the imported NDJSON body, the exported URLs keep
+    their 'active' flag and, if it is asked for, their 'internal_url'
+    """
+
+    active: bool = True
+    internal_url: str | None = None
+
+
+    @model_validator(mode = 'after')
+    def check_internal_url(self) -> 'UrlImportIn':
+        if self.internal_url is None:
+            return self
+
+        if not 0 < len(self.internal_url) <= MAX_INTERNAL_URL_LENGTH:
+            raise ValueError(f'"internal_url" must be from 1 to {MAX_INTERNAL_URL_LENGTH} characters long')
+
+        if not set(self.internal_url) <= _INTERNAL_URL_CHARACTERS:
+            raise ValueError('"internal_url" can contain only digits and ASCII letters')
+
+        return self
 
 
 class UrlCreateOut(UrlInfo):
@@ -32,4 +113,26 @@ class UrlCreateOut(UrlInfo):
     Represent URL creation response
     """
     
-    pass
\ No newline at end of file
+    pass
+
+
+class UrlPage(BaseModel):
+    """
+    Represent a page of the URL list
+
+    'next_cursor' is passed as 'after' to get the next page, it is None on the last page
+    """
+
+    urls: list[UrlInfo]
+    next_cursor: str | None = None
+
+
+class UrlBatchItemOut(BaseModel):
+    """
+    Represent the result of a single URL in the batch creation response.
+
+    Either 'url' or 'error' is set
+    """
+
+    url: UrlCreateOut | None = None
+    error: str | None = None
@@ -1,5 +1,8 @@
 from pydantic import BaseModel
 
+from app.db.models import User
+from app.responses import construct
+
 
 class UserBase(BaseModel):
     """
@@ -12,9 +15,18 @@ class UserBase(BaseModel):
 class UserInfo(UserBase):
     """
     Represent full user information
+
+    The URLs of the user are listed by 'GET /user/me/urls'
     """
-    
-    owned_urls: list[str] 
+
+
+    @classmethod
+    def from_user(cls, user: User) -> 'UserInfo':
+        """
+        Return the model of the stored user without validating it again
+        """
+
+        return construct(cls, {'username': user.username})
 
 
 class UserRegisterIn(UserBase):
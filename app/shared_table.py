@@ -0,0 +1,388 @@
+import fcntl
+import os
+
+from contextlib import contextmanager
+from datetime import timedelta
+from hashlib import blake2b
+from mmap import mmap
+from struct import Struct
+from time import time
+
+from app.db.base_storage import BaseStorage
+from app.db.models import UrlTarget, utc_timestamp
+from app.db.storage_wrapper import StorageWrapper
+
+
+_LAYOUT_VERSION = 2
+
+# magic, layout version, slots, key size, value size, probe window
+_HEADER = Struct('<8sIQHHH')
+_HEADER_SIZE = 64
+_MAGIC = b'URLSHM01'
+
+# The position of the CLOCK hand, right after the header fields
+_HAND = Struct('<I')
+_HAND_OFFSET = _HEADER.size
+
+# sequence, expiration time, key length, flags, value length
+_SLOT_HEADER = Struct('<IIBBH')
+_SEQUENCE = Struct('<I')
+_SLOT_BODY = Struct('<IBBH')
+
+_ACTIVE = 1
+
+# The generation of the keys, whose window starts at the slot
+_GENERATION = Struct('<I')
+
+
+class SharedRedirectTable:
+    """
+    Hash table of 'internal_url' -> redirect target in a file mapped by every
+    worker of the host ('/dev/shm' keeps it in memory).
+
+    Every entry lives in a fixed size slot: a header, the key and the target
+    in place, so 'slots' entries take 'slots * (18 + key_size + value_size)'
+    bytes once per host. A key goes to one of 'window' slots after its hash
+    (open addressing), a byte per slot keeps a part of the hash to find the
+    candidates, and another byte is the reference bit of the CLOCK eviction.
+
+    The readers take no locks. A writer makes the sequence of the slot odd,
+    writes the slot and makes the sequence even again, and a reader drops the
+    entry that was read with an odd or changed sequence, so a torn entry is
+    never returned, only missed. The writers of all workers are serialized
+    by 'flock' of the file.
+
+    Every deletion bumps the generation of the key in the file, and 'put'
+    stores the target only if the generation has not changed since the
+    caller read it before its lookup. So a lookup of any worker, that started
+    before a change, never fills the table with the old target.
+
+    The keys and targets that do not fit into a slot are not cached.
+    The file name carries the layout, so the workers with other settings
+    never share a file
+    """
+
+    def __init__(self,
+                 path: str,
+                 *,
+                 slots: int = 1_000_000,
+                 key_size: int = 16,
+                 value_size: int = 100,
+                 window: int = 8):
+
+        self.slots = slots
+        self.key_size = key_size
+        self.value_size = value_size
+        self.window = window
+
+        self.path = f'{path}-{slots}x{key_size}+{value_size}w{window}.v{_LAYOUT_VERSION}'
+
+        self.__slot_size = _SLOT_HEADER.size + key_size + value_size
+
+        # The windows of the last slots do not wrap around, so they take 'window' more slots
+        self.__generations_offset = _HEADER_SIZE
+        self.__tags_offset = self.__generations_offset + slots * _GENERATION.size
+        self.__references_offset = self.__tags_offset + slots + window
+        self.__slots_offset = self.__references_offset + slots + window
+        size = self.__slots_offset + (slots + window) * self.__slot_size
+
+        self.__file = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        try:
+            with self.__writer():
+                header = _HEADER.pack(_MAGIC, _LAYOUT_VERSION, slots, key_size, value_size, window)
+
+                # A new file, or the one left by a worker that crashed while creating it
+                if os.fstat(self.__file).st_size != size or os.pread(self.__file, _HEADER.size, 0) != header:
+                    os.ftruncate(self.__file, 0)
+                    os.ftruncate(self.__file, size)
+                    os.pwrite(self.__file, header, 0)
+
+            self.__map = mmap(self.__file, size)
+
+        except BaseException:
+            os.close(self.__file)
+            raise
+
+
+    def get(self, internal_url: str) -> UrlTarget | None:
+        """
+        Return the target of the URL or None, if the URL is missing, expired
+        or is being written right now
+        """
+
+        key = internal_url.encode()
+        if len(key) > self.key_size:
+            return None
+
+        start, tag = self.__locate(key)
+        tags = self.__map[self.__tags_offset + start:self.__tags_offset + start + self.window]
+
+        now = time()
+        position = tags.find(tag)
+        while position != -1:
+            index = start + position
+
+            target = self.__read(index, key, now)
+            if target:
+                references_index = self.__references_offset + index
+                if not self.__map[references_index]:
+                    self.__map[references_index] = 1
+
+                return target
+
+            position = tags.find(tag, position + 1)
+
+        return None
+
+
+    def generation(self, internal_url: str) -> int:
+        """
+        Return the generation of the URL, that is passed to 'put' after the lookup of its target
+        """
+
+        start, _ = self.__locate(internal_url.encode())
+        return self.__generation(start)
+
+
+    def put(self, internal_url: str, target: UrlTarget, ttl: timedelta, generation: int | None = None):
+        """
+        Store the target of the URL for 'ttl', but never past its expiration,
+        evicting a rarely used entry of its window.
+
+        If 'generation' is given, the target is dropped, once the URL was
+        deleted from the table after the generation was read
+        """
+
+        key = internal_url.encode()
+        value = target.original_url.encode()
+
+        if len(key) > self.key_size or len(value) > self.value_size:
+            return
+
+        # Rounded down, so the entry is dropped no later than the URL expires
+        expires_at = time() + ttl.total_seconds()
+        if target.expires_at is not None:
+            expires_at = min(expires_at, utc_timestamp(target.expires_at))
+
+        expires_at = int(expires_at)
+        if expires_at <= time():
+            return
+
+        start, tag = self.__locate(key)
+
+        with self.__writer():
+            if generation is not None and generation != self.__generation(start):
+                return
+
+            index = self.__find(start, tag, key)
+            if index is None:
+                index = self.__free_slot(start)
+
+            self.__write(index, tag, key, value, expires_at, _ACTIVE if target.active else 0)
+
+
+    def delete(self, internal_url: str):
+        """
+        Drop the entry of the URL and bump its generation, so the targets read before are not stored
+        """
+
+        key = internal_url.encode()
+        start, tag = self.__locate(key)
+
+        with self.__writer():
+            _GENERATION.pack_into(self.__map,
+                                  self.__generations_offset + start * _GENERATION.size,
+                                  (self.__generation(start) + 1) & 0xffffffff)
+
+            if len(key) > self.key_size:
+                return
+
+            index = self.__find(start, tag, key)
+            if index is not None:
+                self.__write(index, 0, b'', b'', 0, 0)
+
+
+    def close(self):
+        self.__map.close()
+        os.close(self.__file)
+
+
+    @contextmanager
+    def __writer(self):
+        fcntl.flock(self.__file, fcntl.LOCK_EX)
+        try:
+            yield
+
+        finally:
+            fcntl.flock(self.__file, fcntl.LOCK_UN)
+
+
+    def __generation(self, start: int) -> int:
+        return _GENERATION.unpack_from(self.__map, self.__generations_offset + start * _GENERATION.size)[0]
+
+
+    def __locate(self, key: bytes) -> tuple[int, int]:
+        """
+        Return the first slot of the window and the tag of the key, 0 is the tag of the free slot
+        """
+
+        digest = int.from_bytes(blake2b(key, digest_size = 8).digest(), 'little')
+        return (digest >> 8) % self.slots, (digest & 0xff) or 1
+
+
+    def __read(self, index: int, key: bytes, now: float) -> UrlTarget | None:
+        offset = self.__slots_offset + index * self.__slot_size
+        sequence, expires_at, key_length, flags, value_length = _SLOT_HEADER.unpack_from(self.__map, offset)
+
+        if sequence & 1 or key_length != len(key) or expires_at <= now:
+            return None
+
+        key_offset = offset + _SLOT_HEADER.size
+        if self.__map[key_offset:key_offset + key_length] != key:
+            return None
+
+        value_offset = key_offset + self.key_size
+        value = self.__map[value_offset:value_offset + value_length]
+
+        if _SEQUENCE.unpack_from(self.__map, offset)[0] != sequence:
+            return None
+
+        return UrlTarget(original_url = value.decode(), active = bool(flags & _ACTIVE))
+
+
+    def __find(self, start: int, tag: int, key: bytes) -> int | None:
+        """
+        Return the slot of the key in the window, the caller holds the writer lock
+        """
+
+        tags = self.__map[self.__tags_offset + start:self.__tags_offset + start + self.window]
+
+        position = tags.find(tag)
+        while position != -1:
+            offset = self.__slots_offset + (start + position) * self.__slot_size
+            _, key_length, _, _ = _SLOT_BODY.unpack_from(self.__map, offset + _SEQUENCE.size)
+            key_offset = offset + _SLOT_HEADER.size
+
+            if self.__map[key_offset:key_offset + key_length] == key:
+                return start + position
+
+            position = tags.find(tag, position + 1)
+
+        return None
+
+
+    def __free_slot(self, start: int) -> int:
+        """
+        Return a free or expired slot of the window, otherwise the first slot
+        without the reference bit after the CLOCK hand, clearing the bits it passes
+        """
+
+        now = time()
+        for index in range(start, start + self.window):
+            if not self.__map[self.__tags_offset + index]:
+                return index
+
+            offset = self.__slots_offset + index * self.__slot_size
+            expires_at, _, _, _ = _SLOT_BODY.unpack_from(self.__map, offset + _SEQUENCE.size)
+            if expires_at <= now:
+                return index
+
+        hand = _HAND.unpack_from(self.__map, _HAND_OFFSET)[0]
+        _HAND.pack_into(self.__map, _HAND_OFFSET, (hand + 1) & 0xffffffff)
+
+        # Two passes at most, the first one clears every reference bit
+        for step in range(2 * self.window):
+            index = start + (hand + step) % self.window
+            references_index = self.__references_offset + index
+
+            if not self.__map[references_index]:
+                return index
+
+            self.__map[references_index] = 0
+
+        return start + hand % self.window
+
+
+    def __write(self, index: int, tag: int, key: bytes, value: bytes, expires_at: int, flags: int):
+        offset = self.__slots_offset + index * self.__slot_size
+        sequence = _SEQUENCE.unpack_from(self.__map, offset)[0]
+
+        _SEQUENCE.pack_into(self.__map, offset, (sequence + 1) & 0xffffffff)
+
+        _SLOT_BODY.pack_into(self.__map, offset + _SEQUENCE.size, expires_at, len(key), flags, len(value))
+        key_offset = offset + _SLOT_HEADER.size
+        self.__map[key_offset:key_offset + len(key)] = key
+        value_offset = key_offset + self.key_size
+        self.__map[value_offset:value_offset + len(value)] = value
+
+        _SEQUENCE.pack_into(self.__map, offset, (sequence + 2) & 0xffffffff)
+
+        self.__map[self.__tags_offset + index] = tag
+        self.__map[self.__references_offset + index] = 1 if key else 0
+
+
+class SharedTableStorage(StorageWrapper):
+    """
+    Storage that serves 'resolve' from the shared redirect table and fills it
+    on a miss. The URLs changed through this storage or passed to 'invalidate'
+    (by the invalidation bus) are dropped from the table, the rest of the
+    changes are seen after 'ttl'
+    """
+
+    def __init__(self, storage: BaseStorage, table: SharedRedirectTable, *, ttl: timedelta = timedelta(minutes = 1)):
+        super().__init__(storage)
+
+        self.table = table
+        self.ttl = ttl
+
+
+    def invalidate(self, internal_url: str):
+        self.table.delete(internal_url)
+
+
+    async def resolve(self, internal_url: str) -> UrlTarget | None:
+        target = self.table.get(internal_url)
+        if target:
+            return target
+
+        # The target read before an invalidation by any worker would be cached for the whole TTL
+        generation = self.table.generation(internal_url)
+        target = await self.storage.resolve(internal_url)
+
+        if target:
+            self.table.put(internal_url, target, self.ttl, generation)
+
+        return target
+
+
+    async def enable_url(self, internal_url: str):
+        await self.storage.enable_url(internal_url)
+        self.invalidate(internal_url)
+
+
+    async def disable_url(self, internal_url: str):
+        await self.storage.disable_url(internal_url)
+        self.invalidate(internal_url)
+
+
+    async def delete_url(self, internal_url: str):
+        await self.storage.delete_url(internal_url)
+        self.invalidate(internal_url)
+
+
+    async def delete_user_urls(self, username: str, limit: int) -> list[str]:
+        internal_urls = await self.storage.delete_user_urls(username, limit)
+
+        for internal_url in internal_urls:
+            self.invalidate(internal_url)
+
+        return internal_urls
+
+
+    async def close(self):
+        try:
+            await self.storage.close()
+
+        finally:
+            self.table.close()
@@ -1,10 +1,131 @@
-from string import ascii_letters
-from random import choice
+from asyncio import Lock
+from hashlib import blake2b, sha256
+from string import digits, ascii_letters
 
+from app.db.base_storage import BaseStorage
+from app.url_filter import CuckooFilter
 
-def generate_url(length: int = 10):
+
+ALPHABET = digits + ascii_letters
+
+_FEISTEL_ROUNDS = 4
+
+
+class UrlAllocator:
     """
-    Return the ASCII symbol sequence with provided length
+    Allocate unique short URLs from blocks of sequence numbers reserved in the storage.
+
+    A block is reserved with one atomic increment, then its numbers are handed out
+    without any I/O, so the URLs never collide and never need an existence check.
+    Every number is encoded in base62 with the shortest length, starting from
+    'min_length', whose keyspace still has room for it. Legacy 10 letter URLs can
+    not collide with the allocated ones until every shorter keyspace is exhausted.
+
+    If 'secret_key' is provided, the numbers are shuffled inside every keyspace
+    by a keyed Feistel permutation, so the next URLs can not be guessed.
+
+    If 'url_filter' is provided, the URLs it may contain (the legacy ones, etc.)
+    are skipped, so a collision is ruled out without a storage lookup
     """
-    
-    return ''.join(choice(ascii_letters) for _ in range(length))
\ No newline at end of file
+
+    def __init__(self,
+                 storage: BaseStorage,
+                 *,
+                 block_size: int = 1000,
+                 min_length: int = 6,
+                 secret_key: str | None = None,
+                 url_filter: CuckooFilter | None = None):
+
+        self.block_size = block_size
+        self.min_length = min_length
+
+        self.__storage = storage
+        self.__url_filter = url_filter
+        self.__lock = Lock()
+
+        self.__next_id = 0
+        self.__block_end = 0
+
+        self.__key = sha256(secret_key.encode()).digest() if secret_key else None
+
+
+    async def allocate(self) -> str:
+        """
+        Return a new unique URL
+        """
+
+        while True:
+            if self.__next_id == self.__block_end:
+                async with self.__lock:
+                    if self.__next_id == self.__block_end:
+                        first_id = await self.__storage.reserve_ids(self.block_size)
+
+                        self.__next_id = first_id
+                        self.__block_end = first_id + self.block_size
+
+            number = self.__next_id
+            self.__next_id += 1
+
+            url = self.encode(number)
+
+            # A saturated filter reports every URL, so it can not rule anything out
+            url_filter = self.__url_filter
+            if not url_filter or url_filter.saturated or not url_filter.might_contain(url):
+                return url
+
+
+    def encode(self, number: int) -> str:
+        """
+        Return the URL for the sequence number
+        """
+
+        length = self.min_length
+        capacity = len(ALPHABET) ** length
+
+        while number >= capacity:
+            number -= capacity
+            length += 1
+            capacity = len(ALPHABET) ** length
+
+        if self.__key:
+            number = self.__permute(number, capacity)
+
+        symbols = []
+        for _ in range(length):
+            number, index = divmod(number, len(ALPHABET))
+            symbols.append(ALPHABET[index])
+
+        return ''.join(reversed(symbols))
+
+
+    def __permute(self, number: int, capacity: int) -> int:
+        """
+        Map the number onto another one below 'capacity' one-to-one.
+
+        The Feistel network permutes the smallest even-bit domain covering the
+        keyspace, and the results outside of the keyspace are walked again
+        """
+
+        bits = (capacity - 1).bit_length()
+        bits += bits % 2
+
+        half = bits // 2
+        mask = (1 << half) - 1
+
+        while True:
+            left, right = number >> half, number & mask
+
+            for round_index in range(_FEISTEL_ROUNDS):
+                left, right = right, left ^ (self.__round(round_index, right) & mask)
+
+            number = (left << half) | right
+            if number < capacity:
+                return number
+
+
+    def __round(self, round_index: int, value: int) -> int:
+        digest = blake2b(value.to_bytes(8, 'little') + bytes((round_index,)),
+                         key = self.__key,
+                         digest_size = 8).digest()
+
+        return int.from_bytes(digest, 'little')
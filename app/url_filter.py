@@ -0,0 +1,371 @@
+import logging
+import os
+import sys
+
+from array import array
+from datetime import datetime
+from hashlib import blake2b
+from math import ceil, log2
+from random import Random
+from struct import Struct
+
+from app.db.base_storage import BaseStorage
+from app.db.models import Url, UrlTarget
+from app.db.exceptions import DatabaseError
+from app.db.storage_wrapper import StorageWrapper
+
+
+logger = logging.getLogger(__name__)
+
+_BUCKET_SIZE = 4
+_MAX_LOAD = 0.95
+_MAX_KICKS = 500
+
+# Fingerprint width -> array type code of the table
+_TYPECODES = {8: 'B', 16: 'H', 32: 'I'}
+
+# magic, fingerprint bits, saturated, buckets, count
+_SNAPSHOT_HEADER = Struct('<8sBBQQ')
+_SNAPSHOT_MAGIC = b'URLCUCK1'
+
+
+def _fingerprint_bits(false_positive_rate: float) -> int:
+    """
+    Return the narrowest table item that keeps the false positive rate.
+
+    A lookup compares the fingerprint with 2 buckets of '_BUCKET_SIZE' slots
+    """
+
+    bits = ceil(log2(2 * _BUCKET_SIZE / false_positive_rate))
+    for width in _TYPECODES:
+        if bits <= width:
+            return width
+
+    raise ValueError(f'The false positive rate {false_positive_rate} is too low')
+
+
+class CuckooFilter:
+    """
+    Cuckoo filter of strings in a flat array of fingerprints.
+
+    A string that was never added is reported as a possible member with the
+    'false_positive_rate' probability, an added one is always reported.
+    Unlike a Bloom filter, the strings can be removed, but only the ones
+    that were added, otherwise another member may be lost.
+
+    If a string can not be placed (the filter holds much more than 'capacity'
+    strings), the filter becomes saturated and reports every string as a
+    possible member until it is rebuilt
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float = 0.001):
+        self.fingerprint_bits = _fingerprint_bits(false_positive_rate)
+
+        # The alternate bucket is found by XOR, so their number is a power of 2
+        self.buckets = 1 << max(0, ceil(log2(ceil(capacity / (_BUCKET_SIZE * _MAX_LOAD)))))
+
+        self.count = 0
+        self.saturated = False
+
+        self.__mask = self.buckets - 1
+        self.__max_fingerprint = (1 << self.fingerprint_bits) - 1
+
+        # 0 is the empty slot
+        self.__table = array(_TYPECODES[self.fingerprint_bits], [0]) * (self.buckets * _BUCKET_SIZE)
+        self.__random = Random(0)
+
+
+    def __len__(self) -> int:
+        return self.count
+
+
+    def add(self, item: str) -> bool:
+        """
+        Add the string and return False, if the filter became saturated
+        """
+
+        fingerprint, index = self.__hash(item)
+        alternate_index = self.__alternate_index(index, fingerprint)
+
+        if self.__place(index, fingerprint) or self.__place(alternate_index, fingerprint):
+            self.count += 1
+            return True
+
+        # Evict a random fingerprint to its alternate bucket, until one of them finds a free slot
+        index = self.__random.choice((index, alternate_index))
+        for _ in range(_MAX_KICKS):
+            slot = index * _BUCKET_SIZE + self.__random.randrange(_BUCKET_SIZE)
+            fingerprint, self.__table[slot] = self.__table[slot], fingerprint
+
+            index = self.__alternate_index(index, fingerprint)
+            if self.__place(index, fingerprint):
+                self.count += 1
+                return True
+
+        # The last evicted fingerprint has no slot, so its string could be missed
+        self.saturated = True
+        return False
+
+
+    def remove(self, item: str) -> bool:
+        """
+        Remove the string that was added before, return False, if it was not found
+        """
+
+        fingerprint, index = self.__hash(item)
+
+        for bucket in (index, self.__alternate_index(index, fingerprint)):
+            start = bucket * _BUCKET_SIZE
+            for slot in range(start, start + _BUCKET_SIZE):
+                if self.__table[slot] == fingerprint:
+                    self.__table[slot] = 0
+                    self.count -= 1
+                    return True
+
+        return False
+
+
+    def might_contain(self, item: str) -> bool:
+        """
+        Return False, if the string was definitely not added
+        """
+
+        if self.saturated:
+            return True
+
+        fingerprint, index = self.__hash(item)
+
+        start = index * _BUCKET_SIZE
+        if fingerprint in self.__table[start:start + _BUCKET_SIZE]:
+            return True
+
+        start = self.__alternate_index(index, fingerprint) * _BUCKET_SIZE
+        return fingerprint in self.__table[start:start + _BUCKET_SIZE]
+
+
+    def save(self, path: str):
+        """
+        Write the filter to the file atomically
+        """
+
+        table = self.__table
+        if sys.byteorder == 'big':
+            table = array(table.typecode, table)
+            table.byteswap()
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+
+        temporary_path = f'{path}.tmp'
+        with open(temporary_path, 'wb') as snapshot_file:
+            snapshot_file.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC,
+                                                      self.fingerprint_bits,
+                                                      self.saturated,
+                                                      self.buckets,
+                                                      self.count))
+            table.tofile(snapshot_file)
+
+        os.replace(temporary_path, path)
+
+
+    def load(self, path: str) -> bool:
+        """
+        Replace the content of the filter with the snapshot, return False, if the
+        snapshot is missing, corrupted or was made with other settings
+        """
+
+        try:
+            with open(path, 'rb') as snapshot_file:
+                header = snapshot_file.read(_SNAPSHOT_HEADER.size)
+                if len(header) != _SNAPSHOT_HEADER.size:
+                    return False
+
+                magic, fingerprint_bits, saturated, buckets, count = _SNAPSHOT_HEADER.unpack(header)
+                if (magic != _SNAPSHOT_MAGIC
+                        or fingerprint_bits != self.fingerprint_bits
+                        or buckets != self.buckets):
+                    return False
+
+                table = array(self.__table.typecode)
+                table.fromfile(snapshot_file, len(self.__table))
+
+        except (FileNotFoundError, EOFError):
+            return False
+
+        if sys.byteorder == 'big':
+            table.byteswap()
+
+        self.__table = table
+        self.saturated = bool(saturated)
+        self.count = count
+        return True
+
+
+    def clear(self):
+        self.__table = array(self.__table.typecode, [0]) * len(self.__table)
+        self.count = 0
+        self.saturated = False
+
+
+    def __hash(self, item: str) -> tuple[int, int]:
+        """
+        Return the fingerprint and the bucket of the string
+        """
+
+        digest = int.from_bytes(blake2b(item.encode(), digest_size = 8).digest(), 'little')
+        return (digest >> 32) % self.__max_fingerprint + 1, digest & self.__mask
+
+
+    def __alternate_index(self, index: int, fingerprint: int) -> int:
+        return (index ^ (fingerprint * 0x5bd1e995)) & self.__mask
+
+
+    def __place(self, index: int, fingerprint: int) -> bool:
+        start = index * _BUCKET_SIZE
+        for slot in range(start, start + _BUCKET_SIZE):
+            if not self.__table[slot]:
+                self.__table[slot] = fingerprint
+                return True
+
+        return False
+
+
+class FilteredStorage(StorageWrapper):
+    """
+    Storage that answers the lookups of the URLs, that are definitely missing
+    from the filter, without calling the wrapped storage.
+
+    The filter is built from the storage by 'setup' (or loaded from the snapshot)
+    and follows the URLs created and deleted through this storage. The URLs
+    deleted with their owner stay in the filter, which only costs a lookup.
+
+    A miss is definite only if every URL is created through this storage, so
+    the filter answers the lookups only if it is 'authoritative' (the storage
+    of a single process). Otherwise the URLs of the other workers are missing
+    from it: the lookups always reach the storage, the filter only rules out
+    the collisions of the allocated URLs, and the deleted URLs stay in it,
+    since removing a URL, that was never added, drops a colliding one
+    """
+
+    def __init__(self,
+                 storage: BaseStorage,
+                 url_filter: CuckooFilter,
+                 *,
+                 snapshot_path: str | None = None,
+                 authoritative: bool = True):
+
+        super().__init__(storage)
+
+        self.url_filter = url_filter
+        self.snapshot_path = snapshot_path
+        self.authoritative = authoritative
+
+
+    async def setup(self):
+        await self.storage.setup()
+
+        if not self.authoritative:
+            logger.warning('The storage may be shared by other workers, so the URL filter '
+                           'does not answer the lookups of the missing URLs')
+
+        # The snapshot is removed once loaded, so the filter is rebuilt after a
+        # crash instead of missing the URLs created since the snapshot
+        if self.snapshot_path and self.url_filter.load(self.snapshot_path):
+            os.remove(self.snapshot_path)
+            logger.info('Loaded %d URLs into the filter from %s', len(self.url_filter), self.snapshot_path)
+            return
+
+        self.url_filter.clear()
+        async for batch in self.storage.iter_internal_urls():
+            for internal_url in batch:
+                self.url_filter.add(internal_url)
+
+        if self.url_filter.saturated:
+            logger.warning('The URL filter is saturated by %d URLs, increase its capacity', len(self.url_filter))
+
+
+    async def create_url(self,
+                         *,
+                         owner_username: str,
+                         original_url: str,
+                         internal_url: str,
+                         expires_at: datetime | None = None):
+
+        await self.storage.create_url(owner_username = owner_username,
+                                      original_url = original_url,
+                                      internal_url = internal_url,
+                                      expires_at = expires_at)
+        self.url_filter.add(internal_url)
+
+
+    async def create_urls(self, urls: list[Url]) -> list[DatabaseError | None]:
+        errors = await self.storage.create_urls(urls)
+
+        for url, error in zip(urls, errors):
+            if not error:
+                self.url_filter.add(url.internal_url)
+
+        return errors
+
+
+    async def create_reusable_url(self,
+                                  *,
+                                  owner_username: str,
+                                  original_url: str,
+                                  internal_url: str) -> Url:
+
+        url = await self.storage.create_reusable_url(owner_username = owner_username,
+                                                     original_url = original_url,
+                                                     internal_url = internal_url)
+
+        # The URL of a concurrent request is in the filter already
+        if url.internal_url == internal_url:
+            self.url_filter.add(internal_url)
+
+        return url
+
+
+    async def get_url(self, internal_url: str) -> Url | None:
+        if self.authoritative and not self.url_filter.might_contain(internal_url):
+            return None
+
+        return await self.storage.get_url(internal_url)
+
+
+    async def resolve(self, internal_url: str) -> UrlTarget | None:
+        if self.authoritative and not self.url_filter.might_contain(internal_url):
+            return None
+
+        return await self.storage.resolve(internal_url)
+
+
+    async def url_exists(self, internal_url: str) -> bool:
+        if self.authoritative and not self.url_filter.might_contain(internal_url):
+            return False
+
+        return await self.storage.url_exists(internal_url)
+
+
+    async def delete_url(self, internal_url: str):
+        await self.storage.delete_url(internal_url)
+
+        if self.authoritative:
+            self.url_filter.remove(internal_url)
+
+
+    async def delete_user_urls(self, username: str, limit: int) -> list[str]:
+        internal_urls = await self.storage.delete_user_urls(username, limit)
+
+        if self.authoritative:
+            for internal_url in internal_urls:
+                self.url_filter.remove(internal_url)
+
+        return internal_urls
+
+
+    async def close(self):
+        try:
+            if self.snapshot_path:
+                self.url_filter.save(self.snapshot_path)
+
+        finally:
+            await self.storage.close()
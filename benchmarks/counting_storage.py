@@ -0,0 +1,27 @@
+from collections import Counter
+from typing import Any
+
+from app.db.storage_wrapper import StorageWrapper
+
+
+class CountingStorage(StorageWrapper):
+    """
+    Storage that counts the calls of every method of the wrapped storage
+    """
+
+    def __init__(self, storage):
+        super().__init__(storage)
+        self.calls: Counter[str] = Counter()
+
+
+    async def _call(self, method: str, *args, **kwargs) -> Any:
+        self.calls[method] += 1
+        return await super()._call(method, *args, **kwargs)
+
+
+    def reset(self):
+        self.calls.clear()
+
+
+    def total(self) -> int:
+        return sum(self.calls.values())
@@ -0,0 +1,101 @@
+"""
+Compare the hydration of the storage records with the generated model
+methods against dacite, 'dataclasses.asdict' and the validation of the
+response by FastAPI:
+
+    python -m benchmarks.hydration --rounds 100000
+
+'response' is the whole path of 'GET /url/{internal_url}/info' from the
+MongoDB document to the body of the response
+"""
+
+import argparse
+import json
+
+from dataclasses import asdict
+from datetime import datetime
+from time import perf_counter
+from typing import Any, Callable
+
+from dacite import from_dict
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from app.db.models import User, Url
+from app.responses import ModelResponse
+from app.schemas.url import UrlInfo
+
+
+_USER_DOCUMENT = {'_id': 'ObjectId', 'username': 'bench', 'hashed_password': '$2b$12$' + 'x' * 53}
+
+_URL_DOCUMENT = {
+    '_id': 'ObjectId',
+    'original_url': 'https://example.com/some/long/path?with=query',
+    'internal_url': 'b1a2c3',
+    'owner': 'bench',
+    'active': True,
+    'clicks': 42,
+    'last_access': datetime(2024, 1, 1, 12, 30),
+}
+
+
+def _measure(function: Callable[[], Any], rounds: int) -> float:
+    """
+    Return the microseconds per call
+    """
+
+    started = perf_counter()
+    for _ in range(rounds):
+        function()
+
+    return (perf_counter() - started) / rounds * 1e6
+
+
+def _compare(old: Callable[[], Any], new: Callable[[], Any], rounds: int) -> dict[str, float]:
+    old_us, new_us = _measure(old, rounds), _measure(new, rounds)
+    return {'old_us': old_us, 'new_us': new_us, 'speedup': old_us / new_us}
+
+
+async def _serialize_old(field, url: Url) -> bytes:
+    return JSONResponse(await serialize_response(field = field, response_content = url)).body
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__,
+                                     formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type = int, default = 100_000)
+    args = parser.parse_args()
+
+    field = create_response_field(name = 'Response_get_url', type_ = UrlInfo, mode = 'serialization')
+    url = Url.from_dict(_URL_DOCUMENT)
+
+    def respond_old() -> bytes:
+        # 'serialize_response' never awaits, so the coroutine finishes in a single step
+        coroutine = _serialize_old(field, from_dict(Url, _URL_DOCUMENT))
+        try:
+            coroutine.send(None)
+
+        except StopIteration as stop:
+            return stop.value
+
+    def respond_new() -> bytes:
+        return ModelResponse(UrlInfo.from_url(Url.from_dict(_URL_DOCUMENT))).body
+
+    assert json.loads(respond_old()) == json.loads(respond_new())
+
+    results = {
+        'user_from_dict': _compare(lambda: from_dict(User, _USER_DOCUMENT),
+                                   lambda: User.from_dict(_USER_DOCUMENT), args.rounds),
+        'url_from_dict': _compare(lambda: from_dict(Url, _URL_DOCUMENT),
+                                  lambda: Url.from_dict(_URL_DOCUMENT), args.rounds),
+        'url_to_dict': _compare(lambda: asdict(url), url.to_dict, args.rounds),
+        'url_info': _compare(lambda: UrlInfo(**asdict(url)), lambda: UrlInfo.from_url(url), args.rounds),
+        'response': _compare(respond_old, respond_new, args.rounds),
+    }
+
+    print(json.dumps(results, indent = 2))
+
+
+if __name__ == '__main__':
+    main()
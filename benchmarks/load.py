@@ -0,0 +1,227 @@
+"""
+Load and latency benchmark of the whole application.
+
+The application of 'app.main' is driven in-process through the httpx ASGI
+transport on top of the in-memory storage, so neither network nor MongoDB is involved:
+
+    python -m benchmarks.load
+    python -m benchmarks.load --scenario redirect_hit --requests 20000
+    python -m benchmarks.load --save-baseline
+
+Every scenario reports throughput, p50/p95/p99 latency and storage calls per
+request as JSON, next to the import and warm-up time of the application. If the
+baseline file exists, the results are compared with it and the exit code is 1,
+when any scenario regressed beyond '--tolerance'
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+
+from collections import Counter
+from time import perf_counter
+from typing import Any, Awaitable, Callable
+
+import httpx
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+CONFIG_TEMPLATE = '''
+jwt:
+  secret_key: 'benchmark'
+  algorithm: 'HS256'
+
+storage:
+  backend: 'memory'
+
+password:
+  rounds: {rounds}
+
+url:
+  fast_redirect: {fast_redirect}
+
+url_filter:
+  enabled: {url_filter}
+
+redirect_table:
+  enabled: {redirect_table}
+  path: '{config_dir}/redirects'
+'''
+
+
+def _load_app(args: argparse.Namespace) -> tuple[Any, Any, float]:
+    """
+    Create the application on top of the in-memory storage wrapped by CountingStorage,
+    and return it with the time that the import of 'app.main' took
+    """
+
+    config_dir = tempfile.mkdtemp()
+    with open(os.path.join(config_dir, 'config.yaml'), 'w') as config_file:
+        config_file.write(CONFIG_TEMPLATE.format(rounds = args.bcrypt_rounds,
+                                                 fast_redirect = str(not args.no_fast_redirect).lower(),
+                                                 url_filter = str(args.url_filter).lower(),
+                                                 redirect_table = str(args.redirect_table).lower(),
+                                                 config_dir = config_dir))
+
+    # The config is read from the working directory on import
+    os.chdir(config_dir)
+
+    started = perf_counter()
+    from app.main import create_app
+    import_seconds = perf_counter() - started
+
+    from app.config import Config
+    from app.db.memory_storage import InMemoryStorage
+
+    from benchmarks.counting_storage import CountingStorage
+
+    storage = CountingStorage(InMemoryStorage())
+    return create_app(Config.load(), storage), storage, import_seconds
+
+
+def _percentile(samples: list[float], q: float) -> float:
+    return samples[min(len(samples) - 1, int(len(samples) * q))] * 1000
+
+
+async def _measure(name: str,
+                   request: Callable[[int], Awaitable[httpx.Response]],
+                   expected_status: int,
+                   storage,
+                   args: argparse.Namespace) -> dict[str, Any]:
+
+    latencies = []
+    statuses = Counter()
+
+    async def worker(start: int):
+        for index in range(start, args.requests, args.concurrency):
+            started = perf_counter()
+            response = await request(index)
+
+            latencies.append(perf_counter() - started)
+            statuses[response.status_code] += 1
+
+    storage.reset()
+    started = perf_counter()
+    await asyncio.gather(*(worker(start) for start in range(args.concurrency)))
+    elapsed = perf_counter() - started
+
+    latencies.sort()
+    return {
+        'scenario': name,
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'throughput_rps': args.requests / elapsed,
+        'p50_ms': _percentile(latencies, 0.50),
+        'p95_ms': _percentile(latencies, 0.95),
+        'p99_ms': _percentile(latencies, 0.99),
+        'errors': args.requests - statuses[expected_status],
+        'storage_calls_per_request': storage.total() / args.requests,
+        'storage_calls': dict(storage.calls),
+    }
+
+
+async def run(args: argparse.Namespace) -> tuple[dict[str, float], list[dict[str, Any]]]:
+    app, storage, import_seconds = _load_app(args)
+    transport = httpx.ASGITransport(app = app)
+
+    started = perf_counter()
+    async with app.router.lifespan_context(app):
+        startup = {'import_ms': import_seconds * 1000, 'warm_up_ms': (perf_counter() - started) * 1000}
+
+        async with httpx.AsyncClient(transport = transport, base_url = 'http://bench') as client:
+            credentials = {'username': 'bench', 'password': 'bench'}
+
+            await client.post('/user/regist', json = credentials)
+            token = (await client.post('/user/token', data = credentials)).json()['access_token']
+            headers = {'Authorization': f'Bearer {token}'}
+
+            created = await client.post('/url/', json = {'original_url': 'https://example.com'}, headers = headers)
+            internal_url = created.json()['internal_url']
+
+            scenarios = {
+                'redirect_hit': (lambda index: client.get(f'/{internal_url}'), 307),
+                'redirect_miss': (lambda index: client.get(f'/missing{index}'), 404),
+                'url_info': (lambda index: client.get(f'/url/{internal_url}/info', headers = headers), 200),
+                'create_url': (lambda index: client.post('/url/',
+                                                         json = {'original_url': f'https://example.com/{index}'},
+                                                         headers = headers), 200),
+                'login': (lambda index: client.post('/user/token', data = credentials), 200),
+            }
+
+            results = []
+            for name, (request, expected_status) in scenarios.items():
+                if args.scenario and name not in args.scenario:
+                    continue
+
+                results.append(await _measure(name, request, expected_status, storage, args))
+
+            return startup, results
+
+
+def compare(results: list[dict[str, Any]],
+            baseline: list[dict[str, Any]],
+            tolerance: float) -> list[str]:
+    """
+    Return the descriptions of the regressions against the baseline
+    """
+
+    baseline_by_scenario = {result['scenario']: result for result in baseline}
+    regressions = []
+
+    for result in results:
+        expected = baseline_by_scenario.get(result['scenario'])
+        if not expected:
+            continue
+
+        if result['throughput_rps'] < expected['throughput_rps'] * (1 - tolerance):
+            regressions.append(f'{result["scenario"]}: throughput {result["throughput_rps"]:.0f} rps, '
+                               f'baseline {expected["throughput_rps"]:.0f} rps')
+
+        if result['p99_ms'] > expected['p99_ms'] * (1 + tolerance):
+            regressions.append(f'{result["scenario"]}: p99 {result["p99_ms"]:.2f} ms, '
+                               f'baseline {expected["p99_ms"]:.2f} ms')
+
+        if result['storage_calls_per_request'] > expected['storage_calls_per_request']:
+            regressions.append(f'{result["scenario"]}: {result["storage_calls_per_request"]:.2f} storage calls '
+                               f'per request, baseline {expected["storage_calls_per_request"]:.2f}')
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__,
+                                     formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', action = 'append', help = 'Run only the scenario (repeatable)')
+    parser.add_argument('--requests', type = int, default = 5000)
+    parser.add_argument('--concurrency', type = int, default = 32)
+    parser.add_argument('--bcrypt-rounds', type = int, default = 12)
+    parser.add_argument('--url-filter', action = 'store_true', help = 'Answer the missing URLs from the cuckoo filter')
+    parser.add_argument('--no-fast-redirect', action = 'store_true', help = 'Serve the redirects by the FastAPI route')
+    parser.add_argument('--redirect-table', action = 'store_true', help = 'Cache the redirects in the shared table')
+    parser.add_argument('--baseline', default = BASELINE_PATH)
+    parser.add_argument('--save-baseline', action = 'store_true')
+    parser.add_argument('--tolerance', type = float, default = 0.2)
+    args = parser.parse_args()
+
+    args.baseline = os.path.abspath(args.baseline)
+    startup, results = asyncio.run(run(args))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent = 2)
+
+    regressions = []
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+
+    print(json.dumps({'startup': startup, 'results': results, 'regressions': regressions}, indent = 2))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Compare the storage backends on the redirect lookup path.
+
+Fill every backend with '--links' URLs of one user, then measure random
+'resolve' hits and misses:
+
+    python -m benchmarks.storage_backends --links 10000000
+    python -m benchmarks.storage_backends --links 10000000 --mongo localhost:27017
+
+The MongoDB run fills a new database named "urlshortener_bench_<random>",
+which is left for inspection and has to be dropped by hand
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import tempfile
+
+from time import perf_counter
+
+from app.db.base_storage import BaseStorage
+from app.db.log_storage import LogStorage
+from app.db.models import User
+
+
+def _percentiles(samples: list[float]) -> dict[str, float]:
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(len(samples) * q))] * 1e6
+
+    return {'p50_us': pick(0.50), 'p95_us': pick(0.95), 'p99_us': pick(0.99)}
+
+
+async def _fill(storage: BaseStorage, links: int, concurrency: int) -> float:
+    """
+    Create 'links' URLs and return the creation rate per second
+    """
+
+    await storage.create_user(User(username = 'bench', hashed_password = '-'))
+
+    async def create(start: int):
+        for index in range(start, links, concurrency):
+            await storage.create_url(owner_username = 'bench',
+                                     original_url = f'https://example.com/{index}',
+                                     internal_url = f'b{index}')
+
+    started = perf_counter()
+    await asyncio.gather(*(create(start) for start in range(concurrency)))
+
+    return links / (perf_counter() - started)
+
+
+async def _lookups(storage: BaseStorage, keys: list[str]) -> dict[str, float]:
+    samples = []
+
+    for key in keys:
+        started = perf_counter()
+        await storage.resolve(key)
+        samples.append(perf_counter() - started)
+
+    return {'ops_per_s': len(samples) / sum(samples), **_percentiles(samples)}
+
+
+async def _run(name: str, storage: BaseStorage, args: argparse.Namespace) -> dict:
+    await storage.setup()
+
+    try:
+        create_rate = await _fill(storage, args.links, args.concurrency)
+
+        hits = [f'b{random.randrange(args.links)}' for _ in range(args.lookups)]
+        misses = [f'missing{index}' for index in range(args.lookups)]
+
+        return {
+            'backend': name,
+            'links': args.links,
+            'create_per_s': create_rate,
+            'resolve_hit': await _lookups(storage, hits),
+            'resolve_miss': await _lookups(storage, misses),
+        }
+
+    finally:
+        await storage.close()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description = __doc__,
+                                     formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--links', type = int, default = 10_000_000)
+    parser.add_argument('--lookups', type = int, default = 100_000)
+    parser.add_argument('--concurrency', type = int, default = 64)
+    parser.add_argument('--mongo', help = 'host:port of a MongoDB server to compare with')
+    args = parser.parse_args()
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as log_path:
+        results.append(await _run('log', LogStorage(log_path), args))
+
+    if args.mongo:
+        from app.db.mongo_storage import MongoStorage
+
+        host, port = args.mongo.rsplit(':', 1)
+        mongo = MongoStorage(host, int(port), f'urlshortener_bench_{random.randrange(1 << 32):x}')
+        results.append(await _run('mongo', mongo, args))
+
+    print(json.dumps(results, indent = 2))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())